@@ -0,0 +1,265 @@
+# app/clustering.py - PERSISTENT CLUSTER MODEL
+
+"""
+Background-maintained K-Means model for candidate pre-filtering
+- Trained once per snapshot content (UserSnapshot.content_version), off the
+  request path (worker thread); failed trainings are logged, kept for
+  stats() and retried with exponential backoff
+- Two methods (CLUSTER_METHOD): Euclidean K-Means on the one-hot features, or
+  Gower-native k-medoids (CLARA) whose clusters agree with the final ranking
+- Persisted with joblib, so a restart serves the last model right away
+- Updated incrementally with partial_fit as users are upserted (on a copy,
+  in a worker thread, swapped in when done); `identity` changes with every
+  (re)fit, so rankings and cursors of one model are
+  never mixed with another's (app/main.py)
+- Queries only pay a label lookup: labels are cached per packed profile code,
+  and a cluster is a subset of the subject partition's profile buckets
+"""
+
+import asyncio
+import copy
+import os
+import time
+import zlib
+from typing import List, Optional
+
+import numpy as np
+
+from .gower_matching import (
+    fit_profile_kmeans,
+    kmedoids_clustering_for_gower,
+    assign_to_medoids,
+    unpack_features
+)
+
+CLUSTER_MODEL_PATH = os.getenv("CLUSTER_MODEL_PATH", "/tmp/gower_cluster_model.joblib")
+CLUSTER_PARTIAL_FIT_BATCH = int(os.getenv("CLUSTER_PARTIAL_FIT_BATCH", "256"))
+CLUSTER_METHOD = os.getenv("CLUSTER_METHOD", "kmeans")    # kmeans | kmedoids
+
+# Backoff after a failed training: doubles per consecutive failure, up to the max
+CLUSTER_RETRY_SECONDS = float(os.getenv("CLUSTER_RETRY_SECONDS", "30"))
+CLUSTER_RETRY_MAX_SECONDS = float(os.getenv("CLUSTER_RETRY_MAX_SECONDS", "600"))
+
+
+class ProfileClusterModel:
+    """K-Means model + label cache indexed by packed profile code"""
+    
+    method = 'kmeans'
+    revision = 0        # models persisted before partial_fit was counted
+    
+    def __init__(self, model, trained_for: str):
+        self.model = model
+        self.trained_for = trained_for      # UserSnapshot.content_version of the training snapshot
+        self.revision = 0                   # partial_fit count
+        self._labels = np.full(1 << 16, -1, dtype=np.int16)
+    
+    @property
+    def identity(self) -> int:
+        """Non-zero id of the current clusters (changes with retraining and partial_fit)"""
+        key = (self.method, self.trained_for, self.revision, self.n_clusters)
+        return zlib.crc32(repr(key).encode('utf-8')) | 1
+    
+    @property
+    def n_clusters(self) -> int:
+        return int(self.model.n_clusters)
+    
+    def labels_of(self, codes: np.ndarray) -> np.ndarray:
+        """Cluster label of every code (predicts each distinct profile once)"""
+        codes = np.asarray(codes, dtype=np.int64)
+        labels = self._labels[codes]
+        
+        missing = labels < 0
+        if missing.any():
+            unknown = np.unique(codes[missing])
+            self._labels[unknown] = self._predict(unknown)
+            labels = self._labels[codes]
+        
+        return labels
+    
+    def label_of(self, code: int) -> int:
+        return int(self.labels_of([code])[0])
+    
+    def _predict(self, codes: np.ndarray) -> np.ndarray:
+        return self.model.predict(unpack_features(codes))
+    
+    def partial_fit(self, codes: np.ndarray):
+        """Move centers towards new/changed profiles, then drop cached labels"""
+        self.model.partial_fit(unpack_features(np.asarray(codes)))
+        self.revision += 1
+        self._labels[:] = -1
+    
+    def partial_fitted(self, codes: np.ndarray) -> 'ProfileClusterModel':
+        """partial_fit on a copy (the current model keeps serving queries meanwhile)"""
+        updated = copy.copy(self)
+        updated.model = copy.deepcopy(self.model)
+        updated._labels = self._labels.copy()
+        updated.partial_fit(codes)
+        return updated
+
+
+class ProfileMedoidModel(ProfileClusterModel):
+    """Gower k-medoids (model = packed medoid codes), labels by nearest medoid"""
+    
+    method = 'kmedoids'
+    
+    @property
+    def n_clusters(self) -> int:
+        return len(self.model)
+    
+    def _predict(self, codes: np.ndarray) -> np.ndarray:
+        return assign_to_medoids(codes, self.model)[0]
+    
+    def partial_fit(self, codes: np.ndarray):
+        """No-op: new profiles go to their nearest medoid, medoids are re-selected per snapshot build"""
+    
+    def partial_fitted(self, codes: np.ndarray) -> 'ProfileMedoidModel':
+        return self
+
+
+class ClusterIndex:
+    """
+    Owns the current ProfileClusterModel
+    
+    - get(): model for queries; schedules (re)training in the background when
+      the snapshot content changed, returns the previous model meanwhile (or None)
+    - observe(): buffer upserted codes; once a batch is full, partial_fit a
+      copy of the model in a worker thread and swap it in (one update at a
+      time, never blocking the event loop)
+    - A failed training is kept in `last_error` and retried after a backoff,
+      not on every request
+    """
+    
+    def __init__(self, path: Optional[str] = CLUSTER_MODEL_PATH, partial_fit_batch: int = CLUSTER_PARTIAL_FIT_BATCH,
+                 method: str = CLUSTER_METHOD):
+        if method not in ('kmeans', 'kmedoids'):
+            raise ValueError(f"Unknown clustering method: {method}")
+        
+        self.path = path
+        self.method = method
+        self.partial_fit_batch = partial_fit_batch
+        self.model: Optional[ProfileClusterModel] = None
+        self._loaded = False
+        self._skipped_for: Optional[str] = None
+        self._pending: List[int] = []
+        self._task: Optional[asyncio.Task] = None
+        self._update_task: Optional[asyncio.Task] = None
+        self.last_error: Optional[str] = None
+        self._failures = 0
+        self._retry_at = 0.0
+    
+    def load(self):
+        """Load the persisted model (if any)"""
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        
+        try:
+            import joblib
+            model = joblib.load(self.path)
+        except Exception as e:
+            print(f"⚠️ [Cluster] Could not load {self.path}: {e}")
+            return
+        
+        if model.method != self.method:
+            print(f"⚠️ [Cluster] Ignoring persisted {model.method} model (method is {self.method})")
+            return
+        
+        self.model = model
+        print(f"✅ [Cluster] Loaded {model.method} model ({model.n_clusters} clusters) from {self.path}")
+    
+    def save(self):
+        if self.path and self.model is not None:
+            import joblib
+            joblib.dump(self.model, self.path)
+    
+    def get(self, snapshot, n_clusters: int) -> Optional[ProfileClusterModel]:
+        if not self._loaded:
+            self.load()
+        
+        content = snapshot.content_version
+        stale = self.model is None or self.model.trained_for != content
+        if stale and self._skipped_for != content and time.monotonic() >= self._retry_at:
+            self._schedule_training(snapshot, n_clusters)
+        
+        return self.model
+    
+    def stats(self) -> dict:
+        """Current model + last training failure (for /)"""
+        return {
+            "method": self.method,
+            "n_clusters": self.model.n_clusters if self.model is not None else None,
+            "trained_for": self.model.trained_for if self.model is not None else None,
+            "last_error": self.last_error,
+            "retry_in_seconds": round(max(0.0, self._retry_at - time.monotonic()), 1),
+        }
+    
+    def _schedule_training(self, snapshot, n_clusters: int):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.train(snapshot, n_clusters))
+    
+    async def train(self, snapshot, n_clusters: int) -> Optional[ProfileClusterModel]:
+        """Fit on the snapshot's profiles in a worker thread and persist"""
+        codes = snapshot.codes.copy()
+        if self.method == 'kmedoids':
+            fit, model_class = kmedoids_clustering_for_gower, ProfileMedoidModel
+        else:
+            fit, model_class = fit_profile_kmeans, ProfileClusterModel
+        
+        try:
+            fitted = await asyncio.to_thread(fit, codes, n_clusters)
+        except Exception as e:
+            self._training_failed(e)
+            return self.model
+        
+        self.last_error, self._failures, self._retry_at = None, 0, 0.0
+        if fitted is None:
+            print(f"⚠️ [Cluster] Too few distinct profiles, clustering skipped")
+            self._skipped_for = snapshot.content_version
+            return self.model
+        
+        self.model = model_class(fitted, snapshot.content_version)
+        self._pending = []
+        print(f"✅ [Cluster] Trained {self.model.n_clusters} {self.method} clusters on snapshot v{snapshot.version}")
+        
+        try:
+            await asyncio.to_thread(self.save)
+        except Exception as e:
+            print(f"⚠️ [Cluster] Could not save {self.path}: {e}")
+        
+        return self.model
+    
+    def _training_failed(self, error: Exception):
+        """Keep the error and back off (doubling per consecutive failure)"""
+        self.last_error = f"{type(error).__name__}: {error}"
+        self._failures += 1
+        delay = min(CLUSTER_RETRY_SECONDS * 2 ** (self._failures - 1), CLUSTER_RETRY_MAX_SECONDS)
+        self._retry_at = time.monotonic() + delay
+        print(f"❌ [Cluster] Training failed ({self.last_error}), retrying in {delay:.0f}s")
+    
+    async def observe(self, code: int):
+        """Record an upserted profile; partial_fit every partial_fit_batch changes (in the background)"""
+        if self.model is None:
+            return
+        
+        self._pending.append(int(code))
+        if len(self._pending) >= self.partial_fit_batch and (self._update_task is None or self._update_task.done()):
+            self._update_task = asyncio.create_task(self._apply_pending())
+    
+    async def _apply_pending(self):
+        """partial_fit full batches into a copy of the model off the event loop, then swap it in and persist"""
+        while self.model is not None and len(self._pending) >= self.partial_fit_batch:
+            model, codes, self._pending = self.model, np.array(self._pending), []
+            try:
+                updated = await asyncio.to_thread(model.partial_fitted, codes)
+            except Exception as e:
+                print(f"⚠️ [Cluster] partial_fit failed: {e}")
+                return
+            
+            if self.model is not model:     # retrained meanwhile, on data that includes these users
+                return
+            self.model = updated
+            
+            try:
+                await asyncio.to_thread(self.save)
+            except Exception as e:
+                print(f"⚠️ [Cluster] Could not save {self.path}: {e}")
@@ -0,0 +1,211 @@
+# app/filters.py - CANDIDATE FILTERS
+
+"""
+Hard constraints on /match candidates, applied before any distance is computed
+- Expression: comma-separated clauses, all of which must hold, e.g.
+  `grade_within=1,min_common_days=2,times=evening,same_school`
+- Profile clauses (grade / days / times) are bitmask tests on the packed
+  codes: one vectorized op over the distinct profiles (bucket codes) of the
+  candidate set, never a per-student loop
+- same_school starts from the partition's school groups (school → partition
+  positions, kept in place by the snapshot, see UserSnapshot.school_positions):
+  only the students of that school are grouped into buckets, the rest of the
+  subject is never touched
+- apply_filter() reports the candidate count after every clause
+"""
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from .gower_matching import (
+    ProfileBuckets,
+    build_profile_buckets,
+    bucket_members,
+    select_buckets,
+    POPCOUNT_TABLE,
+    GRADE_SHIFT,
+    DAYS_SHIFT,
+    DAYS_MASK,
+    TIMES_MASK,
+    DAYS,
+    TIMES,
+    GRADES,
+)
+from .user_encoder import DAY_MAP, TIME_MAP
+
+# Clause name → (value type, allowed values) - None = flag without a value
+FILTER_CLAUSES = {
+    'grade_within': (int, range(len(GRADES))),
+    'min_common_days': (int, range(1, len(DAYS) + 1)),
+    'min_common_times': (int, range(1, len(TIMES) + 1)),
+    'days': (str, DAYS),
+    'times': (str, TIMES),
+    'same_school': None,
+}
+
+
+class FilterClause(NamedTuple):
+    """One parsed clause: name, normalized value (None for flags), canonical text"""
+    name: str
+    value: object
+    text: str
+
+
+class CandidateFilter(NamedTuple):
+    """Parsed filter expression (clauses in the order they are applied)"""
+    clauses: Tuple[FilterClause, ...]
+    
+    @property
+    def needs_school(self) -> bool:
+        return any(clause.name == 'same_school' for clause in self.clauses)
+    
+    @property
+    def key(self) -> Tuple[str, ...]:
+        """Canonical form (cache keys / cursors)"""
+        return tuple(clause.text for clause in self.clauses)
+
+
+def _parse_value(name: str, raw: str):
+    value_type, allowed = FILTER_CLAUSES[name]
+    if value_type is int:
+        if not raw.isdigit():
+            raise ValueError(f"{name} needs an integer, got {raw!r}")
+        value = int(raw)
+    else:
+        value = (DAY_MAP if name == 'days' else TIME_MAP).get(raw, raw.lower())
+    
+    if value not in allowed:
+        raise ValueError(f"{name} must be one of {list(allowed)}, got {raw!r}")
+    return value
+
+
+def parse_filter(expression: str) -> CandidateFilter:
+    """
+    Parse a filter expression
+    
+    Args:
+        expression: `clause[,clause...]`, each `name=value` or a flag
+                    (see FILTER_CLAUSES); days / times accept codes or
+                    display names
+    
+    Returns:
+        CandidateFilter
+    
+    Raises:
+        ValueError: unknown clause, missing / invalid value, empty expression
+    """
+    clauses = []
+    for item in expression.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        
+        name, has_value, raw = (part.strip() for part in item.partition('='))
+        if name not in FILTER_CLAUSES:
+            raise ValueError(f"Unknown filter {name!r} (known: {', '.join(FILTER_CLAUSES)})")
+        
+        if FILTER_CLAUSES[name] is None:
+            if has_value:
+                raise ValueError(f"{name} takes no value")
+            clauses.append(FilterClause(name, None, name))
+            continue
+        
+        if not raw:
+            raise ValueError(f"{name} needs a value ({name}=...)")
+        value = _parse_value(name, raw)
+        clauses.append(FilterClause(name, value, f"{name}={value}"))
+    
+    if not clauses:
+        raise ValueError("Empty filter expression")
+    return CandidateFilter(tuple(clauses))
+
+
+def profile_clause_mask(clause: FilterClause, codes: np.ndarray, query_code: int) -> np.ndarray:
+    """
+    Bitmask test of one profile clause on packed codes
+    
+    Args:
+        clause: any clause except same_school
+        codes: (B,) packed codes (e.g. the bucket codes of a candidate set)
+        query_code: packed code of the query (for relative clauses)
+    
+    Returns:
+        (B,) boolean mask
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    query_code = int(query_code)
+    
+    if clause.name == 'grade_within':
+        query_grade = (query_code >> GRADE_SHIFT) & 0b11
+        return np.abs(((codes >> GRADE_SHIFT) & 0b11) - query_grade) <= clause.value
+    
+    if clause.name == 'min_common_days':
+        query_days = (query_code >> DAYS_SHIFT) & DAYS_MASK
+        return POPCOUNT_TABLE[(codes >> DAYS_SHIFT) & query_days] >= clause.value
+    
+    if clause.name == 'min_common_times':
+        return POPCOUNT_TABLE[codes & query_code & TIMES_MASK] >= clause.value
+    
+    if clause.name == 'days':
+        return (codes >> DAYS_SHIFT) & (1 << DAYS.index(clause.value)) != 0
+    
+    if clause.name == 'times':
+        return codes & (1 << TIMES.index(clause.value)) != 0
+    
+    raise ValueError(f"{clause.name} is not a profile clause")
+
+
+def _school_buckets(buckets: ProfileBuckets, school_positions: np.ndarray, position_codes: np.ndarray) -> ProfileBuckets:
+    """Buckets of the candidates at one school (school_positions: ascending partition positions)"""
+    if buckets.size != len(position_codes):
+        # Candidate subset (e.g. one cluster): keep its students only
+        school_positions = school_positions[np.isin(school_positions, bucket_members(buckets))]
+    
+    local = build_profile_buckets(position_codes[school_positions])
+    return ProfileBuckets(local.codes, local.starts, local.sizes, school_positions[local.members])
+
+
+def apply_filter(
+    candidate_filter: CandidateFilter,
+    buckets: ProfileBuckets,
+    query_code: int,
+    school_positions: Optional[np.ndarray] = None,
+    position_codes: Optional[np.ndarray] = None,
+) -> Tuple[ProfileBuckets, List[Dict]]:
+    """
+    Restrict a candidate set to the students passing every clause
+    
+    Profile clauses narrow a mask over the buckets, so the count after each
+    one is a masked sum of bucket sizes. same_school swaps the candidate set
+    for the (much smaller) bucketed students of the query's school and
+    re-applies the profile clauses seen so far to it.
+    
+    Args:
+        candidate_filter: parsed filter
+        buckets: candidate ProfileBuckets (members = partition positions)
+        query_code: packed code of the query
+        school_positions: partition positions at the query's school
+        position_codes: packed code of every partition position
+                        (both required when the filter has same_school)
+    
+    Returns:
+        (filtered buckets, [{"filter": clause text, "candidates": n}, ...])
+    """
+    bucket_mask = np.ones(len(buckets.codes), dtype=bool)
+    applied = []
+    counts = []
+    
+    for clause in candidate_filter.clauses:
+        if clause.name == 'same_school':
+            buckets = _school_buckets(buckets, school_positions, position_codes)
+            bucket_mask = np.ones(len(buckets.codes), dtype=bool)
+            for previous in applied:
+                bucket_mask &= profile_clause_mask(previous, buckets.codes, query_code)
+        else:
+            applied.append(clause)
+            bucket_mask &= profile_clause_mask(clause, buckets.codes, query_code)
+        
+        counts.append({'filter': clause.text, 'candidates': int(buckets.sizes[bucket_mask].sum())})
+    
+    return select_buckets(buckets, bucket_mask), counts
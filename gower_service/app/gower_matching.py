@@ -4,12 +4,16 @@
 Gower Distance Matching for Mixed Data Types
 - Handles: Categorical (Subject), Ordinal (Grade), Binary Sets (Days, Times)
 - Survey-based weights: Subject 34%, Grade 35%, Days 20%, Times 10%
+  (per-request weightings / WEIGHT_PROFILES re-weight the same components)
 - Gower (1971) - Standard method for heterogeneous data
 """
 
 import numpy as np
-from typing import Dict, List, Tuple
-from sklearn.cluster import KMeans
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    # sklearn is imported lazily (clustering only), keeping service startup fast
+    from sklearn.cluster import KMeans, MiniBatchKMeans
 
 # ===== SURVEY-BASED FEATURE WEIGHTS (128 Students, Survey-based) =====
 FEATURE_WEIGHTS = {
@@ -19,12 +23,37 @@ FEATURE_WEIGHTS = {
     'times': 0.10       # 10% - Flexible timing
 }
 
+# Gower components, in the order they are summed (and returned by component_distances_packed)
+WEIGHT_COMPONENTS = ('subject', 'grade', 'days', 'times')
+
+# Named weightings a request can pick (weight_profile); 'survey' = FEATURE_WEIGHTS
+WEIGHT_PROFILES = {
+    'survey': FEATURE_WEIGHTS,
+    'schedule_first': {'subject': 0.25, 'grade': 0.15, 'days': 0.35, 'times': 0.25},
+    'same_grade': {'subject': 0.25, 'grade': 0.50, 'days': 0.15, 'times': 0.10},
+    'equal': {'subject': 0.25, 'grade': 0.25, 'days': 0.25, 'times': 0.25},
+}
+
 # Feature dimensions
 SUBJECTS = ['math', 'physics', 'chemistry', 'biology', 'english', 'computer']
 DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
 TIMES = ['morning', 'afternoon', 'evening', 'night']
 GRADES = [10, 11, 12]  # Ordinal
 
+# ===== PACKED PROFILE LAYOUT (16 bits per student) =====
+# bits 13-15: subject index in SUBJECTS (SUBJECT_UNKNOWN = no known subject)
+# bits 11-12: grade code (0=Grade10, 1=Grade11, 2=Grade12)
+# bits  4-10: days mask (bit i = DAYS[i])
+# bits  0-3:  times mask (bit i = TIMES[i])
+PACKED_DTYPE = np.uint16
+SUBJECT_SHIFT = 13
+GRADE_SHIFT = 11
+DAYS_SHIFT = 4
+DAYS_MASK = (1 << len(DAYS)) - 1
+TIMES_MASK = (1 << len(TIMES)) - 1
+SUBJECT_UNKNOWN = 7
+SUBJECT_INDEX = {s: i for i, s in enumerate(SUBJECTS)}
+
 
 def encode_features_for_gower(profile: Dict) -> np.ndarray:
     """
@@ -76,10 +105,13 @@ def gower_distance_manual(x1: np.ndarray, x2: np.ndarray) -> float:
     
     Args:
         x1, x2: Feature vectors from encode_features_for_gower()
+                or packed codes from encode_profile_packed()
     
     Returns:
         float: Gower distance in [0, 1], where 0 = identical, 1 = completely different
     """
+    x1, x2 = _as_feature_vector(x1), _as_feature_vector(x2)
+    
     # Feature slicing
     subject1, subject2 = x1[:6], x2[:6]
     grade1, grade2 = x1[6], x2[6]
@@ -138,10 +170,36 @@ def binary_jaccard_distance(vec1: np.ndarray, vec2: np.ndarray) -> float:
     return 1.0 - jaccard_sim
 
 
+def _jaccard_distance_batch(query_bits: np.ndarray, candidate_bits: np.ndarray) -> np.ndarray:
+    """
+    Jaccard distance from one binary vector to every row of a binary block
+    
+    Same arithmetic as binary_jaccard_distance(), applied row-wise:
+    integer intersection/union counts, true division, 1.0 for empty unions.
+    
+    Args:
+        query_bits: (B,) binary vector
+        candidate_bits: (N, B) binary block
+    
+    Returns:
+        (N,) array of Jaccard distances
+    """
+    intersection = np.sum(np.logical_and(query_bits, candidate_bits), axis=1)
+    union = np.sum(np.logical_or(query_bits, candidate_bits), axis=1)
+    
+    # Both vectors all zeros → maximum distance (same rule as the scalar version)
+    jaccard_sim = np.divide(intersection, union, out=np.zeros(len(union)), where=union > 0)
+    return np.where(union > 0, 1.0 - jaccard_sim, 1.0)
+
+
 def calculate_gower_distances(query_features: np.ndarray, all_features: np.ndarray) -> np.ndarray:
     """
     Calculate Gower distances from query to all candidates
     
+    Vectorized over the whole (N, 18) block: each component is computed for
+    every candidate in one pass, then combined with the same weights and in
+    the same order as gower_distance_manual(), so results are bit-identical.
+    
     Args:
         query_features: (18,) array for query student
         all_features: (N, 18) array for all students
@@ -149,22 +207,39 @@ def calculate_gower_distances(query_features: np.ndarray, all_features: np.ndarr
     Returns:
         (N,) array of distances
     """
-    n_students = all_features.shape[0]
-    distances = np.zeros(n_students)
+    all_features = np.asarray(all_features, dtype=np.float64).reshape(-1, 18)
+    
+    # 1. Subject distance (categorical - exact match on the one-hot block)
+    same_subject = np.all(all_features[:, :6] == query_features[:6], axis=1)
+    subject_dist = np.where(same_subject, 0.0, 1.0)
     
-    for i in range(n_students):
-        distances[i] = gower_distance_manual(query_features, all_features[i])
+    # 2. Grade distance (ordinal - already normalized)
+    grade_dist = np.abs(query_features[6] - all_features[:, 6])
     
-    return distances
+    # 3-4. Days / Times distance (binary sets - Jaccard-based)
+    days_dist = _jaccard_distance_batch(query_features[7:14], all_features[:, 7:14])
+    times_dist = _jaccard_distance_batch(query_features[14:18], all_features[:, 14:18])
+    
+    return (
+        FEATURE_WEIGHTS['subject'] * subject_dist +
+        FEATURE_WEIGHTS['grade'] * grade_dist +
+        FEATURE_WEIGHTS['days'] * days_dist +
+        FEATURE_WEIGHTS['times'] * times_dist
+    )
 
 
 def get_similarity_breakdown(query_features: np.ndarray, candidate_features: np.ndarray) -> Dict:
     """
     Get detailed similarity breakdown for a single candidate
     
+    Accepts 18-dim feature vectors or packed codes (encode_profile_packed).
+    
     Returns:
         Dict with similarity percentages and overlap counts
     """
+    query_features = _as_feature_vector(query_features)
+    candidate_features = _as_feature_vector(candidate_features)
+    
     # Feature slicing
     subject1, subject2 = query_features[:6], candidate_features[:6]
     grade1, grade2 = query_features[6], candidate_features[6]
@@ -210,12 +285,631 @@ def get_similarity_breakdown(query_features: np.ndarray, candidate_features: np.
     }
 
 
-def kmeans_clustering_for_gower(all_features: np.ndarray, n_clusters: int) -> Tuple[np.ndarray, KMeans]:
+def encode_profile_packed(profile: Dict) -> int:
+    """
+    Encode student profile into a single 16-bit code
+    
+    Same defaulting rules as encode_features_for_gower(), packed as:
+    subject index | grade code | days mask | times mask (see PACKED_DTYPE layout)
+    
+    Args:
+        profile: Dict with tag_subject, grade, tag_study_days, tag_study_times
+    
+    Returns:
+        int: packed profile code
+    """
+    subject = profile.get('tag_subject', 'math').lower()
+    subject_idx = SUBJECT_INDEX.get(subject, SUBJECT_UNKNOWN)
+    
+    grade = int(profile.get('grade', 11))
+    if grade not in GRADES:
+        grade = 11  # Default
+    
+    study_days = profile.get('tag_study_days', [])
+    days_mask = sum(1 << i for i, d in enumerate(DAYS) if d in study_days)
+    
+    study_times = profile.get('tag_study_times', [])
+    times_mask = sum(1 << i for i, t in enumerate(TIMES) if t in study_times)
+    
+    return (
+        (subject_idx << SUBJECT_SHIFT) |
+        ((grade - 10) << GRADE_SHIFT) |
+        (days_mask << DAYS_SHIFT) |
+        times_mask
+    )
+
+
+def pack_features(features: np.ndarray) -> np.ndarray:
+    """
+    Convert 18-dim feature vectors into packed codes
+    
+    Args:
+        features: (18,) or (N, 18) array from encode_features_for_gower()
+    
+    Returns:
+        () or (N,) array of PACKED_DTYPE codes
+    """
+    features = np.asarray(features, dtype=np.float64)
+    block = features.reshape(-1, 18)
+    
+    has_subject = block[:, :6].any(axis=1)
+    subject_idx = np.where(has_subject, np.argmax(block[:, :6], axis=1), SUBJECT_UNKNOWN)
+    grade_code = np.rint(block[:, 6] * 2).astype(np.int64)
+    days_mask = (block[:, 7:14] != 0) @ (1 << np.arange(len(DAYS)))
+    times_mask = (block[:, 14:18] != 0) @ (1 << np.arange(len(TIMES)))
+    
+    codes = (
+        (subject_idx << SUBJECT_SHIFT) |
+        (grade_code << GRADE_SHIFT) |
+        (days_mask << DAYS_SHIFT) |
+        times_mask
+    ).astype(PACKED_DTYPE)
+    
+    return codes.reshape(features.shape[:-1])
+
+
+def unpack_features(codes) -> np.ndarray:
+    """
+    Expand packed codes back into 18-dim feature vectors
+    
+    Args:
+        codes: scalar code or (N,) array of codes
+    
+    Returns:
+        (18,) or (N, 18) float64 array, identical to encode_features_for_gower()
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    flat = codes.reshape(-1)
+    
+    features = np.zeros((len(flat), 18), dtype=np.float64)
+    subject_idx = flat >> SUBJECT_SHIFT
+    known = subject_idx < len(SUBJECTS)
+    features[np.flatnonzero(known), subject_idx[known]] = 1.0
+    features[:, 6] = GRADE_VALUES[(flat >> GRADE_SHIFT) & 0b11]
+    features[:, 7:14] = ((flat[:, None] >> (DAYS_SHIFT + np.arange(len(DAYS)))) & 1)
+    features[:, 14:18] = ((flat[:, None] >> np.arange(len(TIMES))) & 1)
+    
+    return features.reshape(codes.shape + (18,))
+
+
+def _as_feature_vector(x) -> np.ndarray:
+    """Accept either an 18-dim feature vector or a packed code"""
+    if np.ndim(x) == 0:
+        return unpack_features(x)
+    return x
+
+
+def _jaccard_distance_table(n_bits: int) -> np.ndarray:
+    """
+    Precompute Jaccard distances between every pair of n-bit masks
+    
+    Uses popcount on (a & b) and (a | b) with the same integer division and
+    empty-union rule as binary_jaccard_distance().
+    """
+    masks = np.arange(1 << n_bits)
+    popcount = np.array([bin(m).count('1') for m in masks], dtype=np.int64)
+    intersection = popcount[masks[:, None] & masks[None, :]]
+    union = popcount[masks[:, None] | masks[None, :]]
+    
+    jaccard_sim = np.divide(intersection, union, out=np.zeros(union.shape), where=union > 0)
+    return np.where(union > 0, 1.0 - jaccard_sim, 1.0)
+
+
+# Lookup tables for the packed distance engine
+POPCOUNT_TABLE = np.array([bin(m).count('1') for m in range(1 << len(DAYS))], dtype=np.int64)
+GRADE_VALUES = np.array([(g - 10) / 2.0 for g in GRADES])
+DAYS_JACCARD_TABLE = _jaccard_distance_table(len(DAYS))     # (128, 128)
+TIMES_JACCARD_TABLE = _jaccard_distance_table(len(TIMES))   # (16, 16)
+
+
+def calculate_gower_distances_packed(query_code: int, codes: np.ndarray, weights: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """
+    Calculate Gower distances from a packed query to packed candidates
+    
+    Days/Times Jaccard come from the popcount lookup tables, so every
+    component is a table lookup; results are bit-identical to
+    calculate_gower_distances() on the unpacked vectors.
+    
+    Args:
+        query_code: packed code for query student
+        codes: (N,) array of packed codes
+        weights: component → weight (None = FEATURE_WEIGHTS)
+    
+    Returns:
+        (N,) array of distances
+    """
+    return combine_component_distances(component_distances_packed(query_code, codes), weights)
+
+
+def component_distances_packed(query_code: int, codes: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """
+    Unweighted per-component distances from a packed query to packed candidates
+    
+    Keep these to score one candidate set under several weightings: each
+    extra weighting is a 4-term combine_component_distances(), not a new
+    pass over the codes.
+    
+    Args:
+        query_code: packed code for query student
+        codes: (N,) array of packed codes
+    
+    Returns:
+        (subject, grade, days, times) - four (N,) arrays, WEIGHT_COMPONENTS order
+    """
+    query_code = int(query_code)
+    codes = np.asarray(codes)
+    
+    subject_dist = np.where((codes >> SUBJECT_SHIFT) == (query_code >> SUBJECT_SHIFT), 0.0, 1.0)
+    
+    grade_dist = np.abs(
+        GRADE_VALUES[(query_code >> GRADE_SHIFT) & 0b11] - GRADE_VALUES[(codes >> GRADE_SHIFT) & 0b11]
+    )
+    
+    days_dist = DAYS_JACCARD_TABLE[(query_code >> DAYS_SHIFT) & DAYS_MASK][(codes >> DAYS_SHIFT) & DAYS_MASK]
+    times_dist = TIMES_JACCARD_TABLE[query_code & TIMES_MASK][codes & TIMES_MASK]
+    
+    return subject_dist, grade_dist, days_dist, times_dist
+
+
+def combine_component_distances(components: Sequence[np.ndarray], weights: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """
+    Weighted Gower distance from per-component distances
+    
+    Same weights-times-components sum, in the same order, as every other
+    distance function here, so the default weighting stays bit-identical.
+    
+    Args:
+        components: (subject, grade, days, times) distance arrays, e.g. from
+                    component_distances_packed()
+        weights: component → weight (None = FEATURE_WEIGHTS)
+    
+    Returns:
+        (...) array of distances
+    """
+    weights = FEATURE_WEIGHTS if weights is None else weights
+    return (
+        weights['subject'] * components[0] +
+        weights['grade'] * components[1] +
+        weights['days'] * components[2] +
+        weights['times'] * components[3]
+    )
+
+
+def validate_weights(weights: Dict[str, float]) -> Dict[str, float]:
+    """
+    Check a per-request weighting
+    
+    Every component needs a finite, non-negative weight; the weights must sum
+    to more than 0 and at most 1, so distances stay in [0, 1] (they are not
+    rescaled: FEATURE_WEIGHTS itself sums to 0.99).
+    
+    Args:
+        weights: component → weight
+    
+    Returns:
+        Dict with exactly the WEIGHT_COMPONENTS keys, as floats
+    
+    Raises:
+        ValueError: missing / unknown component or invalid weight
+    """
+    unknown = sorted(set(weights) - set(WEIGHT_COMPONENTS))
+    missing = [name for name in WEIGHT_COMPONENTS if name not in weights]
+    if unknown or missing:
+        raise ValueError(f"Weights need exactly {list(WEIGHT_COMPONENTS)} (unknown: {unknown}, missing: {missing})")
+    
+    checked = {name: float(weights[name]) for name in WEIGHT_COMPONENTS}
+    if not all(np.isfinite(w) and w >= 0 for w in checked.values()):
+        raise ValueError(f"Weights must be finite and non-negative: {checked}")
+    
+    total = sum(checked.values())
+    if not 0 < total <= 1 + 1e-9:
+        raise ValueError(f"Weights must sum to more than 0 and at most 1 (got {total:g})")
+    
+    return checked
+
+
+def calculate_gower_distance_matrix_packed(query_codes: np.ndarray, codes: np.ndarray, weights: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """
+    Calculate the (M, N) Gower distance matrix between packed queries and candidates
+    
+    Row i equals calculate_gower_distances_packed(query_codes[i], codes, weights).
+    
+    Args:
+        query_codes: (M,) array of packed query codes
+        codes: (N,) array of packed candidate codes
+        weights: component → weight (None = FEATURE_WEIGHTS)
+    
+    Returns:
+        (M, N) array of distances
+    """
+    q = np.asarray(query_codes, dtype=np.int64)[:, None]
+    c = np.asarray(codes, dtype=np.int64)[None, :]
+    
+    subject_dist = np.where((c >> SUBJECT_SHIFT) == (q >> SUBJECT_SHIFT), 0.0, 1.0)
+    grade_dist = np.abs(GRADE_VALUES[(q >> GRADE_SHIFT) & 0b11] - GRADE_VALUES[(c >> GRADE_SHIFT) & 0b11])
+    days_dist = DAYS_JACCARD_TABLE[(q >> DAYS_SHIFT) & DAYS_MASK, (c >> DAYS_SHIFT) & DAYS_MASK]
+    times_dist = TIMES_JACCARD_TABLE[q & TIMES_MASK, c & TIMES_MASK]
+    
+    return combine_component_distances((subject_dist, grade_dist, days_dist, times_dist), weights)
+
+
+def get_similarity_breakdown_batch(query_features, candidate_features, gower_distances: Optional[np.ndarray] = None,
+                                   weights: Optional[Dict[str, float]] = None) -> Dict[str, np.ndarray]:
+    """
+    Similarity breakdown for many candidates at once
+    
+    Same fields and values as get_similarity_breakdown(), as arrays over the
+    candidates. Overlap counts come from popcount tables on the packed masks.
+    
+    Args:
+        query_features: (18,) feature vector or packed code
+        candidate_features: (k, 18) feature block or (k,) packed codes
+        gower_distances: (k,) distances already computed during ranking
+                         (reused instead of recomputed)
+        weights: component → weight used when gower_distances is None
+                 (None = FEATURE_WEIGHTS)
+    
+    Returns:
+        Dict of (k,) arrays (grade_query is a scalar)
+    """
+    query_code = int(pack_features(query_features)) if np.ndim(query_features) == 1 else int(query_features)
+    codes = np.asarray(candidate_features)
+    codes = pack_features(codes) if codes.ndim == 2 else codes
+    codes = codes.astype(np.int64)
+    
+    # Subject match
+    subject_match = (codes >> SUBJECT_SHIFT) == (query_code >> SUBJECT_SHIFT)
+    
+    # Grade similarity (convert distance to similarity)
+    grade1 = GRADE_VALUES[(query_code >> GRADE_SHIFT) & 0b11]
+    grade2 = GRADE_VALUES[(codes >> GRADE_SHIFT) & 0b11]
+    grade_similarity = 1.0 - np.abs(grade1 - grade2)
+    
+    # Days / Times Jaccard (0.0 when both are empty)
+    query_days, days = (query_code >> DAYS_SHIFT) & DAYS_MASK, (codes >> DAYS_SHIFT) & DAYS_MASK
+    days_intersection = POPCOUNT_TABLE[query_days & days]
+    days_union = POPCOUNT_TABLE[query_days | days]
+    days_jaccard = np.divide(days_intersection, days_union, out=np.zeros(len(codes)), where=days_union > 0)
+    
+    query_times, times = query_code & TIMES_MASK, codes & TIMES_MASK
+    times_intersection = POPCOUNT_TABLE[query_times & times]
+    times_union = POPCOUNT_TABLE[query_times | times]
+    times_jaccard = np.divide(times_intersection, times_union, out=np.zeros(len(codes)), where=times_union > 0)
+    
+    # Overall Gower distance & similarity
+    if gower_distances is None:
+        gower_distances = calculate_gower_distances_packed(query_code, codes, weights)
+    gower_distances = np.asarray(gower_distances, dtype=np.float64)
+    
+    return {
+        'subject_match': subject_match,
+        'grade_similarity': grade_similarity,
+        'grade_query': int(round(grade1 * 2 + 10)),
+        'grade_candidate': np.rint(grade2 * 2 + 10).astype(np.int64),
+        'days_similarity': days_jaccard,
+        'days_overlap_count': days_intersection,
+        'times_similarity': times_jaccard,
+        'times_overlap_count': times_intersection,
+        'gower_distance': gower_distances,
+        'overall_similarity': 1.0 - gower_distances
+    }
+
+
+class ProfileBuckets(NamedTuple):
+    """
+    Students grouped by identical packed profile (CSR layout, gaps allowed)
+    
+    Members of bucket b are members[starts[b]:starts[b] + sizes[b]]; codes[b]
+    is the shared profile code. build_profile_buckets() packs the buckets back
+    to back in ascending row order (ordered=True). Buckets maintained in place
+    (snapshot.PositionGroups) leave free slots between buckets and keep their
+    members in arbitrary order, so rankings never rely on either.
+    """
+    codes: np.ndarray
+    starts: np.ndarray
+    sizes: np.ndarray
+    members: np.ndarray
+    ordered: bool = True
+    
+    @property
+    def size(self) -> int:
+        """Number of students in all buckets"""
+        return int(self.sizes.sum())
+
+
+def build_profile_buckets(codes: np.ndarray) -> ProfileBuckets:
+    """
+    Group students into equivalence classes by packed profile code
+    
+    The feature space is finite (6 subjects × 3 grades × 128 day sets × 16
+    time sets), so a large population collapses into a few thousand buckets.
+    
+    Args:
+        codes: (N,) array of packed codes
+    
+    Returns:
+        ProfileBuckets over row indices 0..N-1
+    """
+    codes = np.asarray(codes)
+    members = np.argsort(codes, kind='stable')
+    bucket_codes, starts, sizes = np.unique(codes[members], return_index=True, return_counts=True)
+    
+    return ProfileBuckets(bucket_codes, starts.astype(np.int64), sizes.astype(np.int64), members)
+
+
+def rank_profile_buckets(query_code: int, buckets: ProfileBuckets, k: Optional[int] = None,
+                         weights: Optional[Dict[str, float]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rank bucketed students by Gower distance to the query
+    
+    Distances are computed once per profile class (component lookup tables),
+    then only the closest buckets are expanded into their members. Ties are
+    broken by row index, so the order equals a stable sort of per-student
+    distances.
+    
+    Args:
+        query_code: packed code for query student
+        buckets: ProfileBuckets from build_profile_buckets()
+        k: Number of results (None = all students)
+        weights: component → weight (None = FEATURE_WEIGHTS)
+    
+    Returns:
+        (rows, distances) sorted by (distance, row)
+    """
+    bucket_dist = calculate_gower_distances_packed(query_code, buckets.codes, weights)
+    return _expand_buckets(bucket_dist, buckets, k)
+
+
+def rank_profile_buckets_weightings(
+    query_code: int,
+    buckets: ProfileBuckets,
+    weightings: List[Optional[Dict[str, float]]],
+    k: Optional[int] = None,
+    components: Optional[Tuple[np.ndarray, ...]] = None,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Rank one candidate set under several weightings (e.g. A/B arms)
+    
+    The per-component bucket distances are computed once (or passed in,
+    e.g. cached per query profile); each weighting only adds a 4-term
+    combine over the buckets and its own expansion.
+    
+    Args:
+        query_code: packed code for query student
+        buckets: ProfileBuckets from build_profile_buckets()
+        weightings: component → weight dicts (None = FEATURE_WEIGHTS)
+        k: Number of results per weighting (None = all students)
+        components: component_distances_packed(query_code, buckets.codes)
+            if already known
+    
+    Returns:
+        One (rows, distances) pair per weighting, each equal to
+        rank_profile_buckets(query_code, buckets, k, weights)
+    """
+    if components is None:
+        components = component_distances_packed(query_code, buckets.codes)
+    return [_expand_buckets(combine_component_distances(components, weights), buckets, k) for weights in weightings]
+
+
+def select_top_k(distances: np.ndarray, k: int) -> np.ndarray:
+    """
+    Exact top-k indices by (distance, index) without a full sort
+    
+    np.partition finds the k-th smallest distance in O(N); everything closer
+    is kept, and ties at the cutoff are filled in ascending index order. Only
+    the k survivors are sorted, so the cost is O(N + k log k) and the result
+    equals np.argsort(distances, kind='stable')[:k].
+    
+    Args:
+        distances: (N,) array of distances
+        k: Number of indices to return
+    
+    Returns:
+        (min(k, N),) array of indices
+    """
+    n = len(distances)
+    k = min(k, n)
+    
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    
+    if k < n:
+        cutoff = np.partition(distances, k - 1)[k - 1]
+        closer = np.flatnonzero(distances < cutoff)
+        tied = np.flatnonzero(distances == cutoff)[:k - len(closer)]
+        candidates = np.concatenate([closer, tied])
+    else:
+        candidates = np.arange(n)
+    
+    return candidates[np.lexsort((candidates, distances[candidates]))]
+
+
+def _bucket_members(buckets: ProfileBuckets, chosen: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Member rows of the chosen buckets (vectorized CSR gather) + bucket sizes"""
+    sizes = buckets.sizes[chosen]
+    shift = np.repeat(buckets.starts[chosen] - (np.cumsum(sizes) - sizes), sizes)
+    return buckets.members[shift + np.arange(int(sizes.sum()))], sizes
+
+
+def bucket_members(buckets: ProfileBuckets) -> np.ndarray:
+    """Every member row (bucket by bucket, free slots skipped)"""
+    return _bucket_members(buckets, np.arange(len(buckets.codes)))[0]
+
+
+def select_buckets(buckets: ProfileBuckets, mask: np.ndarray) -> ProfileBuckets:
+    """
+    Subset of buckets (e.g. one cluster), members kept in row order
+    
+    Args:
+        buckets: ProfileBuckets
+        mask: (B,) boolean mask over buckets.codes
+    
+    Returns:
+        ProfileBuckets with the selected buckets only
+    """
+    chosen = np.flatnonzero(mask)
+    members, sizes = _bucket_members(buckets, chosen)
+    
+    return ProfileBuckets(buckets.codes[chosen], np.cumsum(sizes) - sizes, sizes, members, buckets.ordered)
+
+
+def _expand_buckets(bucket_dist: np.ndarray, buckets: ProfileBuckets, k: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Expand the closest buckets into (rows, distances) ordered by (distance, row)"""
+    sizes = buckets.sizes
+    total = int(sizes.sum())
+    k = total if k is None else min(k, total)
+    
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    
+    # Closest buckets (k buckets always hold >= k students); the cutoff is the
+    # distance at which their cumulative size reaches k
+    nearest = select_top_k(bucket_dist, k)
+    cutoff = bucket_dist[nearest[np.searchsorted(np.cumsum(sizes[nearest]), k)]]
+    
+    # Everyone strictly closer is in the result; ties at the cutoff by row
+    closer = np.flatnonzero(bucket_dist < cutoff)
+    closer_rows, closer_sizes = _bucket_members(buckets, closer)
+    tied_rows, _ = _bucket_members(buckets, np.flatnonzero(bucket_dist == cutoff))
+    
+    need = k - len(closer_rows)
+    if need < len(tied_rows):
+        tied_rows = np.partition(tied_rows, need - 1)[:need]
+    
+    rows = np.concatenate([closer_rows, tied_rows])
+    distances = np.concatenate([np.repeat(bucket_dist[closer], closer_sizes), np.full(len(tied_rows), cutoff)])
+    
+    top = np.lexsort((rows, distances))
+    return rows[top], distances[top]
+
+
+class BucketRanking(NamedTuple):
+    """
+    Complete (distance, row) order of a bucket set, kept at bucket granularity
+    
+    Tie group g (buckets at one distance) covers rank positions
+    [starts[g], starts[g + 1]) and holds the buckets order[first[g]:first[g + 1]].
+    Its members interleave by row, so multi-bucket groups (and unordered
+    buckets) are sorted on first use and kept in `merged`: later pages through
+    them cost O(page size).
+    """
+    buckets: ProfileBuckets
+    order: np.ndarray
+    first: np.ndarray
+    starts: np.ndarray
+    distances: np.ndarray
+    merged: Dict[int, np.ndarray]
+
+
+def rank_bucket_order(query_code: int, buckets: ProfileBuckets, weights: Optional[Dict[str, float]] = None,
+                      components: Optional[Tuple[np.ndarray, ...]] = None) -> BucketRanking:
+    """
+    Full ranking of bucketed students without expanding it (O(B log B))
+    
+    Args:
+        query_code: packed code for query student
+        buckets: ProfileBuckets from build_profile_buckets()
+        weights: component → weight (None = FEATURE_WEIGHTS)
+        components: component_distances_packed(query_code, buckets.codes)
+            if already known (then only re-weighted)
+    
+    Returns:
+        BucketRanking, paged with ranking_page()
+    """
+    if components is None:
+        bucket_dist = calculate_gower_distances_packed(query_code, buckets.codes, weights)
+    else:
+        bucket_dist = combine_component_distances(components, weights)
+    order = np.argsort(bucket_dist, kind='stable')
+    sorted_dist = bucket_dist[order]
+    
+    first = np.flatnonzero(np.concatenate([[len(order) > 0], sorted_dist[1:] != sorted_dist[:-1]]))
+    first = np.append(first, len(order))
+    rank_ends = np.concatenate([[0], np.cumsum(buckets.sizes[order])])
+    
+    return BucketRanking(buckets, order, first, rank_ends[first], sorted_dist[first[:-1]], {})
+
+
+def _tie_group_members(ranking: BucketRanking, group: int) -> np.ndarray:
+    """Member rows of one tie group in row order"""
+    chosen = ranking.order[ranking.first[group]:ranking.first[group + 1]]
+    if len(chosen) == 1 and ranking.buckets.ordered:
+        start = ranking.buckets.starts[chosen[0]]
+        return ranking.buckets.members[start:start + ranking.buckets.sizes[chosen[0]]]
+    
+    members = ranking.merged.get(group)
+    if members is None:
+        members = ranking.merged[group] = np.sort(_bucket_members(ranking.buckets, chosen)[0])
+    return members
+
+
+def ranking_page(ranking: BucketRanking, offset: int, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Ranks [offset, offset + n) of a BucketRanking
+    
+    ranking_page(rank_bucket_order(q, b), 0, k) equals rank_profile_buckets(q, b, k).
+    
+    Returns:
+        (rows, distances) sorted by (distance, row); shorter than n at the end
+    """
+    end = min(offset + n, int(ranking.starts[-1]))
+    if offset >= end:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    
+    rows, distances = [], []
+    group = int(np.searchsorted(ranking.starts, offset, side='right')) - 1
+    while group < len(ranking.distances) and ranking.starts[group] < end:
+        start = int(ranking.starts[group])
+        members = _tie_group_members(ranking, group)[max(offset - start, 0):end - start]
+        rows.append(members)
+        distances.append(np.full(len(members), ranking.distances[group]))
+        group += 1
+    
+    return np.concatenate(rows).astype(np.int64), np.concatenate(distances)
+
+
+def rank_profile_buckets_batch(
+    query_codes: np.ndarray,
+    buckets: ProfileBuckets,
+    k: Optional[int] = None,
+    max_block_bytes: int = 32 * 1024 * 1024,
+    weights: Optional[Dict[str, float]] = None,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Rank bucketed students for many queries at once
+    
+    Identical query profiles are ranked once. The (queries × buckets)
+    distance matrix is computed in row blocks of at most max_block_bytes,
+    so memory stays bounded for any number of queries.
+    
+    Args:
+        query_codes: (M,) array of packed query codes
+        buckets: ProfileBuckets from build_profile_buckets()
+        k: Number of results per query (None = all students)
+        max_block_bytes: Memory budget for one distance block
+        weights: component → weight for every query (None = FEATURE_WEIGHTS)
+    
+    Returns:
+        List of M (rows, distances) pairs, same order as rank_profile_buckets()
+    """
+    unique_codes, inverse = np.unique(np.asarray(query_codes), return_inverse=True)
+    block_rows = max(1, max_block_bytes // (8 * max(1, len(buckets.codes))))
+    
+    ranked = []
+    for start in range(0, len(unique_codes), block_rows):
+        block = calculate_gower_distance_matrix_packed(unique_codes[start:start + block_rows], buckets.codes, weights)
+        ranked.extend(_expand_buckets(row, buckets, k) for row in block)
+    
+    return [ranked[i] for i in inverse.reshape(-1)]
+
+
+def kmeans_clustering_for_gower(all_features: np.ndarray, n_clusters: int) -> Tuple[np.ndarray, 'KMeans']:
     """
     Perform K-Means clustering on all features for initial grouping
     
     Note: K-Means uses Euclidean distance, but this is just for initial grouping.
-    Final ranking uses Gower distance.
+    Final ranking uses Gower distance (see kmedoids_clustering_for_gower for a
+    Gower-consistent alternative).
     
     Args:
         all_features: (N, 18) array
@@ -228,12 +922,172 @@ def kmeans_clustering_for_gower(all_features: np.ndarray, n_clusters: int) -> Tu
         # Too few students for clustering
         return np.zeros(all_features.shape[0], dtype=int), None
     
+    from sklearn.cluster import KMeans
+    
     kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
     cluster_labels = kmeans.fit_predict(all_features)
     
     return cluster_labels, kmeans
 
 
+def fit_profile_kmeans(codes: np.ndarray, n_clusters: int, random_state: int = 42) -> Optional['MiniBatchKMeans']:
+    """
+    Fit K-Means on distinct profiles, weighted by how many students share each
+    
+    Identical profiles have identical feature vectors, so this optimizes the
+    same objective as fitting every student while touching only a few thousand
+    points. MiniBatchKMeans supports partial_fit for incremental updates.
+    
+    Args:
+        codes: (N,) packed codes of all students
+        n_clusters: Number of clusters
+    
+    Returns:
+        Fitted model, or None if there are too few distinct profiles
+    """
+    unique_codes, counts = np.unique(np.asarray(codes), return_counts=True)
+    if len(unique_codes) < 2:
+        return None
+    
+    from sklearn.cluster import MiniBatchKMeans
+    
+    kmeans = MiniBatchKMeans(
+        n_clusters=min(n_clusters, len(unique_codes)),
+        random_state=random_state,
+        n_init=10,
+        batch_size=1024
+    )
+    kmeans.fit(unpack_features(unique_codes), sample_weight=counts)
+    
+    return kmeans
+
+
+def _pam_weighted(dist: np.ndarray, weights: np.ndarray, k: int, max_iter: int = 100) -> np.ndarray:
+    """
+    Weighted PAM (BUILD + SWAP) on a precomputed distance matrix
+    
+    Args:
+        dist: (s, s) symmetric distance matrix
+        weights: (s,) point weights (students sharing the profile)
+        k: Number of medoids
+        max_iter: Maximum number of SWAP steps
+    
+    Returns:
+        (k,) indices of the medoids into dist
+    """
+    # BUILD: greedy medoids, each one removing the most weighted distance
+    medoids = [int(np.argmin(dist @ weights))]
+    nearest = dist[medoids[0]].copy()
+    for _ in range(1, k):
+        gain = np.maximum(nearest[None, :] - dist, 0.0) @ weights
+        gain[medoids] = -1.0
+        medoids.append(int(np.argmax(gain)))
+        nearest = np.minimum(nearest, dist[medoids[-1]])
+    medoids = np.array(medoids)
+    
+    # SWAP: best (medoid, non-medoid) exchange until no improvement
+    columns = np.arange(dist.shape[0])
+    for _ in range(max_iter):
+        medoid_dist = dist[medoids]                         # (k, s)
+        order = np.argsort(medoid_dist, axis=0)
+        first = medoid_dist[order[0], columns]
+        second = medoid_dist[order[1], columns] if k > 1 else np.full(len(columns), np.inf)
+        
+        best_cost, best_swap = float(first @ weights), None
+        for i in range(k):
+            # Cost of replacing medoid i by every candidate h at once
+            without_i = np.where(order[0] == i, second, first)
+            costs = np.minimum(dist, without_i[None, :]) @ weights
+            costs[medoids] = np.inf
+            h = int(np.argmin(costs))
+            if costs[h] < best_cost - 1e-12:
+                best_cost, best_swap = float(costs[h]), (i, h)
+        
+        if best_swap is None:
+            break
+        medoids[best_swap[0]] = best_swap[1]
+    
+    return medoids
+
+
+def assign_to_medoids(codes: np.ndarray, medoids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Nearest-medoid lookup under the weighted Gower distance
+    
+    Args:
+        codes: (N,) packed codes
+        medoids: (k,) packed medoid codes
+    
+    Returns:
+        (labels, distances) - index of the nearest medoid and the distance to it
+    """
+    unique_codes, inverse = np.unique(np.asarray(codes), return_inverse=True)
+    dist = calculate_gower_distance_matrix_packed(medoids, unique_codes)     # (k, U)
+    labels = np.argmin(dist, axis=0)
+    
+    return labels[inverse], dist[labels, np.arange(len(unique_codes))][inverse]
+
+
+def kmedoids_clustering_for_gower(
+    codes: np.ndarray,
+    n_clusters: int,
+    n_samples: int = 5,
+    sample_size: Optional[int] = None,
+    max_iter: int = 100,
+    random_state: int = 42
+) -> Optional[np.ndarray]:
+    """
+    Gower-native k-medoids (CLARA): PAM on samples of the distinct profiles
+    
+    Unlike K-Means, clusters use the same weighted Gower distance as the final
+    ranking. Each sample of distinct profiles (drawn proportionally to how many
+    students share them, best medoids so far always included) is clustered with
+    weighted PAM; the medoid set with the lowest total cost over all students
+    wins. Cost per sample is O(sample_size²), so it scales past 100k users.
+    
+    Args:
+        codes: (N,) packed codes of all students
+        n_clusters: Number of medoids
+        n_samples: Number of CLARA samples
+        sample_size: Distinct profiles per sample (default 40 + 2k); PAM runs on
+                     all distinct profiles when there are fewer
+        max_iter: Maximum PAM SWAP steps per sample
+        random_state: Seed for sampling
+    
+    Returns:
+        (k,) packed medoid codes, or None if there are too few distinct profiles
+    """
+    unique_codes, counts = np.unique(np.asarray(codes), return_counts=True)
+    if len(unique_codes) < 2:
+        return None
+    
+    k = min(n_clusters, len(unique_codes))
+    sample_size = min(len(unique_codes), max(sample_size or 40 + 2 * k, k))
+    if sample_size == len(unique_codes):
+        n_samples = 1
+    
+    rng = np.random.default_rng(random_state)
+    probabilities = counts / counts.sum()
+    best_idx, best_cost = np.empty(0, dtype=np.int64), np.inf
+    
+    for _ in range(n_samples):
+        if sample_size == len(unique_codes):
+            idx = np.arange(len(unique_codes))
+        else:
+            drawn = rng.choice(len(unique_codes), size=sample_size, replace=False, p=probabilities)
+            idx = np.unique(np.concatenate([best_idx, drawn]))
+        
+        sample = unique_codes[idx]
+        local = _pam_weighted(calculate_gower_distance_matrix_packed(sample, sample), counts[idx], k, max_iter)
+        
+        # Total cost over every student (distinct profiles weighted by count)
+        cost = float(counts @ calculate_gower_distance_matrix_packed(sample[local], unique_codes).min(axis=0))
+        if cost < best_cost:
+            best_idx, best_cost = idx[local], cost
+    
+    return unique_codes[best_idx]
+
+
 def explain_weights() -> Dict:
     """
     Explain the survey-based weight methodology
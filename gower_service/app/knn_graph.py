@@ -0,0 +1,351 @@
+# app/knn_graph.py - ALL-PAIRS TOP-K NEIGHBOUR GRAPH
+
+"""
+Offline job: every user's top-k partners (same ranking as /match)
+- Candidates: same subject, self included (as on /match, so a graph page and
+  the live ranking it continues into agree), ordered by (Gower distance,
+  position in the subject partition) like /match; users without a known
+  subject get no partners (/match answers 404 for them)
+- Each distinct profile is ranked once against its subject's profile buckets,
+  then the result is expanded to every user sharing that profile
+- Tiles of query buckets run on a ProcessPoolExecutor; bucket arrays and
+  the output adjacency live in shared memory (no pickling of big arrays)
+- Output directory (np.load(..., mmap_mode='r')-able):
+    user_ids.npy   (N,) str        codes.npy      (N,) uint16
+    neighbors.npy  (N, k) int32    distances.npy  (N, k) float32
+    meta.json      k, n_users, snapshot_version, content_version,
+                   subject_versions, created_at
+  Rows with fewer than k candidates are padded with -1 / inf
+- Source: the service's snapshot file (--snapshot, default SNAPSHOT_FILE_PATH
+  or SHARED_SNAPSHOT_DIR/snapshot.bin), whose versions the graph records; or
+  a JSON export / backend fetch, which has no snapshot version (null). /match
+  only serves a subject from the graph while that subject's data version is
+  the recorded one, so a graph without versions is never served
+
+Run: python -m app.knn_graph --out knn_graph --k 20 [--snapshot snapshot.bin | --input users.json] [--workers 8]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .gower_matching import (
+    ProfileBuckets,
+    build_profile_buckets,
+    rank_profile_buckets_batch,
+    FEATURE_WEIGHTS,
+    SUBJECT_SHIFT,
+    SUBJECTS,
+    PACKED_DTYPE
+)
+
+GRAPH_FILES = ('user_ids', 'codes', 'neighbors', 'distances')
+TILE_BUCKETS = 256
+
+# Shared arrays attached by each worker process (name → ndarray)
+_shared: Dict[str, np.ndarray] = {}
+_segments: List[shared_memory.SharedMemory] = []
+
+
+def _bucket_index(codes: np.ndarray, subject_rows: Sequence[np.ndarray]) -> Tuple[Dict[str, np.ndarray], List[Tuple[int, int]]]:
+    """
+    Profile buckets of every subject, concatenated
+    
+    Returns:
+        (arrays, subject_ranges) - bucket_codes / offsets / members
+        (positions in their subject) / rows (each subject's rows by
+        position, at the same offsets as its members) and the [start, end)
+        bucket range of each subject
+    """
+    bucket_codes, offsets, members, all_rows, subject_ranges = [], [np.zeros(1, dtype=np.int64)], [], [], []
+    n_buckets, n_members = 0, 0
+    
+    for rows in subject_rows:
+        if len(rows) == 0:
+            continue
+        rows = np.asarray(rows, dtype=np.int64)
+        buckets = build_profile_buckets(codes[rows])
+        
+        bucket_codes.append(buckets.codes)
+        offsets.append(np.append(buckets.starts[1:], len(rows)) + n_members)
+        members.append(buckets.members)
+        all_rows.append(rows)
+        subject_ranges.append((n_buckets, n_buckets + len(buckets.codes)))
+        n_buckets += len(buckets.codes)
+        n_members += len(rows)
+    
+    arrays = {
+        'bucket_codes': np.concatenate(bucket_codes) if bucket_codes else np.zeros(0, dtype=PACKED_DTYPE),
+        'offsets': np.concatenate(offsets),
+        'members': np.concatenate(members) if members else np.zeros(0, dtype=np.int64),
+        'rows': np.concatenate(all_rows) if all_rows else np.zeros(0, dtype=np.int64),
+    }
+    return arrays, subject_ranges
+
+
+def _subject_buckets(start: int, end: int) -> ProfileBuckets:
+    """ProfileBuckets view of one subject's slice of the shared bucket index"""
+    offsets = _shared['offsets'][start:end + 1]
+    return ProfileBuckets(
+        _shared['bucket_codes'][start:end],
+        offsets[:-1] - offsets[0],
+        np.diff(offsets),
+        _shared['members'][offsets[0]:offsets[-1]]
+    )
+
+
+def _write_neighbors(members: np.ndarray, rows: np.ndarray, distances: np.ndarray):
+    """Top-k of every user in one bucket: the bucket's top-k ranking (self included), padded"""
+    neighbors, out_distances = _shared['neighbors'], _shared['distances']
+    width = len(rows)
+    
+    neighbors[members, :width] = rows
+    out_distances[members, :width] = distances
+    neighbors[members, width:] = -1
+    out_distances[members, width:] = np.inf
+
+
+def _rank_tile(tile: Tuple[int, int, int, int, int, int]) -> int:
+    """
+    Rank query buckets [q_start, q_end) of one subject, write their users' rows
+    
+    Returns:
+        Number of users written
+    """
+    start, end, q_start, q_end, k, max_block_bytes = tile
+    buckets = _subject_buckets(start, end)
+    offsets, members = _shared['offsets'], _shared['members']
+    subject_rows = _shared['rows'][offsets[start]:offsets[end]]
+    
+    ranked = rank_profile_buckets_batch(_shared['bucket_codes'][q_start:q_end], buckets, k=k, max_block_bytes=max_block_bytes)
+    
+    written = 0
+    for bucket, (positions, distances) in zip(range(q_start, q_end), ranked):
+        bucket_members = subject_rows[members[offsets[bucket]:offsets[bucket + 1]]]
+        _write_neighbors(bucket_members, subject_rows[positions], distances)
+        written += len(bucket_members)
+    
+    return written
+
+
+def _attach_shared(specs: Dict[str, Tuple[str, tuple, str]]):
+    """Worker initializer: map the parent's shared memory blocks as arrays"""
+    for name, (segment_name, shape, dtype) in specs.items():
+        segment = shared_memory.SharedMemory(name=segment_name)
+        _segments.append(segment)
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+
+def build_knn_graph(
+    codes: np.ndarray,
+    k: int,
+    workers: Optional[int] = None,
+    tile_buckets: int = TILE_BUCKETS,
+    max_block_bytes: int = 32 * 1024 * 1024,
+    subject_rows: Optional[Sequence[np.ndarray]] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top-k same-subject neighbours of every user (self included, like /match)
+    
+    Row i equals rank_profile_buckets(codes[i], <subject buckets>, k), with
+    the buckets built over the subject's rows in `subject_rows` order (ties
+    are broken by that position, as /match does on SubjectPartition.rows).
+    
+    Args:
+        codes: (N,) packed codes of all users
+        k: Neighbours per user
+        workers: Worker processes (None = os.cpu_count(), 1 = in-process)
+        tile_buckets: Query buckets per tile (unit of work)
+        max_block_bytes: Memory budget for one distance block inside a tile
+        subject_rows: Rows of each SUBJECTS entry in partition order, e.g.
+            [p.rows for p in snapshot.partitions.values()] (None = ascending)
+    
+    Returns:
+        (neighbors, distances) - (N, k) int32 rows, (N, k) float32, padded
+        with -1 / inf where a subject has fewer than k users (all padding
+        for users without a known subject)
+    """
+    codes = np.asarray(codes, dtype=PACKED_DTYPE)
+    if subject_rows is None:
+        subjects = codes.astype(np.int64) >> SUBJECT_SHIFT
+        subject_rows = [np.flatnonzero(subjects == idx) for idx in range(len(SUBJECTS))]
+    arrays, subject_ranges = _bucket_index(codes, subject_rows)
+    arrays['neighbors'] = np.full((len(codes), k), -1, dtype=np.int32)
+    arrays['distances'] = np.full((len(codes), k), np.inf, dtype=np.float32)
+    
+    tiles = [
+        (start, end, q_start, min(q_start + tile_buckets, end), k, max_block_bytes)
+        for start, end in subject_ranges
+        for q_start in range(start, end, tile_buckets)
+    ]
+    workers = workers or os.cpu_count() or 1
+    
+    if workers == 1 or len(tiles) <= 1:
+        _shared.update(arrays)
+        try:
+            for tile in tiles:
+                _rank_tile(tile)
+            return arrays['neighbors'], arrays['distances']
+        finally:
+            _shared.clear()
+    
+    # Shared memory: workers read the bucket index and write their own rows
+    segments, specs, views = [], {}, {}
+    try:
+        for name, array in arrays.items():
+            segment = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            segments.append(segment)
+            views[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+            views[name][...] = array
+            specs[name] = (segment.name, array.shape, array.dtype.str)
+        
+        with ProcessPoolExecutor(max_workers=min(workers, len(tiles)), initializer=_attach_shared, initargs=(specs,)) as pool:
+            written = sum(pool.map(_rank_tile, tiles))
+        if written != len(arrays['rows']):
+            raise RuntimeError(f"Graph covers {written} of {len(arrays['rows'])} users")
+        
+        return views['neighbors'].copy(), views['distances'].copy()
+    finally:
+        views.clear()
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+
+def save_knn_graph(path: str, user_ids, codes: np.ndarray, neighbors: np.ndarray, distances: np.ndarray,
+                   snapshot_version: Optional[int] = None, content_version: Optional[str] = None,
+                   subject_versions: Optional[Dict[str, int]] = None):
+    """
+    Write the graph directory (meta.json last, so readers never see a half-written graph)
+    
+    snapshot_version / content_version / subject_versions (SUBJECTS entry →
+    data_version): the source UserSnapshot's, None when the users did not
+    come from a service snapshot
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        'user_ids': np.asarray([str(user_id) for user_id in user_ids]),
+        'codes': np.asarray(codes, dtype=PACKED_DTYPE),
+        'neighbors': neighbors,
+        'distances': distances,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.tmp.npy"), array)
+        os.replace(os.path.join(path, f"{name}.tmp.npy"), os.path.join(path, f"{name}.npy"))
+    
+    meta = {
+        'k': int(neighbors.shape[1]),
+        'n_users': int(len(codes)),
+        'snapshot_version': None if snapshot_version is None else int(snapshot_version),
+        'content_version': content_version,
+        'subject_versions': None if subject_versions is None else {s: int(v) for s, v in subject_versions.items()},
+        'created_at': time.time(),
+        'weights': FEATURE_WEIGHTS,
+    }
+    with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+
+class KnnGraph:
+    """Memory-mapped neighbour graph written by save_knn_graph()"""
+    
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in GRAPH_FILES}
+        self.user_ids = arrays['user_ids']
+        self.codes = arrays['codes']
+        self.neighbors = arrays['neighbors']
+        self.distances = arrays['distances']
+        self.k = self.meta['k']
+        self.snapshot_version: Optional[int] = self.meta.get('snapshot_version')
+        self.content_version: Optional[str] = self.meta.get('content_version')
+        self.subject_versions: Dict[str, int] = self.meta.get('subject_versions') or {}
+        self.row_of = {user_id: row for row, user_id in enumerate(self.user_ids.tolist())}
+    
+    def is_current(self, subject: str, version: int, content_version: str) -> bool:
+        """Whether the graph was built on this data version of the subject (app.result_cache.data_version)"""
+        return self.subject_versions.get(subject) == version and self.content_version == content_version
+    
+    def neighbors_of(self, user_id: str, code: int, k: int) -> Optional[List[str]]:
+        """
+        Precomputed top-k partner ids of a user
+        
+        Returns:
+            Partner ids in rank order, or None when the graph cannot answer
+            (unknown user, profile changed since the job ran, k too large)
+        """
+        row = self.row_of.get(user_id)
+        if row is None or k > self.k or int(self.codes[row]) != int(code):
+            return None
+        
+        neighbors = self.neighbors[row, :k]
+        return self.user_ids[neighbors[neighbors >= 0]].tolist()
+
+
+def default_snapshot_path() -> Optional[str]:
+    """Where the service saves its snapshot (SNAPSHOT_FILE_PATH, else the shared snapshot file)"""
+    from .shared_snapshot import SHARED_SNAPSHOT_DIR, SNAPSHOT_FILE
+    from .snapshot import SNAPSHOT_FILE_PATH
+    
+    if SNAPSHOT_FILE_PATH:
+        return SNAPSHOT_FILE_PATH
+    return os.path.join(SHARED_SNAPSHOT_DIR, SNAPSHOT_FILE) if SHARED_SNAPSHOT_DIR else None
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Precompute every user's top-k Gower partners")
+    parser.add_argument('--out', required=True, help="Output directory")
+    parser.add_argument('--k', type=int, default=20, help="Partners per user")
+    parser.add_argument('--snapshot', default=default_snapshot_path(),
+                        help="Snapshot file saved by the service (default: SNAPSHOT_FILE_PATH or SHARED_SNAPSHOT_DIR/snapshot.bin)")
+    parser.add_argument('--input', help="JSON file with backend-format users instead of the snapshot file")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--tile-buckets', type=int, default=TILE_BUCKETS, help="Query profiles per tile")
+    args = parser.parse_args(argv)
+    
+    from .main import fetch_users_from_backend
+    from .snapshot import build_user_snapshot
+    from .snapshot_file import load_snapshot_file
+    from .user_encoder import map_backend_to_ml_format, encode_backend_users
+    
+    start = time.perf_counter()
+    if not args.input and args.snapshot and os.path.exists(args.snapshot):
+        snapshot = load_snapshot_file(args.snapshot)
+        snapshot_version = snapshot.version
+        subject_versions = {subject: partition.version for subject, partition in snapshot.partitions.items()}
+        print(f"📂 [kNN] Loaded snapshot v{snapshot_version} ({snapshot.size} users) from {args.snapshot}")
+    else:
+        if args.input:
+            with open(args.input) as f:
+                backend_users = json.load(f)
+        else:
+            backend_users = asyncio.run(fetch_users_from_backend())
+        snapshot = build_user_snapshot(backend_users, map_backend_to_ml_format, version=0, encode_users=encode_backend_users)
+        snapshot_version = subject_versions = None
+        print(f"📊 [kNN] Encoded {snapshot.size} users in {time.perf_counter() - start:.1f}s (no snapshot version)")
+    
+    start = time.perf_counter()
+    neighbors, distances = build_knn_graph(
+        snapshot.codes, args.k, workers=args.workers, tile_buckets=args.tile_buckets,
+        subject_rows=[partition.rows for partition in snapshot.partitions.values()]
+    )
+    print(f"✅ [kNN] Top-{args.k} graph for {snapshot.size} users in {time.perf_counter() - start:.1f}s")
+    
+    save_knn_graph(args.out, snapshot.column('student_id'), snapshot.codes, neighbors, distances,
+                   snapshot_version=snapshot_version, content_version=snapshot.content_version,
+                   subject_versions=subject_versions)
+    print(f"💾 [kNN] Written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,20 +10,41 @@ Gower Distance Matching API (Survey-based Weights)
 """
 
 import numpy as np
-import pandas as pd
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict
+from typing import List, Dict, Optional
+from contextlib import asynccontextmanager
 from . import schemas
+from .snapshot import SnapshotStore, UserSnapshot, normalize_school
+from .user_encoder import map_backend_to_ml_format, encode_backend_users
+from .shared_snapshot import SharedSnapshotStore, SHARED_SNAPSHOT_DIR
+from .clustering import ClusterIndex
+from .knn_graph import KnnGraph
+from .result_cache import ResultCache, data_version
+from .pagination import encode_cursor, decode_cursor, ranking_tag
+from .filters import CandidateFilter, apply_filter, parse_filter
+from .streaming import ndjson_line, chunk_sizes, NDJSON_MEDIA_TYPE
+from . import metrics
+from .metrics import log
 from .gower_matching import (
-    encode_features_for_gower,
-    calculate_gower_distances,
-    get_similarity_breakdown,
-    kmeans_clustering_for_gower,
+    encode_profile_packed,
+    select_buckets,
+    rank_profile_buckets,
+    rank_profile_buckets_batch,
+    rank_profile_buckets_weightings,
+    rank_bucket_order,
+    ranking_page,
+    calculate_gower_distances_packed,
+    component_distances_packed,
+    get_similarity_breakdown_batch,
+    validate_weights,
     FEATURE_WEIGHTS,
+    WEIGHT_PROFILES as BUILTIN_WEIGHT_PROFILES,
     SUBJECTS,
     DAYS,
     TIMES,
+    SUBJECT_SHIFT,
     explain_weights
 )
 
@@ -38,10 +59,18 @@ API Tìm kiếm Bạn học - Gower Distance Matching 🎯
 - Workflow: FETCH → ENCODE → CLUSTER (optional) → GOWER DISTANCE → SORT
 """
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm everything the first /match needs before serving traffic"""
+    if PRELOAD_ON_STARTUP:
+        await warm_up()
+    yield
+
 app = FastAPI(
     title="Study Buddy Matching API - Gower Distance",
     description=API_DESCRIPTION,
-    version="9.0.0"
+    version="9.0.0",
+    lifespan=lifespan
 )
 
 # CORS
@@ -55,10 +84,40 @@ app.add_middleware(
 
 # ===== DATABASE INTEGRATION =====
 import httpx
+import json
 import os
+import time
 
 BACKEND_URL = os.getenv("BACKEND_URL", "http://host.docker.internal:8888")
 
+# Breakdown fields copied into every result record
+BREAKDOWN_FIELDS = (
+    'subject_match', 'grade_similarity', 'days_similarity', 'days_overlap_count',
+    'times_similarity', 'times_overlap_count', 'overall_similarity'
+)
+
+# Result limits / batch memory budget
+MAX_MATCH_RESULTS = 100
+BATCH_BLOCK_BYTES = int(os.getenv("BATCH_BLOCK_BYTES", str(32 * 1024 * 1024)))
+
+# K-Means pre-filtering on /match (persistent model, see app/clustering.py)
+USE_CLUSTERING = os.getenv("USE_CLUSTERING", "false").lower() in ("1", "true", "yes")
+
+# Precomputed top-k graph (python -m app.knn_graph), served by /match for known users;
+# meta.json is re-checked at most every KNN_GRAPH_CHECK_SECONDS
+KNN_GRAPH_DIR = os.getenv("KNN_GRAPH_DIR")
+KNN_GRAPH_CHECK_SECONDS = float(os.getenv("KNN_GRAPH_CHECK_SECONDS", "10"))
+
+# Named weightings for weight_profile: built-ins + WEIGHT_PROFILES_JSON
+# ({"name": {"subject": .., "grade": .., "days": .., "times": ..}}, e.g. A/B arms)
+WEIGHT_PROFILES = {
+    **BUILTIN_WEIGHT_PROFILES,
+    **{name: validate_weights(weights) for name, weights in json.loads(os.getenv("WEIGHT_PROFILES_JSON", "{}")).items()},
+}
+
+# Fetch + encode the snapshot (and build indexes) before reporting ready
+PRELOAD_ON_STARTUP = os.getenv("PRELOAD_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
 async def fetch_users_from_backend():
     """Fetch all active users from Backend API"""
     try:
@@ -72,79 +131,111 @@ async def fetch_users_from_backend():
         print(f"❌ [Backend] Error: {e}")
         return []
 
-def map_backend_to_ml_format(backend_user: Dict) -> Dict:
-    """Map backend user format to ML format"""
-    # Subject mapping
-    subject_map = {
-        'Mathematics': 'math',
-        'Physics': 'physics',
-        'Chemistry': 'chemistry',
-        'Biology': 'biology',
-        'English': 'english',
-        'Computer Science': 'computer',
-        'math': 'math',
-        'physics': 'physics',
-        'chemistry': 'chemistry',
-        'biology': 'biology',
-        'english': 'english',
-        'computer': 'computer'
-    }
+# Shared user snapshot: fetched + encoded once, refreshed in the background.
+# With SHARED_SNAPSHOT_DIR, one worker per host builds it and the others map it.
+if SHARED_SNAPSHOT_DIR:
+    snapshot_store = SharedSnapshotStore(
+        SHARED_SNAPSHOT_DIR,
+        fetch_users=lambda: fetch_users_from_backend(),
+        map_user=map_backend_to_ml_format,
+        encode_users=encode_backend_users,
+    )
+else:
+    snapshot_store = SnapshotStore(
+        fetch_users=lambda: fetch_users_from_backend(),
+        map_user=map_backend_to_ml_format,
+        encode_users=encode_backend_users,
+    )
+
+# Clustering model: trained per snapshot build, persisted, partial_fit on upserts
+cluster_index = ClusterIndex()
+
+# Ranked results per (query profile, k), dropped whenever the snapshot changes
+result_cache = ResultCache()
+
+# Loaded lazily, reloaded when the job rewrites meta.json; a missing graph is
+# cached like a loaded one (one stat per check interval, logged once)
+_knn_graph = {'dir': None, 'graph': None, 'mtime': None, 'checked_at': 0.0, 'error': None}
+
+def get_knn_graph() -> Optional[KnnGraph]:
+    """Current precomputed neighbour graph (None if not configured / not built yet)"""
+    if not KNN_GRAPH_DIR:
+        return None
     
-    # Days mapping
-    day_map = {
-        'Monday': 'monday',
-        'Tuesday': 'tuesday',
-        'Wednesday': 'wednesday',
-        'Thursday': 'thursday',
-        'Friday': 'friday',
-        'Saturday': 'saturday',
-        'Sunday': 'sunday',
-    }
+    now = time.monotonic()
+    if _knn_graph['dir'] == KNN_GRAPH_DIR and now - _knn_graph['checked_at'] < KNN_GRAPH_CHECK_SECONDS:
+        return _knn_graph['graph']
+    if _knn_graph['dir'] != KNN_GRAPH_DIR:
+        _knn_graph.update({'dir': KNN_GRAPH_DIR, 'graph': None, 'mtime': None, 'error': None})
+    _knn_graph['checked_at'] = now
     
-    # Times mapping
-    time_map = {
-        'Morning (6am-12pm)': 'morning',
-        'Afternoon (12pm-6pm)': 'afternoon',
-        'Evening (6pm-9pm)': 'evening',
-        'Night (9pm-6am)': 'night',
-        'Morning': 'morning',
-        'Afternoon': 'afternoon',
-        'Evening': 'evening',
-        'Night': 'night',
-    }
+    try:
+        mtime = os.stat(os.path.join(KNN_GRAPH_DIR, 'meta.json')).st_mtime
+        if mtime != _knn_graph['mtime']:
+            graph = KnnGraph(KNN_GRAPH_DIR)
+            _knn_graph['graph'], _knn_graph['mtime'], _knn_graph['error'] = graph, mtime, None
+            print(f"✅ [kNN] Loaded graph ({graph.meta['n_users']} users, k={graph.k}, snapshot v{graph.snapshot_version})")
+    except Exception as e:
+        if str(e) != _knn_graph['error']:
+            print(f"⚠️ [kNN] Graph unavailable: {e}")
+        _knn_graph['graph'], _knn_graph['mtime'], _knn_graph['error'] = None, None, str(e)
     
-    # Transform
-    subject_input = backend_user.get('tag_subject', 'math')
-    subject_code = subject_map.get(str(subject_input), 'math')
+    return _knn_graph['graph']
+
+def find_in_knn_graph(snapshot: UserSnapshot, user_id: Optional[str], query_code: int, k: int) -> Optional[np.ndarray]:
+    """
+    Snapshot rows of a user's precomputed partners
     
-    days_display = backend_user.get('tag_study_days', [])
-    days_codes = [day_map.get(d, d.lower()) for d in days_display if d]
-    if not days_codes:
-        days_codes = ['monday', 'wednesday', 'friday']
+    The graph is only used while the query's subject is at the data version
+    it was built on, so its rows are exactly page 1 of the live ranking.
     
-    times_display = backend_user.get('tag_study_times', [])
-    times_codes = [time_map.get(t, t.lower()) for t in times_display if t]
-    if not times_codes:
-        times_codes = ['morning', 'evening']
+    Returns:
+        Rows in rank order, or None when live ranking is needed (no graph,
+        unknown subject or user, subject changed since the job ran, profile
+        changed, or a partner left the index)
+    """
+    graph = get_knn_graph() if user_id else None
+    if graph is None:
+        return None
     
-    # Grade normalization
-    grade_raw = backend_user.get('grade', '11')
-    try:
-        grade = int(grade_raw)
-    except:
-        grade = 11
+    subject_idx = query_code >> SUBJECT_SHIFT
+    if subject_idx >= len(SUBJECTS):
+        return None
+    subject = SUBJECTS[subject_idx]
+    if not graph.is_current(subject, data_version(snapshot, subject), snapshot.content_version):
+        return None
     
-    return {
-        'student_id': backend_user.get('user_id', ''),
-        'name': backend_user.get('name', 'Student'),
-        'email': backend_user.get('email', ''),
-        'school': backend_user.get('school', ''),
-        'grade': str(grade),
-        'bio': backend_user.get('bio', ''),
-        'tag_subject': subject_code,
-        'tag_study_days': days_codes,
-        'tag_study_times': times_codes,
-    }
+    partner_ids = graph.neighbors_of(user_id, query_code, k)
+    if partner_ids is None:
+        return None
+    
+    rows = [snapshot.row_of.get(partner_id) for partner_id in partner_ids]
+    if any(row is None for row in rows):
+        return None
+    
+    return np.array(rows, dtype=np.int64)
+
+async def warm_up() -> UserSnapshot:
+    """
+    Startup preload: snapshot, per-subject buckets, kNN graph, cluster model
+    
+    Returns:
+        The loaded snapshot: the saved snapshot file when there is one (the
+        fetch then runs in the background), else a fresh fetch (empty if the
+        backend was unreachable; /ready keeps reporting 503 and retries in the
+        background)
+    """
+    started = time.perf_counter()
+    snapshot = await snapshot_store.get()
+    
+    for partition in snapshot.partitions.values():
+        partition.buckets       # built lazily otherwise, on the first query per subject
+    get_knn_graph()
+    if USE_CLUSTERING:
+        cluster_index.load()
+    
+    print(f"🚀 [Startup] Warm in {time.perf_counter() - started:.2f}s: snapshot v{snapshot.version} ({snapshot.size} users)")
+    return snapshot
 
 def calculate_optimal_clusters(n_users: int) -> int:
     """Calculate optimal number of clusters based on user count"""
@@ -158,133 +249,417 @@ def calculate_optimal_clusters(n_users: int) -> int:
     optimal_k = int(6 * multiplier)  # 6 subjects × multiplier
     return max(6, min(optimal_k, 20))
 
-async def find_similar_with_gower(profile: Dict, top_n: int = 5, use_clustering: bool = True) -> tuple:
+async def find_similar_with_gower(profile: Dict, top_n: int = 5, use_clustering: bool = True, cursor: Optional[str] = None,
+                                  weights: Optional[Dict[str, float]] = None,
+                                  candidate_filter: Optional[CandidateFilter] = None) -> tuple:
     """
     Find matches using Gower Distance
     
     Workflow:
-    1. FETCH: Get users from Backend
-    2. MAP: Convert to ML format
-    3. ENCODE: Convert to Gower-friendly features (18-dim)
-    4. CLUSTER (optional): K-Means for initial grouping
+    1-3. SNAPSHOT: Users fetched, mapped and encoded (18-dim + packed) once
+         per snapshot version, not per request
+    (GRAPH: known users with an unchanged profile are served from the
+     precomputed kNN graph, see app/knn_graph.py - default weights, no filter)
+    (CACHE: repeated profiles + weighting + filter, while the subject is unchanged, skip 4-8)
+    4. CLUSTER (optional): persistent K-Means model, predict only (its
+       identity keys the cached ranking and the cursor)
     5. FILTER: Same subject (required)
-    6. GOWER DISTANCE: Calculate weighted Gower distance
-    7. SORT: Return top N by distance (ascending)
+    6. BUCKET: Group candidates by identical packed profile, then apply the
+       request's filter expression to the buckets (app/filters.py)
+    7. GOWER DISTANCE + SORT: Rank buckets, expand top N (ascending distance)
+       (next pages: slice of the full bucket ranking, cached per snapshot)
     
     Args:
         profile: Query student profile
-        top_n: Number of matches to return
+        top_n: Page size (capped at MAX_MATCH_RESULTS)
         use_clustering: Whether to use K-Means pre-filtering
+        cursor: next_cursor of the previous page (None = first page)
+        weights: Per-request weighting from resolve_weighting() (None = FEATURE_WEIGHTS)
+        candidate_filter: Parsed filter expression (None = subject filter only)
     
     Returns:
-        (result_list, cluster_id)
+        (result_list, cluster_id, next_cursor, filter_counts) - next_cursor is
+        None once the ranking is exhausted; filter_counts (None without a
+        filter) lists the candidates left after the subject and each clause
     """
-    # === 1. FETCH ===
-    backend_users = await fetch_users_from_backend()
+    stages = metrics.MATCH_STAGE_SECONDS.stopwatch()
     
-    if len(backend_users) == 0:
-        raise HTTPException(status_code=404, detail="Chưa có học sinh trong hệ thống")
-    
-    print(f"📊 [ML] Processing {len(backend_users)} users")
+    # === 1-3. SNAPSHOT (FETCH → MAP → ENCODE, cached) ===
+    snapshot = await snapshot_store.get()
+    stages.lap('snapshot')
     
-    # === 2. MAP ===
-    students_data = []
-    for backend_user in backend_users:
-        ml_user = map_backend_to_ml_format(backend_user)
-        ml_user['features'] = encode_features_for_gower(ml_user)
-        students_data.append(ml_user)
+    if snapshot.size == 0:
+        raise HTTPException(status_code=404, detail="Chưa có học sinh trong hệ thống")
     
-    students_df = pd.DataFrame(students_data)
-    print(f"✅ [ML] Converted {len(students_df)} users to ML format")
+    log(f"📊 [ML] Using snapshot v{snapshot.version} ({snapshot.size} users)")
     
     # Map query profile
     ml_profile = map_backend_to_ml_format(profile)
-    query_features = encode_features_for_gower(ml_profile)
+    query_code = encode_profile_packed(ml_profile)
     
-    # === 3. GET ALL FEATURES ===
-    all_features = np.vstack(students_df['features'].values)
+    # Exact top-k (argpartition, ties by row) - backend decides top_n,
+    # capped at MAX_MATCH_RESULTS to avoid overwhelming responses
+    k = min(top_n, MAX_MATCH_RESULTS)
+    query_subject = ml_profile.get('tag_subject', '').lower()
+    query_school = ml_profile.get('school') or ''
     
-    # === 4. OPTIONAL CLUSTERING ===
-    query_cluster = 0
-    candidate_indices = list(range(len(students_df)))
+    # Weighting + filter (+ the query's school for same_school) decide the ranking too
+    weights_key = weighting_key(weights)
+    filter_key = None
+    if candidate_filter is not None:
+        filter_key = candidate_filter.key + ((normalize_school(query_school),) if candidate_filter.needs_school else ())
+    tag = ranking_tag(weights, filter_key)
+    version = data_version(snapshot, query_subject)     # unchanged by changes to other subjects
     
-    if use_clustering and len(students_df) >= 10:
-        optimal_clusters = calculate_optimal_clusters(len(students_df))
-        effective_clusters = min(optimal_clusters, len(students_df))
-        
-        print(f"🎯 [ML] Using {effective_clusters} clusters")
-        
-        cluster_labels, kmeans = kmeans_clustering_for_gower(all_features, effective_clusters)
+    # === 4a. CLUSTER MODEL (optional; its identity is part of the ranking + cursor) ===
+    cluster_model = None
+    if use_clustering and snapshot.size >= 10:
+        cluster_model = cluster_index.get(snapshot, calculate_optimal_clusters(snapshot.size))
+    cluster_id = cluster_model.identity if cluster_model is not None else 0
+    
+    offset = resolve_cursor(cursor, version, query_code, tag, cluster_id)
+    stages.lap('encode')
+    
+    ranking_key = ('ranking', query_code, weights_key, filter_key, cluster_id)
+    
+    if offset > 0:
+        # === NEXT PAGE (ranking already computed for this data version) ===
+        cached = result_cache.get(snapshot, ranking_key, query_subject)
+        if cached is not None:
+            ranking, query_cluster, filter_counts = cached
+            results = build_ranking_page(snapshot, query_code, query_subject, ranking, offset, k, query_cluster)
+            stages.lap('page')
+            log(f"⚡ [ML] Page at offset {offset}: {len(results)} results from cached ranking")
+            next_cursor = next_page_cursor(version, query_code, offset, k, int(ranking.starts[-1]), tag, cluster_id)
+            return finish_match(stages, 'page', results), query_cluster, next_cursor, filter_counts
+    
+    elif not use_clustering:
+        # === PRECOMPUTED GRAPH (known user, profile unchanged since the job ran; default weights, unfiltered) ===
+        use_graph = weights is None and candidate_filter is None
+        graph_rows = find_in_knn_graph(snapshot, profile.get('user_id'), query_code, k) if use_graph else None
+        if graph_rows is not None:
+            graph_distances = calculate_gower_distances_packed(query_code, snapshot.codes[graph_rows])
+            results = build_match_records(snapshot, query_code, graph_rows, graph_distances, 0)
+            stages.lap('graph')
+            log(f"⚡ [ML] Serving {len(graph_rows)} partners from precomputed kNN graph")
+            # Same data version + ranking as the live path (self included): page 2 continues the live ranking
+            next_cursor = next_page_cursor(version, query_code, 0, k, subject_size(snapshot, query_subject))
+            return finish_match(stages, 'graph', results), 0, next_cursor, None
+        stages.lap('graph')
         
-        if kmeans is not None:
-            query_cluster = kmeans.predict(query_features.reshape(1, -1))[0]
-            candidate_indices = np.where(cluster_labels == query_cluster)[0].tolist()
-            print(f"🎯 [ML] Query assigned to cluster {query_cluster} ({len(candidate_indices)} candidates)")
-        else:
-            print(f"⚠️ [ML] Clustering skipped (too few users)")
+        # === RESULT CACHE (same profile + k + weighting + filter, subject unchanged) ===
+        cached = result_cache.get(snapshot, (query_code, k, weights_key, filter_key), query_subject)
+        stages.lap('cache')
+        if cached is not None:
+            results, filter_counts = cached
+            log(f"⚡ [ML] Cache hit: {len(results)} results for profile {query_code}")
+            n_ranked = filter_counts[-1]['candidates'] if filter_counts else subject_size(snapshot, query_subject)
+            next_cursor = next_page_cursor(version, query_code, 0, k, n_ranked, tag)
+            return finish_match(stages, 'cache', results), 0, next_cursor, filter_counts
+    
+    # === 4b. OPTIONAL CLUSTERING (model trained in background, predict only) ===
+    query_cluster = 0
+    
+    if cluster_model is not None:
+        query_cluster = cluster_model.label_of(query_code)
+        log(f"🎯 [ML] Query assigned to cluster {query_cluster} of {cluster_model.n_clusters}")
+    elif use_clustering and snapshot.size >= 10:
+        log(f"⚠️ [ML] Cluster model not ready, direct matching")
     else:
-        print(f"📊 [ML] Direct matching (no clustering)")
+        log(f"📊 [ML] Direct matching (no clustering)")
+    stages.lap('cluster')
     
-    # === 5. SUBJECT FILTER ===
-    query_subject = ml_profile.get('tag_subject', '').lower()
-    same_subject_indices = [
-        idx for idx in candidate_indices
-        if students_df.iloc[idx]['tag_subject'].lower() == query_subject
-    ]
+    # === 5. SUBJECT FILTER (prebuilt partition lookup) ===
+    partition = snapshot.partitions.get(query_subject)
     
-    if len(same_subject_indices) == 0:
-        # Fallback: search entire database
-        print(f"⚠️ [ML] No subject match in cluster, searching database")
-        same_subject_indices = [
-            idx for idx in range(len(students_df))
-            if students_df.iloc[idx]['tag_subject'].lower() == query_subject
-        ]
-        
-        if len(same_subject_indices) == 0:
-            raise HTTPException(status_code=404, detail=f"Không tìm thấy ai học {query_subject}")
+    if partition is None or partition.size == 0:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy ai học {query_subject}")
     
-    print(f"✅ [ML] Found {len(same_subject_indices)} candidates with subject: {query_subject}")
+    # === 6. BUCKET BY PROFILE (cluster = subset of buckets, labels cached per code) ===
+    buckets = partition.buckets
+    if cluster_model is not None:
+        in_cluster = cluster_model.labels_of(buckets.codes) == query_cluster
+        if in_cluster.any():
+            buckets = select_buckets(buckets, in_cluster)
+        else:
+            # Fallback: search entire subject partition
+            log(f"⚠️ [ML] No subject match in cluster, searching database")
     
-    # === 6. GOWER DISTANCE CALCULATION ===
-    candidate_features = all_features[same_subject_indices]
-    distances = calculate_gower_distances(query_features, candidate_features)
+    filter_counts = None
+    if candidate_filter is not None:
+        buckets, filter_counts = filter_candidates(snapshot, query_subject, buckets, query_code, query_school, candidate_filter)
+        log(f"🔎 [ML] Filter {','.join(candidate_filter.key)}: {' → '.join(str(c['candidates']) for c in filter_counts)} candidates")
     
-    # === 7. SORT AND RANK ===
-    # Sort ALL candidates by distance (no limit here - let backend decide)
-    sorted_idx = np.argsort(distances)  # Remove [:top_n] to return all
+    n_candidates = buckets.size
+    metrics.CANDIDATES_SCANNED.inc(n_candidates)
+    stages.lap('filter')
+    log(f"✅ [ML] Found {n_candidates} candidates with subject: {query_subject}")
+    log(f"🧺 [ML] {n_candidates} candidates in {len(buckets.codes)} profile buckets")
     
-    # But to avoid overwhelming response, cap at reasonable max (e.g., 100)
-    max_results = min(len(sorted_idx), 100)  # Max 100 results
-    sorted_idx = sorted_idx[:max_results]
+    # === 7. GOWER DISTANCE + TOP-K (or one page of the full ranking) ===
+    # (non-default weightings re-weight the cached per-component distances of this candidate set)
+    components = None
+    if weights is not None:
+        components = query_components(snapshot, query_subject, query_code, buckets, (filter_key, cluster_id))
     
-    matched_indices = [same_subject_indices[i] for i in sorted_idx]
-    matched_distances = distances[sorted_idx]
+    if offset > 0:
+        ranking = rank_bucket_order(query_code, buckets, weights, components)
+        result_cache.put(snapshot, ranking_key, (ranking, int(query_cluster), filter_counts), query_subject)
+        ranked_positions, matched_distances = ranking_page(ranking, offset, k)
+    elif components is not None:
+        ranked_positions, matched_distances = rank_profile_buckets_weightings(query_code, buckets, [weights], k, components)[0]
+    else:
+        ranked_positions, matched_distances = rank_profile_buckets(query_code, buckets, k=k, weights=weights)
+    matched_rows = partition.rows[ranked_positions]
+    stages.lap('rank')
     
-    print(f"📊 [ML] Returning {len(matched_indices)} Gower-ranked results (capped at 100)")
+    log(f"📊 [ML] Returning {len(matched_rows)} Gower-ranked results (top_n={top_n}, cap {MAX_MATCH_RESULTS})")
     
     # === 8. BUILD RESULT ===
-    result_df = students_df.iloc[matched_indices].copy()
-    result_df['gower_distance'] = matched_distances
-    result_df['cluster'] = query_cluster
-    
-    # Add detailed breakdown
-    for i, idx in enumerate(matched_indices):
-        breakdown = get_similarity_breakdown(
-            query_features,
-            students_df.iloc[idx]['features']
-        )
+    results = build_match_records(snapshot, query_code, matched_rows, matched_distances, query_cluster)
+    if not use_clustering and offset == 0:
+        result_cache.put(snapshot, (query_code, k, weights_key, filter_key), (results, filter_counts), query_subject)
+    stages.lap('build')
+    
+    log(f"✅ [ML] Returning top {len(results)} Gower matches")
+    
+    next_cursor = next_page_cursor(version, query_code, offset, k, n_candidates, tag, cluster_id)
+    return finish_match(stages, 'ranked', results), int(query_cluster), next_cursor, filter_counts
+
+def filter_candidates(snapshot: UserSnapshot, subject: str, buckets, query_code: int, query_school: str,
+                      candidate_filter: CandidateFilter) -> tuple:
+    """
+    Apply a filter expression to a subject's candidate buckets (before ranking)
+    
+    Returns:
+        (filtered buckets, filter_counts) - filter_counts starts with the
+        subject candidates, then the count after each clause
+    """
+    school_positions = None
+    if candidate_filter.needs_school:
+        if not normalize_school(query_school):
+            raise HTTPException(status_code=400, detail="Bộ lọc same_school cần trường học (school) của hồ sơ tìm kiếm")
+        school_positions = snapshot.school_positions(subject, query_school)
+    
+    counts = [{'filter': f"subject={subject}", 'candidates': buckets.size}]
+    partition_codes = snapshot.partitions[subject].codes
+    buckets, clause_counts = apply_filter(candidate_filter, buckets, query_code, school_positions, partition_codes)
+    return buckets, counts + clause_counts
+
+def resolve_cursor(cursor: Optional[str], version: int, query_code: int, tag: int = 0, cluster: int = 0) -> int:
+    """
+    Offset encoded in a /match cursor (0 without one); 400 / 410 if it cannot be used
+    (version: data_version of the query's subject, cluster: identity of the cluster model, 0 = unclustered)
+    """
+    if not cursor:
+        return 0
+    
+    try:
+        cursor_version, cursor_code, offset, cursor_tag, cursor_cluster = decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor không hợp lệ")
+    
+    if cursor_code != query_code:
+        raise HTTPException(status_code=400, detail="Cursor không thuộc hồ sơ tìm kiếm này")
+    if cursor_tag != tag:
+        raise HTTPException(status_code=400, detail="Cursor không thuộc bộ trọng số / bộ lọc này (weight_profile / weights / filter)")
+    if cursor_version != version:
+        raise HTTPException(status_code=410, detail="Cursor đã hết hạn (dữ liệu đã thay đổi), hãy tìm lại từ đầu")
+    if cursor_cluster != cluster:
+        raise HTTPException(status_code=410, detail="Cursor đã hết hạn (mô hình phân cụm đã thay đổi), hãy tìm lại từ đầu")
+    
+    return offset
+
+def next_page_cursor(version: int, query_code: int, offset: int, k: int, n_ranked: int,
+                     tag: int = 0, cluster: int = 0) -> Optional[str]:
+    """Cursor of the page after [offset, offset + k) of n_ranked candidates, None if this page was the last"""
+    if offset + k >= n_ranked:
+        return None
+    return encode_cursor(version, query_code, offset + k, tag, cluster)
+
+def parse_weights_query(text: Optional[str]) -> Optional[Dict[str, float]]:
+    """`subject=0.4,grade=0.3,days=0.2,times=0.1` (query parameter form of weights); 400 if malformed"""
+    if text is None:
+        return None
+    
+    try:
+        pairs = [item.split('=') for item in text.split(',') if item.strip()]
+        return {name.strip(): float(value) for name, value in pairs}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="weights phải có dạng subject=0.4,grade=0.3,days=0.2,times=0.1")
+
+def resolve_filter(expression: Optional[str]) -> Optional[CandidateFilter]:
+    """Parsed `filter` query parameter (None without one); 400 if it cannot be parsed"""
+    if expression is None:
+        return None
+    
+    try:
+        return parse_filter(expression)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Bộ lọc không hợp lệ: {e}")
+
+def resolve_weighting(weight_profile: Optional[str], weights: Optional[Dict[str, float]]) -> Optional[Dict[str, float]]:
+    """
+    Weighting of one request: a named profile or explicit weights (not both)
+    
+    Returns:
+        component → weight, or None for the default survey weights (same
+        graph, cache entries and cursors as a request without weights)
+    """
+    if weight_profile is not None and weights is not None:
+        raise HTTPException(status_code=400, detail="Chỉ dùng weight_profile hoặc weights, không dùng cả hai")
+    
+    if weight_profile is not None:
+        if weight_profile not in WEIGHT_PROFILES:
+            raise HTTPException(status_code=400, detail=f"Không có weight_profile '{weight_profile}' (có: {', '.join(sorted(WEIGHT_PROFILES))})")
+        weights = WEIGHT_PROFILES[weight_profile]
+    elif weights is not None:
+        try:
+            weights = validate_weights(weights)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Trọng số không hợp lệ: {e}")
+    
+    return None if weights is None or weights == FEATURE_WEIGHTS else weights
+
+def weighting_key(weights: Optional[Dict[str, float]]) -> Optional[tuple]:
+    """Hashable form of a resolve_weighting() result (None = default weights)"""
+    return None if weights is None else tuple(sorted(weights.items()))
+
+def query_components(snapshot: UserSnapshot, subject: str, query_code: int, buckets, scope_key: tuple) -> tuple:
+    """
+    Per-component distances from a query to a candidate set's buckets,
+    cached per subject data version
+    
+    Args:
+        scope_key: what selected the buckets besides the subject, e.g.
+            (filter_key, cluster_id); (None, 0) = the whole partition
+    
+    Returns:
+        component_distances_packed(query_code, buckets.codes)
+    """
+    key = ('components', query_code) + scope_key
+    components = result_cache.get(snapshot, key, subject)
+    if components is None:
+        components = component_distances_packed(query_code, buckets.codes)
+        result_cache.put(snapshot, key, components, subject)
+    return components
+
+def subject_size(snapshot: UserSnapshot, subject: str) -> int:
+    """Candidates of an unclustered ranking: the whole subject partition"""
+    partition = snapshot.partitions.get(subject)
+    return partition.size if partition is not None else 0
+
+def build_ranking_page(snapshot: UserSnapshot, query_code: int, subject: str, ranking,
+                       offset: int, k: int, query_cluster: int) -> List[Dict]:
+    """Result dicts for ranks [offset, offset + k) of a cached subject ranking"""
+    ranked_positions, matched_distances = ranking_page(ranking, offset, k)
+    matched_rows = snapshot.partitions[subject].rows[ranked_positions]
+    return build_match_records(snapshot, query_code, matched_rows, matched_distances, query_cluster)
+
+def finish_match(stages: metrics.Stopwatch, source: str, results: List[Dict]) -> List[Dict]:
+    """Record request-level metrics for one /match query"""
+    metrics.MATCH_SECONDS.observe(stages.total(), endpoint='match')
+    metrics.MATCH_REQUESTS.inc(source=source)
+    metrics.RESULTS_RETURNED.inc(len(results))
+    return results
+
+
+def build_match_records(snapshot: UserSnapshot, query_code: int, matched_rows: np.ndarray,
+                        matched_distances: np.ndarray, query_cluster: int) -> List[Dict]:
+    """Ranked students + similarity breakdown as result dicts (one gather per column)"""
+    columns = snapshot.gather(matched_rows)
+    
+    # One vectorized breakdown for all matches (ranking distances reused)
+    breakdown = get_similarity_breakdown_batch(query_code, snapshot.codes[matched_rows], matched_distances)
+    columns['gower_distance'] = breakdown['gower_distance'].tolist()
+    columns['cluster'] = [query_cluster] * len(matched_rows)
+    for name in BREAKDOWN_FIELDS:
+        columns[name] = breakdown[name].tolist()
+    
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+async def find_similar_batch_with_gower(profiles: List[Dict], top_n: int = 5, weights: Optional[Dict[str, float]] = None,
+                                        profile_weights: Optional[List[Optional[Dict[str, float]]]] = None) -> tuple:
+    """
+    Find matches for many query profiles against one snapshot
+    
+    Queries are grouped by subject; each group is ranked against that
+    subject partition's buckets with one blocked (queries × buckets) distance
+    matrix (identical query profiles are ranked once). A query profile sent
+    with other weightings than the batch's is ranked once per distinct
+    weighting from its cached per-component distances instead.
+    
+    Args:
+        profiles: Query student profiles
+        top_n: Number of matches per query (capped at MAX_MATCH_RESULTS)
+        weights: Weighting of the batch (None = FEATURE_WEIGHTS)
+        profile_weights: Weighting of each query, same order as profiles
+            (None = `weights` for every query)
+    
+    Returns:
+        (list of result_list per query, snapshot_version)
+    """
+    started = time.perf_counter()
+    snapshot = await snapshot_store.get()
+    
+    if snapshot.size == 0:
+        raise HTTPException(status_code=404, detail="Chưa có học sinh trong hệ thống")
+    
+    ml_profiles = [map_backend_to_ml_format(profile) for profile in profiles]
+    query_codes = np.array([encode_profile_packed(p) for p in ml_profiles], dtype=np.int64)
+    query_subjects = query_codes >> SUBJECT_SHIFT
+    k = min(top_n, MAX_MATCH_RESULTS)
+    
+    log(f"📦 [ML] Batch of {len(profiles)} queries on snapshot v{snapshot.version} ({snapshot.size} users)")
+    
+    results: List[List[Dict]] = [[] for _ in profiles]
+    for subject_idx in np.unique(query_subjects):
+        partition = snapshot.partitions.get(SUBJECTS[subject_idx]) if subject_idx < len(SUBJECTS) else None
+        if partition is None or partition.size == 0:
+            continue
         
-        result_df.at[result_df.index[i], 'subject_match'] = breakdown['subject_match']
-        result_df.at[result_df.index[i], 'grade_similarity'] = breakdown['grade_similarity']
-        result_df.at[result_df.index[i], 'days_similarity'] = breakdown['days_similarity']
-        result_df.at[result_df.index[i], 'days_overlap_count'] = breakdown['days_overlap_count']
-        result_df.at[result_df.index[i], 'times_similarity'] = breakdown['times_similarity']
-        result_df.at[result_df.index[i], 'times_overlap_count'] = breakdown['times_overlap_count']
-        result_df.at[result_df.index[i], 'overall_similarity'] = breakdown['overall_similarity']
+        query_positions = np.flatnonzero(query_subjects == subject_idx)
+        metrics.CANDIDATES_SCANNED.inc(partition.size * len(query_positions))
+        
+        # Profiles sent with other weightings: one component pass per profile, one combine per weighting
+        reweighted = set()
+        if profile_weights is not None:
+            by_code: Dict[int, List[int]] = {}
+            for position in query_positions:
+                by_code.setdefault(int(query_codes[position]), []).append(int(position))
+            
+            for query_code, positions in by_code.items():
+                keys = [weighting_key(profile_weights[position]) for position in positions]
+                if all(key == weighting_key(weights) for key in keys):
+                    continue
+                
+                distinct = list(dict.fromkeys(keys))
+                components = query_components(snapshot, SUBJECTS[subject_idx], query_code, partition.buckets, (None, 0))
+                ranked = rank_profile_buckets_weightings(
+                    query_code, partition.buckets, [profile_weights[positions[keys.index(key)]] for key in distinct],
+                    k, components
+                )
+                for position, key in zip(positions, keys):
+                    ranked_positions, matched_distances = ranked[distinct.index(key)]
+                    results[position] = build_match_records(
+                        snapshot, query_code, partition.rows[ranked_positions], matched_distances, 0
+                    )
+                reweighted.update(positions)
+        
+        query_positions = np.array([p for p in query_positions if p not in reweighted], dtype=np.int64)
+        ranked = rank_profile_buckets_batch(query_codes[query_positions], partition.buckets, k, BATCH_BLOCK_BYTES, weights)
+        
+        for position, (ranked_positions, matched_distances) in zip(query_positions, ranked):
+            results[position] = build_match_records(
+                snapshot, query_codes[position], partition.rows[ranked_positions], matched_distances, 0
+            )
     
-    print(f"✅ [ML] Returning top {len(result_df)} Gower matches")
+    metrics.MATCH_SECONDS.observe(time.perf_counter() - started, endpoint='batch')
+    metrics.MATCH_REQUESTS.inc(len(profiles), source='batch')
+    metrics.RESULTS_RETURNED.inc(sum(len(result) for result in results))
     
-    return result_df.to_dict('records'), int(query_cluster)
+    return results, snapshot.version
 
 # ===== HELPER FUNCTIONS =====
 def get_display_list(items: List[str]) -> List[str]:
@@ -297,30 +672,172 @@ def get_display_list(items: List[str]) -> List[str]:
             unique_items.append(item)
     return [item.capitalize() for item in unique_items]
 
+def partner_fields(partner: Dict, rank: int) -> Dict:
+    """MatchedPartner fields of one ranked result dict"""
+    # Gower distance → similarity percentage
+    # Distance: 0 (perfect) to 1 (completely different)
+    # Similarity: 1 (perfect) to 0 (no match)
+    similarity = partner.get('overall_similarity', 0.0)
+    
+    return dict(
+        rank=rank,
+        student_id=partner.get('student_id', ''),
+        name=partner.get('name', 'Student'),
+        school=partner.get('school'),
+        grade=partner.get('grade', '11'),
+        subject_selected=partner.get('tag_subject', 'math'),
+        
+        # Overall similarity (0-1, higher = better)
+        similarity_score=float(similarity),
+        
+        # Detailed breakdown
+        days_match_score=float(partner.get('days_similarity', 0.0)),
+        times_match_score=float(partner.get('times_similarity', 0.0)),
+        days_overlap_count=int(partner.get('days_overlap_count', 0)),
+        times_overlap_count=int(partner.get('times_overlap_count', 0)),
+        
+        is_subject_match=bool(partner.get('subject_match', True)),
+        available_days=get_display_list(partner.get('tag_study_days', [])),
+        available_times=get_display_list(partner.get('tag_study_times', [])),
+        email=partner.get('email', ''),
+        phone=partner.get('phone')
+    )
+
+def query_student_fields(profile: schemas.StudentProfile) -> Dict:
+    return {
+        "name": profile.name,
+        "subject": profile.tag_subject,
+        "grade": profile.grade,
+        "available_days": get_display_list(profile.tag_study_days),
+        "available_times": get_display_list(profile.tag_study_times)
+    }
+
+def build_matching_response(profile: schemas.StudentProfile, matched_results: List[Dict], query_cluster: int,
+                            rank_offset: int = 0, next_cursor: Optional[str] = None,
+                            weights: Optional[Dict[str, float]] = None,
+                            filter_counts: Optional[List[Dict]] = None) -> schemas.MatchingResponse:
+    """Convert ranked result dicts into the API response model (ranks continue across pages)"""
+    weights = weights or FEATURE_WEIGHTS
+    matched_partners = [
+        schemas.MatchedPartner(**partner_fields(partner, rank))
+        for rank, partner in enumerate(matched_results, start=rank_offset + 1)
+    ]
+    
+    return schemas.MatchingResponse(
+        query_student=query_student_fields(profile),
+        cluster_id=query_cluster,
+        total_candidates=len(matched_results),
+        matched_partners=matched_partners,
+        next_cursor=next_cursor,
+        filter_counts=filter_counts,
+        message=(
+            f"✅ {len(matched_partners)} matches (Gower: {weights['subject']:.0%} Subject, {weights['grade']:.0%} Grade, "
+            f"{weights['days']:.0%} Days, {weights['times']:.0%} Times)"
+        )
+    )
+
+async def stream_matches(profile: schemas.StudentProfile, snapshot: UserSnapshot, partition, ranking,
+                         query_code: int, limit: int, filter_counts: Optional[List[Dict]] = None):
+    """
+    NDJSON lines for /match/stream: query header, one line per partner in
+    rank order, end marker
+    
+    Ranks are expanded, built and serialized chunk by chunk (no pydantic
+    models), so the first partners are sent before the rest exist. An
+    in-place change to the query's subject mid-stream ends it early
+    (`"complete": false`): its rows no longer match the ranking.
+    """
+    started = time.perf_counter()
+    version = partition.version
+    yield ndjson_line({
+        "type": "query",
+        "query_student": query_student_fields(profile),
+        "snapshot_version": snapshot.version,
+        "total_candidates": int(ranking.starts[-1]),
+        "filter_counts": filter_counts,
+    })
+    
+    offset, complete = 0, True
+    for size in chunk_sizes():
+        if offset >= limit:
+            break
+        if partition.version != version:
+            complete = False
+            break
+        
+        positions, distances = ranking_page(ranking, offset, min(size, limit - offset))
+        records = build_match_records(snapshot, query_code, partition.rows[positions], distances, 0)
+        yield b''.join(
+            ndjson_line({"type": "partner", **partner_fields(record, rank)})
+            for rank, record in enumerate(records, start=offset + 1)
+        )
+        offset += len(records)
+    
+    metrics.MATCH_SECONDS.observe(time.perf_counter() - started, endpoint='stream')
+    metrics.RESULTS_RETURNED.inc(offset)
+    yield ndjson_line({"type": "end", "returned": offset, "complete": complete})
+
 # ===== ENDPOINTS =====
 
+async def current_snapshot():
+    """
+    Snapshot for the info endpoints: the one already held, as is
+    
+    Never starts a backend refetch once a snapshot is loaded, so status polling
+    and health checks put no load on the backend.
+    """
+    return snapshot_store.snapshot or await snapshot_store.get()
+
 @app.get("/")
 async def root():
     """API status"""
-    users = await fetch_users_from_backend()
-    optimal_k = calculate_optimal_clusters(len(users))
+    snapshot = await current_snapshot()
+    optimal_k = calculate_optimal_clusters(snapshot.size)
     
     return {
         "status": "OK",
         "mode": "Gower Distance Matching (Survey-based)",
-        "total_students": len(users),
+        "total_students": snapshot.size,
+        "snapshot_version": snapshot.version,
+        "result_cache": result_cache.stats(),
         "backend_url": BACKEND_URL,
         "algorithm": "Gower Distance (mixed data types)",
         "weights": FEATURE_WEIGHTS,
         "n_clusters": {
             "current": optimal_k,
-            "strategy": "Dynamic K-Means pre-filtering (optional)"
+            "strategy": "Dynamic K-Means pre-filtering (optional)",
+            "model": cluster_index.stats()
         },
         "description": "Survey-based: Subject 34%, Grade 35%, Days 20%, Times 10%"
     }
 
+@app.get("/ready", tags=["Info"])
+async def ready():
+    """Readiness probe: 200 once the user snapshot is loaded, 503 otherwise"""
+    snapshot = snapshot_store.snapshot
+    
+    if snapshot is None or snapshot.size == 0:
+        # Backend was down at startup: retry without blocking the probe
+        snapshot_store.schedule_refresh()
+        raise HTTPException(status_code=503, detail="Snapshot chưa sẵn sàng")
+    
+    return {
+        "status": "ready",
+        "snapshot_version": snapshot.version,
+        "total_students": snapshot.size
+    }
+
 @app.post("/match", response_model=schemas.MatchingResponse, tags=["Matching"])
-async def match(profile: schemas.StudentProfile, top_n: int = 5):
+async def match(
+    profile: schemas.StudentProfile,
+    top_n: int = Query(5, ge=1),
+    cursor: Optional[str] = Query(None, description="next_cursor của trang trước (cùng hồ sơ)"),
+    weight_profile: Optional[str] = Query(None, description="Bộ trọng số có tên (xem /weights)"),
+    weights: Optional[str] = Query(None, description="Trọng số riêng: subject=0.4,grade=0.3,days=0.2,times=0.1"),
+    filter_expression: Optional[str] = Query(
+        None, alias="filter", description="Bộ lọc: grade_within=1,min_common_days=2,times=evening,same_school"
+    )
+):
     """
     Tìm bạn học với Gower Distance
     
@@ -329,68 +846,194 @@ async def match(profile: schemas.StudentProfile, top_n: int = 5):
     - Grade: 35% (Ordinal: 10/11/12)
     - Days: 20% (Binary set overlap)
     - Times: 10% (Binary set overlap)
+    
+    **Trọng số theo request:** `weight_profile=<tên>` (danh sách ở /weights)
+    hoặc `weights=subject=..,grade=..,days=..,times=..` (không âm, tổng ≤ 1).
+    
+    **Bộ lọc (áp dụng trước khi tính khoảng cách):** `filter=` các điều kiện
+    cách nhau bởi dấu phẩy, tất cả phải thoả:
+    - `grade_within=N`: chênh lệch khối ≤ N
+    - `min_common_days=N` / `min_common_times=N`: ít nhất N ngày / buổi trùng
+    - `days=<ngày>` / `times=<buổi>`: bắt buộc rảnh ngày / buổi đó
+    - `same_school`: cùng trường với hồ sơ tìm kiếm
+    
+    `filter_counts` trong kết quả cho biết số ứng viên còn lại sau từng điều
+    kiện (danh sách rỗng thay vì 404 khi bộ lọc loại hết ứng viên).
+    
+    **Phân trang:** gửi lại cùng hồ sơ (và cùng trọng số / bộ lọc) với
+    `cursor=<next_cursor>` để lấy top_n kết quả tiếp theo. Cursor hết hạn
+    (410) khi dữ liệu thay đổi.
     """
     try:
-        matched_results, query_cluster = await find_similar_with_gower(
+        request_weights = resolve_weighting(weight_profile, parse_weights_query(weights))
+        candidate_filter = resolve_filter(filter_expression)
+        matched_results, query_cluster, next_cursor, filter_counts = await find_similar_with_gower(
             profile.dict(), 
             top_n,
-            use_clustering=False  # Disable clustering for pure Gower distance testing
+            use_clustering=USE_CLUSTERING,  # Off by default: pure Gower distance ranking
+            cursor=cursor,
+            weights=request_weights,
+            candidate_filter=candidate_filter
         )
         
-        if len(matched_results) == 0:
+        if len(matched_results) == 0 and not cursor and candidate_filter is None:
             raise HTTPException(status_code=404, detail="Không tìm thấy ai phù hợp")
         
-        matched_partners = []
-        for idx, partner in enumerate(matched_results, start=1):
-            # Gower distance → similarity percentage
-            # Distance: 0 (perfect) to 1 (completely different)
-            # Similarity: 1 (perfect) to 0 (no match)
-            similarity = partner.get('overall_similarity', 0.0)
-            
-            matched_partners.append(schemas.MatchedPartner(
-                rank=idx,
-                student_id=partner.get('student_id', ''),
-                name=partner.get('name', 'Student'),
-                school=partner.get('school'),
-                grade=partner.get('grade', '11'),
-                subject_selected=partner.get('tag_subject', 'math'),
-                
-                # Overall similarity (0-1, higher = better)
-                similarity_score=float(similarity),
-                
-                # Detailed breakdown
-                days_match_score=float(partner.get('days_similarity', 0.0)),
-                times_match_score=float(partner.get('times_similarity', 0.0)),
-                days_overlap_count=int(partner.get('days_overlap_count', 0)),
-                times_overlap_count=int(partner.get('times_overlap_count', 0)),
-                
-                is_subject_match=bool(partner.get('subject_match', True)),
-                available_days=get_display_list(partner.get('tag_study_days', [])),
-                available_times=get_display_list(partner.get('tag_study_times', [])),
-                email=partner.get('email', ''),
-                phone=partner.get('phone')
-            ))
+        rank_offset = decode_cursor(cursor)[2] if cursor else 0
+        return build_matching_response(
+            profile, matched_results, query_cluster, rank_offset, next_cursor, request_weights, filter_counts
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ [ML] Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/match/stream", response_class=StreamingResponse, tags=["Matching"])
+async def match_stream(
+    profile: schemas.StudentProfile,
+    top_n: Optional[int] = Query(None, ge=1, description="Số kết quả (bỏ trống = toàn bộ học sinh cùng môn)"),
+    weight_profile: Optional[str] = Query(None, description="Bộ trọng số có tên (xem /weights)"),
+    weights: Optional[str] = Query(None, description="Trọng số riêng: subject=0.4,grade=0.3,days=0.2,times=0.1"),
+    filter_expression: Optional[str] = Query(
+        None, alias="filter", description="Bộ lọc: grade_within=1,min_common_days=2,times=evening,same_school"
+    )
+):
+    """
+    Tìm bạn học, trả về dạng stream NDJSON (`application/x-ndjson`)
+    
+    Dành cho danh sách sâu (không giới hạn 100 kết quả):
+    - Dòng đầu: `{"type": "query", ...}` (hồ sơ, snapshot_version, total_candidates, filter_counts)
+    - Mỗi dòng tiếp theo: `{"type": "partner", ...}` với các trường của MatchedPartner, theo thứ hạng
+    - Dòng cuối: `{"type": "end", "returned": n, "complete": true}`
+    
+    Xếp hạng toàn bộ học sinh cùng môn (không dùng K-Means pre-filtering).
+    Trọng số (`weight_profile` / `weights`) và bộ lọc (`filter`) như /match.
+    """
+    request_weights = resolve_weighting(weight_profile, parse_weights_query(weights))
+    candidate_filter = resolve_filter(filter_expression)
+    snapshot = await snapshot_store.get()
+    if snapshot.size == 0:
+        raise HTTPException(status_code=404, detail="Chưa có học sinh trong hệ thống")
+    
+    ml_profile = map_backend_to_ml_format(profile.dict())
+    query_code = encode_profile_packed(ml_profile)
+    query_subject = ml_profile.get('tag_subject', '').lower()
+    partition = snapshot.partitions.get(query_subject)
+    if partition is None or partition.size == 0:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy ai học {query_subject}")
+    
+    buckets, filter_counts = partition.buckets, None
+    if candidate_filter is not None:
+        buckets, filter_counts = filter_candidates(
+            snapshot, query_subject, buckets, query_code, ml_profile.get('school') or '', candidate_filter
+        )
+    
+    ranking = rank_bucket_order(query_code, buckets, request_weights)
+    n_candidates = buckets.size
+    limit = n_candidates if top_n is None else min(top_n, n_candidates)
+    metrics.MATCH_REQUESTS.inc(source='stream')
+    metrics.CANDIDATES_SCANNED.inc(n_candidates)
+    log(f"🌊 [ML] Streaming {limit} of {n_candidates} ranked partners")
+    
+    return StreamingResponse(
+        stream_matches(profile, snapshot, partition, ranking, query_code, limit, filter_counts),
+        media_type=NDJSON_MEDIA_TYPE
+    )
+
+@app.post("/match/batch", response_model=schemas.BatchMatchingResponse, tags=["Matching"])
+async def match_batch(request: schemas.BatchMatchRequest):
+    """
+    Tìm bạn học cho nhiều học sinh cùng lúc (một snapshot, một phép tính ma trận)
+    
+    Trả về top_n kết quả cho từng hồ sơ, theo đúng thứ tự gửi lên.
+    Trọng số (`weight_profile` hoặc `weights`) áp dụng cho cả lô;
+    `weight_profiles` (cùng thứ tự với profiles) đổi bộ trọng số của từng hồ sơ.
+    Cùng một hồ sơ gửi với nhiều bộ trọng số chỉ tính khoảng cách thành phần một lần.
+    """
+    try:
+        request_weights = resolve_weighting(request.weight_profile, request.weights)
+        profile_weights = None
+        if request.weight_profiles is not None:
+            if len(request.weight_profiles) != len(request.profiles):
+                raise HTTPException(status_code=400, detail="weight_profiles phải có cùng số phần tử với profiles")
+            profile_weights = [
+                request_weights if name is None else resolve_weighting(name, None)
+                for name in request.weight_profiles
+            ]
         
-        return schemas.MatchingResponse(
-            query_student={
-                "name": profile.name,
-                "subject": profile.tag_subject,
-                "grade": profile.grade,
-                "available_days": get_display_list(profile.tag_study_days),
-                "available_times": get_display_list(profile.tag_study_times)
-            },
-            cluster_id=query_cluster,
-            total_candidates=len(matched_results),
-            matched_partners=matched_partners,
-            message=f"✅ {len(matched_partners)} matches (Gower: 34% Subject, 35% Grade, 20% Days, 10% Times)"
+        batch_results, snapshot_version = await find_similar_batch_with_gower(
+            [profile.dict() for profile in request.profiles],
+            request.top_n,
+            request_weights,
+            profile_weights
         )
         
+        return schemas.BatchMatchingResponse(
+            snapshot_version=snapshot_version,
+            results=[
+                build_matching_response(
+                    profile, matched_results, 0,
+                    weights=profile_weights[i] if profile_weights is not None else request_weights
+                )
+                for i, (profile, matched_results) in enumerate(zip(request.profiles, batch_results))
+            ]
+        )
+    
     except HTTPException:
         raise
     except Exception as e:
         print(f"❌ [ML] Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ===== INGESTION (incremental index updates) =====
+
+@app.put("/users/{user_id}", tags=["Ingest"])
+async def upsert_user(user_id: str, profile: schemas.StudentProfile):
+    """
+    Thêm / cập nhật một học sinh trong index matching (không refetch toàn bộ)
+    
+    Body: same format as one item of backend `/users/for-matching`.
+    """
+    backend_user = {**profile.dict(), 'user_id': user_id}
+    snapshot = await snapshot_store.upsert_user(backend_user)
+    # Encoded from the request: a follower worker's snapshot still has the old row until the leader publishes
+    await cluster_index.observe(encode_profile_packed(map_backend_to_ml_format(backend_user)))
+    
+    return {
+        "status": "upserted",
+        "user_id": user_id,
+        "snapshot_version": snapshot.version,
+        "total_students": snapshot.size
+    }
+
+@app.delete("/users/{user_id}", tags=["Ingest"])
+async def delete_user(user_id: str):
+    """Xóa một học sinh khỏi index matching"""
+    snapshot = await snapshot_store.delete_user(user_id)
+    
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail=f"User {user_id} không có trong index")
+    
+    return {
+        "status": "deleted",
+        "user_id": user_id,
+        "snapshot_version": snapshot.version,
+        "total_students": snapshot.size
+    }
+
+@app.post("/users/resync", tags=["Ingest"])
+async def resync_users():
+    """Full resync from backend `/users/for-matching` (fallback)"""
+    snapshot = await snapshot_store.resync()
+    
+    return {
+        "status": "resynced",
+        "snapshot_version": snapshot.version,
+        "total_students": snapshot.size
+    }
+
 @app.get("/features", tags=["Info"])
 def get_feature_info():
     """Feature information and weights explanation"""
@@ -441,38 +1084,43 @@ def get_feature_info():
 @app.get("/stats", tags=["Info"])
 async def get_stats():
     """Statistics about users and distribution"""
-    users = await fetch_users_from_backend()
+    snapshot = await current_snapshot()
     
-    if len(users) == 0:
+    if snapshot.size == 0:
         return {"error": "No users in database"}
     
-    # Convert to ML format
-    students_data = []
-    for user in users:
-        ml_user = map_backend_to_ml_format(user)
-        students_data.append(ml_user)
-    
-    students_df = pd.DataFrame(students_data)
-    
-    # Distributions
-    subject_counts = students_df['tag_subject'].value_counts().to_dict()
-    grade_counts = students_df['grade'].value_counts().to_dict()
-    optimal_k = calculate_optimal_clusters(len(students_df))
+    # Distributions: counters maintained by the snapshot (no scan)
+    stats = snapshot.stats
+    optimal_k = calculate_optimal_clusters(stats.total)
     
     return {
-        "total_users": len(students_df),
-        "subject_distribution": subject_counts,
-        "grade_distribution": grade_counts,
+        "total_users": stats.total,
+        "snapshot_version": snapshot.version,
+        "subject_distribution": stats.distribution('subject'),
+        "grade_distribution": stats.distribution('grade'),
+        "day_distribution": stats.distribution('days'),
+        "time_distribution": stats.distribution('times'),
         "clustering": {
             "optimal_clusters": optimal_k,
-            "avg_users_per_cluster": len(students_df) / optimal_k,
+            "avg_users_per_cluster": stats.total / optimal_k,
             "strategy": "Dynamic K-Means (optional pre-filtering)"
         },
         "weights": FEATURE_WEIGHTS,
         "algorithm": "Gower Distance"
     }
 
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Info"])
+def get_metrics():
+    """Stage latency histograms + counters (Prometheus text format)"""
+    snapshot = snapshot_store.snapshot
+    if snapshot is not None:
+        metrics.SNAPSHOT_USERS.set(snapshot.size)
+        metrics.SNAPSHOT_VERSION.set(snapshot.version)
+    metrics.RESULT_CACHE_ENTRIES.set(result_cache.stats()['entries'])
+    
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/weights", tags=["Info"])
 def get_weight_explanation():
-    """Get detailed explanation of survey-based weights"""
-    return explain_weights()
+    """Get detailed explanation of survey-based weights + the named weight profiles"""
+    return {**explain_weights(), "weight_profiles": WEIGHT_PROFILES}
@@ -0,0 +1,207 @@
+# app/metrics.py - LATENCY METRICS + LOG SWITCH
+
+"""
+In-process metrics in Prometheus text format (no extra dependency)
+- Histogram: per-stage latency of /match, backend fetch, snapshot build
+- Counter: requests by source, candidates scanned, results returned
+- Gauge: snapshot / cache state, set at scrape time
+- log(): hot-path logging, switched off with MATCH_LOG=false so print I/O
+  stays out of request latency
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+MATCH_LOG = os.getenv("MATCH_LOG", "true").lower() in ("1", "true", "yes")
+
+# Seconds: 50µs … 5s (stage timings are mostly sub-millisecond)
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+
+def log(message: str):
+    """print() for per-request progress messages, unless MATCH_LOG is off"""
+    if MATCH_LOG:
+        print(message)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = ''
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+    
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonic counter (name should end in _total)"""
+    
+    kind = 'counter'
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+    
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+
+class Gauge(Counter):
+    """Current value, set rather than incremented"""
+    
+    kind = 'gauge'
+    
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram of observed values (seconds)"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], list] = {}      # key → [bucket counts..., sum, count]
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[-1] if series else 0
+    
+    def time(self, **labels) -> '_Timer':
+        """Context manager observing the elapsed time of its block"""
+        return _Timer(self, labels)
+    
+    def stopwatch(self, **labels) -> 'Stopwatch':
+        """Stopwatch observing consecutive stages (label `stage` per lap)"""
+        return Stopwatch(self, labels)
+    
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                bucket_labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series[-2]:.9g}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Stopwatch:
+    """lap(stage) observes the time since the previous lap (or creation)"""
+    
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = self.last = time.perf_counter()
+    
+    def lap(self, stage: str) -> float:
+        now = time.perf_counter()
+        elapsed, self.last = now - self.last, now
+        self.histogram.observe(elapsed, stage=stage, **self.labels)
+        return elapsed
+    
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+
+REGISTRY: List[_Metric] = []
+
+# ===== SERVICE METRICS =====
+MATCH_STAGE_SECONDS = Histogram(
+    'gower_match_stage_seconds', 'Latency of each /match stage',
+    labelnames=('stage',)
+)
+MATCH_SECONDS = Histogram(
+    'gower_match_seconds', 'End-to-end ranking latency per request',
+    labelnames=('endpoint',)
+)
+BACKEND_FETCH_SECONDS = Histogram(
+    'gower_backend_fetch_seconds', 'Latency of fetching all users from the backend'
+)
+SNAPSHOT_BUILD_SECONDS = Histogram(
+    'gower_snapshot_build_seconds', 'Latency of mapping + encoding a fetched user list'
+)
+MATCH_REQUESTS = Counter(
+    'gower_match_requests_total', 'Ranked queries by result source (ranked, cache, graph, page, stream)',
+    labelnames=('source',)
+)
+CANDIDATES_SCANNED = Counter(
+    'gower_match_candidates_scanned_total', 'Candidates considered by live ranking'
+)
+RESULTS_RETURNED = Counter(
+    'gower_match_results_returned_total', 'Matches returned'
+)
+SNAPSHOT_USERS = Gauge('gower_snapshot_users', 'Users in the current snapshot')
+SNAPSHOT_VERSION = Gauge('gower_snapshot_version', 'Version of the current snapshot')
+RESULT_CACHE_ENTRIES = Gauge('gower_result_cache_entries', 'Entries in the /match result cache')
+
+
+def render_metrics() -> str:
+    """Every registered metric in Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,57 @@
+# app/pagination.py - /match CURSORS
+
+"""
+Opaque cursors for paging through one /match ranking
+- A cursor names (data version, packed query profile, offset, ranking tag,
+  cluster model); it is only valid for the same profile, weighting and
+  filter while the query's subject and the cluster model are unchanged
+  (result_cache.data_version, ProfileClusterModel.identity)
+- Pages after the first are sliced from the full bucket-level ranking
+  (gower_matching.rank_bucket_order), cached per snapshot in the ResultCache,
+  so page p costs O(page size) instead of a re-rank
+"""
+
+import base64
+import json
+import zlib
+from typing import Dict, Optional, Tuple
+
+
+def ranking_tag(weights: Optional[Dict[str, float]] = None, filter_key: Optional[tuple] = None) -> int:
+    """Short id of a per-request weighting + filter for cursors (0 = default weights, no filter)"""
+    if weights is None and filter_key is None:
+        return 0
+    key = (sorted(weights.items()) if weights is not None else None, filter_key)
+    return zlib.crc32(repr(key).encode('utf-8')) | 1
+
+
+def encode_cursor(version: int, query_code: int, offset: int, tag: int = 0, cluster: int = 0) -> str:
+    """URL-safe cursor for the page starting at `offset` (cluster: model identity, 0 = unclustered)"""
+    fields = [int(version), int(query_code), int(offset)]
+    if tag or cluster:
+        fields += [int(tag)] + ([int(cluster)] if cluster else [])
+    payload = json.dumps(fields, separators=(',', ':')).encode('ascii')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int, int, int, int]:
+    """
+    Parse a cursor from encode_cursor()
+    
+    Returns:
+        (data_version, query_code, offset, tag, cluster)
+    
+    Raises:
+        ValueError: malformed cursor
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        version, query_code, offset, *rest = json.loads(payload)
+        tag, cluster = (rest + [0, 0])[:2] if len(rest) <= 2 else None
+    except Exception:
+        raise ValueError(f"Malformed cursor: {cursor!r}")
+    
+    if not all(isinstance(value, int) for value in (version, query_code, offset, tag, cluster)) or offset < 0:
+        raise ValueError(f"Malformed cursor: {cursor!r}")
+    
+    return version, query_code, offset, tag, cluster
@@ -0,0 +1,87 @@
+# app/population.py - POPULATION STATISTICS
+
+"""
+Subject / grade / day / time distribution counters of one UserSnapshot
+- Counted once when a snapshot is built, then adjusted by every upsert and
+  delete, so /stats and / read them in O(1) instead of scanning the users
+- Keys are the mapped field values (what /stats used to value_count):
+  subject code, grade string, day / time codes
+- Stored in the snapshot file header (app/snapshot_file.py), so a mapped
+  snapshot has them without decoding any row
+"""
+
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+# Counter name → mapped field it counts
+STAT_FIELDS = {
+    'subject': 'tag_subject',
+    'grade': 'grade',
+    'days': 'tag_study_days',
+    'times': 'tag_study_times',
+}
+
+# Fields holding a list of options: each user counts once per distinct option
+LIST_FIELDS = ('tag_study_days', 'tag_study_times')
+
+
+class PopulationStats:
+    """Distribution counters over the users of one snapshot"""
+    
+    def __init__(self, total: int = 0, counters: Optional[Dict[str, Dict]] = None):
+        self.total = total
+        self.counters = {name: Counter((counters or {}).get(name, {})) for name in STAT_FIELDS}
+    
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Iterable], size: int) -> 'PopulationStats':
+        """Count every user of STUDENT_COLUMNS-style columns (first `size` rows)"""
+        stats = cls(total=size)
+        for name, field in STAT_FIELDS.items():
+            values = columns[field][:size]
+            counter = stats.counters[name]
+            if field in LIST_FIELDS:
+                # Each distinct list object once (bulk-encoded rows share interned lists)
+                per_object = Counter(map(id, values))
+                objects = dict(zip(map(id, values), values))
+                for key, count in per_object.items():
+                    for option in set(objects[key] or ()):
+                        counter[option] += count
+            else:
+                counter.update(values)
+                counter.pop(None, None)
+        return stats
+    
+    def _update(self, student: Dict, delta: int):
+        self.total += delta
+        for name, field in STAT_FIELDS.items():
+            value = student.get(field)
+            if value is None:
+                continue
+            counter = self.counters[name]
+            for key in (set(value) if field in LIST_FIELDS else (value,)):
+                counter[key] += delta
+                if counter[key] <= 0:
+                    del counter[key]
+    
+    def add(self, student: Dict):
+        """Count one mapped user"""
+        self._update(student, 1)
+    
+    def remove(self, student: Dict):
+        """Uncount one mapped user (as it was counted by add())"""
+        self._update(student, -1)
+    
+    def distribution(self, name: str) -> Dict:
+        """One counter, most common first"""
+        return dict(self.counters[name].most_common())
+    
+    def copy(self) -> 'PopulationStats':
+        return PopulationStats(self.total, self.counters)
+    
+    def to_dict(self) -> Dict:
+        """JSON-serializable form (snapshot file header)"""
+        return {'total': self.total, 'counters': {name: dict(counter) for name, counter in self.counters.items()}}
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'PopulationStats':
+        return cls(data['total'], data['counters'])
@@ -0,0 +1,92 @@
+# app/result_cache.py - MATCH RESULT CACHE
+
+"""
+Bounded LRU + TTL cache of ranked match results
+- Key: packed query profile + result count (identical profiles rank identically)
+- Scoped to one snapshot build: the first lookup against a rebuilt snapshot
+  drops every entry. Within a build, an entry for a subject stays valid until
+  that subject's partition changes (SubjectPartition.version), so an upsert
+  only invalidates the queries of the subjects it touched
+- Hit / miss / eviction counters for /stats and monitoring
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+MATCH_CACHE_SIZE = int(os.getenv("MATCH_CACHE_SIZE", "4096"))
+MATCH_CACHE_TTL_SECONDS = float(os.getenv("MATCH_CACHE_TTL_SECONDS", "300"))
+
+
+def data_version(snapshot, subject: Optional[str] = None) -> int:
+    """Version of the data a subject's results depend on (the snapshot version without a subject)"""
+    partition = snapshot.partitions.get(subject) if subject is not None else None
+    return snapshot.version if partition is None else partition.version
+
+
+class ResultCache:
+    """LRU (max_entries) + TTL cache, invalidated when the snapshot changes"""
+    
+    def __init__(self, max_entries: int = MATCH_CACHE_SIZE, ttl_seconds: float = MATCH_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._scope: Optional[float] = None
+    
+    def _check_scope(self, snapshot):
+        """Drop everything once the snapshot has been rebuilt"""
+        if snapshot.built_at != self._scope:
+            self._entries.clear()
+            self._scope = snapshot.built_at
+    
+    def get(self, snapshot, key: Hashable, subject: Optional[str] = None) -> Optional[Any]:
+        """Cached value (None if missing, expired, or its subject / snapshot changed since put)"""
+        self._check_scope(snapshot)
+        
+        entry = self._entries.get(key)
+        stale = entry is not None and (
+            (self.ttl_seconds > 0 and time.monotonic() - entry[0] > self.ttl_seconds)
+            or entry[1] != data_version(snapshot, subject)
+        )
+        if entry is None or stale:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+    
+    def put(self, snapshot, key: Hashable, value: Any, subject: Optional[str] = None):
+        """Cache a value computed from `subject`'s partition (None: from the whole snapshot)"""
+        if self.max_entries <= 0:
+            return
+        
+        self._check_scope(snapshot)
+        self._entries[key] = (time.monotonic(), data_version(snapshot, subject), value)
+        self._entries.move_to_end(key)
+        
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def clear(self):
+        self._entries.clear()
+        self._scope = None
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -51,10 +51,34 @@ class MatchedPartner(BaseModel):
     phone: Optional[str] = Field(None, example="0987654321", description="Số điện thoại")
 
 
+class FilterCount(BaseModel):
+    """Số ứng viên còn lại sau một điều kiện lọc"""
+    filter: str = Field(..., example="grade_within=1", description="Điều kiện (dạng chuẩn hoá)")
+    candidates: int = Field(..., example=42, description="Số ứng viên còn lại")
+
+
 class MatchingResponse(BaseModel):
     """Kết quả tìm kiếm bạn học"""
     query_student: Dict[str, Any] = Field(..., description="Thông tin học sinh đang tìm kiếm")
     cluster_id: int = Field(..., example=3, description="Cluster ID mà query student được gán vào")
     total_candidates: int = Field(..., example=15, description="Số học sinh trong cùng cluster")
     matched_partners: List[MatchedPartner] = Field(..., description="Danh sách bạn học phù hợp")
+    next_cursor: Optional[str] = Field(None, example="WzQyLDI4NjcsMTBd", description="Cursor của trang kết quả tiếp theo (null = hết)")
+    filter_counts: Optional[List[FilterCount]] = Field(None, description="Số ứng viên còn lại sau từng điều kiện lọc (null = không lọc)")
     message: str = Field(..., example="Tìm thấy 5 bạn học phù hợp trong cluster 3!", description="Thông báo")
+
+
+# ===== BATCH SCHEMA =====
+class BatchMatchRequest(BaseModel):
+    """Nhiều hồ sơ cần tìm bạn học trong một lần gọi"""
+    profiles: List[StudentProfile] = Field(..., description="Danh sách hồ sơ cần tìm bạn học")
+    top_n: int = Field(5, ge=1, example=15, description="Số kết quả cho mỗi hồ sơ (tối đa 100)")
+    weight_profile: Optional[str] = Field(None, example="schedule_first", description="Bộ trọng số có tên (xem /weights)")
+    weights: Optional[Dict[str, float]] = Field(None, example={"subject": 0.4, "grade": 0.3, "days": 0.2, "times": 0.1}, description="Trọng số riêng cho cả lô (không âm, tổng ≤ 1)")
+    weight_profiles: Optional[List[Optional[str]]] = Field(None, example=[None, "schedule_first"], description="Bộ trọng số có tên cho từng hồ sơ, cùng thứ tự với profiles (null = trọng số của cả lô)")
+
+
+class BatchMatchingResponse(BaseModel):
+    """Kết quả tìm kiếm cho từng hồ sơ, cùng thứ tự với request"""
+    snapshot_version: int = Field(..., example=42, description="Phiên bản snapshot học sinh đã dùng")
+    results: List[MatchingResponse] = Field(..., description="Kết quả cho từng hồ sơ")
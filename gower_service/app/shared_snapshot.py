@@ -0,0 +1,268 @@
+# app/shared_snapshot.py - SNAPSHOT SHARED BY ALL WORKER PROCESSES
+
+"""
+One encoded snapshot per host, shared by every uvicorn worker
+- Leader: the worker holding the fcntl lock on <dir>/leader.lock. Only it
+  fetches from the backend, encodes, and publishes <dir>/snapshot.bin
+  (atomic rename, format in app/snapshot_file.py)
+- Followers: np.memmap the published file read-only and swap to a newer one
+  when its inode changes (one stat() per request), so memory stays flat as
+  workers are added
+- Ingest received by a follower is appended to <dir>/journal.ndjson; the
+  leader replays it into its own snapshot and republishes at most once per
+  SHARED_PUBLISH_INTERVAL, after which every worker serves the change
+- When the leader exits, the kernel drops its lock and the next follower to
+  poll takes over (refetch, then publish)
+
+Use a tmpfs directory (e.g. /dev/shm/gower) so the file never touches disk.
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .snapshot import (
+    EncodeUsers,
+    SnapshotStore,
+    UserSnapshot,
+    SNAPSHOT_TTL_SECONDS,
+    build_user_snapshot,
+)
+from .snapshot_file import load_snapshot_file, save_snapshot_file
+
+SHARED_SNAPSHOT_DIR = os.getenv("SHARED_SNAPSHOT_DIR")
+SHARED_PUBLISH_INTERVAL = float(os.getenv("SHARED_PUBLISH_INTERVAL", "1"))
+
+# Followers starting before the leader's first publish wait this long at most
+PUBLISH_WAIT_SECONDS = 10.0
+
+SNAPSHOT_FILE = 'snapshot.bin'
+JOURNAL_FILE = 'journal.ndjson'
+LEADER_LOCK_FILE = 'leader.lock'
+
+
+class SharedSnapshotStore(SnapshotStore):
+    """
+    SnapshotStore whose snapshot is built by one worker and mapped by the rest
+    
+    Same interface as SnapshotStore. On followers, upsert/delete/resync are
+    queued for the leader and return the current (unchanged) snapshot.
+    """
+    
+    def __init__(
+        self,
+        directory: str,
+        fetch_users: Callable[[], Awaitable[List[Dict]]],
+        map_user: Callable[[Dict], Dict],
+        ttl_seconds: float = SNAPSHOT_TTL_SECONDS,
+        publish_interval: float = SHARED_PUBLISH_INTERVAL,
+        encode_users: Optional[EncodeUsers] = None,
+    ):
+        super().__init__(fetch_users, map_user, ttl_seconds, encode_users=encode_users)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.published_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.publish_interval = publish_interval
+        self.is_leader = False
+        self._started = False
+        self._lock_fd: Optional[int] = None
+        self._attached: Optional[tuple] = None          # (inode, mtime) of the mapped file
+        self._published_version: Optional[int] = None
+        self._publish_lock = asyncio.Lock()
+        self._sync_task: Optional[asyncio.Task] = None
+    
+    # ===== LEADERSHIP =====
+    
+    def try_lead(self) -> bool:
+        """Take the host-wide leader lock if nobody holds it (non-blocking)"""
+        if self.is_leader:
+            return True
+        
+        fd = os.open(os.path.join(self.directory, LEADER_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        
+        self._lock_fd = fd
+        self.is_leader = True
+        if self._snapshot is not None:
+            # Keep serving the mapped data until our own refetch completes
+            self._version = max(self._version, self._snapshot.version)
+        self._last_attempt = 0.0
+        print(f"👑 [Shared] Worker {os.getpid()} is the snapshot leader")
+        return True
+    
+    def close(self):
+        """Stop the sync loop and release leadership"""
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        self.is_leader = False
+        self._started = False
+    
+    def _ensure_started(self):
+        if not self._started:
+            self._started = True
+            self.try_lead()
+        if self.publish_interval > 0 and (self._sync_task is None or self._sync_task.done()):
+            self._sync_task = asyncio.create_task(self._sync_loop())
+    
+    # ===== FOLLOWER: ATTACH =====
+    
+    def _attach_latest(self) -> Optional[UserSnapshot]:
+        """Map the published file if it was replaced since the last attach"""
+        try:
+            stat = os.stat(self.published_path)
+        except FileNotFoundError:
+            return self._snapshot
+        
+        key = (stat.st_ino, stat.st_mtime_ns)
+        if key != self._attached:
+            snapshot = load_snapshot_file(self.published_path)
+            self._snapshot, self._attached = snapshot, key
+            self._version = max(self._version, snapshot.version)
+            self._last_attempt = time.monotonic()
+            print(f"🔗 [Shared] Attached v{snapshot.version} ({snapshot.size} users)")
+        
+        return self._snapshot
+    
+    async def _wait_for_publish(self) -> UserSnapshot:
+        """Cold start on a follower: wait for the leader's first publish (or take over)"""
+        deadline = time.monotonic() + PUBLISH_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            if self.try_lead():
+                return await self.refresh()
+            snapshot = self._attach_latest()
+            if snapshot is not None:
+                return snapshot
+        
+        print(f"⚠️ [Shared] No snapshot published after {PUBLISH_WAIT_SECONDS:.0f}s")
+        return build_user_snapshot([], self._map_user, 0)
+    
+    # ===== LEADER: PUBLISH + JOURNAL =====
+    
+    async def publish(self, snapshot: UserSnapshot):
+        """Write the snapshot file for the followers (no-op if already published)"""
+        async with self._publish_lock:
+            if snapshot.version == self._published_version:
+                return
+            
+            self._published_version = await save_snapshot_file(
+                self.published_path, snapshot, {'leader_pid': os.getpid()}
+            )
+            print(f"📤 [Shared] Published v{self._published_version} ({snapshot.size} users)")
+    
+    def _append_journal(self, op: Dict):
+        with open(self.journal_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(op) + '\n')
+    
+    def _take_journal(self) -> List[Dict]:
+        """Every queued op, removing them from the journal"""
+        try:
+            f = open(self.journal_path, 'r+')
+        except FileNotFoundError:
+            return []
+        
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            lines = f.read().splitlines()
+            f.seek(0)
+            f.truncate()
+        
+        return [json.loads(line) for line in lines if line]
+    
+    async def _apply_journal(self):
+        resync = False
+        for op in self._take_journal():
+            if op['op'] == 'upsert':
+                await super().upsert_user(op['user'])
+            elif op['op'] == 'delete':
+                await super().delete_user(op['user_id'])
+            else:
+                resync = True
+        
+        if resync:
+            await self.refresh()
+    
+    async def sync(self):
+        """
+        One maintenance step, run every publish_interval
+        
+        Followers re-attach (or take over a vacant leadership); the leader
+        applies queued ingest, refreshes when stale and republishes changes.
+        """
+        if not self.is_leader and not self.try_lead():
+            self._attach_latest()
+            return
+        
+        await self._apply_journal()
+        if self._snapshot is None or self.is_stale():
+            await self.refresh()
+        else:
+            await self.publish(self._snapshot)
+    
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.publish_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"⚠️ [Shared] Sync failed: {e}")
+    
+    # ===== SnapshotStore INTERFACE =====
+    
+    async def get(self) -> UserSnapshot:
+        self._ensure_started()
+        if self.is_leader:
+            return await super().get()
+        
+        return self._attach_latest() or await self._wait_for_publish()
+    
+    async def refresh(self) -> UserSnapshot:
+        self._ensure_started()
+        if not self.is_leader:
+            # Followers never fetch: pick up (or wait for) the leader's publish
+            return self._attach_latest() or await self._wait_for_publish()
+        
+        snapshot = await super().refresh()
+        await self.publish(snapshot)
+        return snapshot
+    
+    async def resync(self) -> UserSnapshot:
+        self._ensure_started()
+        if self.is_leader:
+            return await self.refresh()
+        
+        self._append_journal({'op': 'resync'})
+        return await self.get()
+    
+    async def upsert_user(self, backend_user: Dict) -> UserSnapshot:
+        self._ensure_started()
+        if self.is_leader:
+            return await super().upsert_user(backend_user)
+        
+        self._append_journal({'op': 'upsert', 'user': backend_user})
+        return await self.get()
+    
+    async def delete_user(self, user_id: str) -> Optional[UserSnapshot]:
+        self._ensure_started()
+        if self.is_leader:
+            return await super().delete_user(user_id)
+        
+        snapshot = await self.get()
+        if user_id not in snapshot.row_of:
+            return None
+        
+        self._append_journal({'op': 'delete', 'user_id': user_id})
+        return snapshot
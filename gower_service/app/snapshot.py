@@ -0,0 +1,822 @@
+# app/snapshot.py - USER SNAPSHOT CACHE
+
+"""
+In-memory snapshot of mapped + encoded users
+- Built once per backend fetch and shared by every request
+- Versioned: every rebuild gets a new version number
+- Stale-while-revalidate: requests always read the current snapshot; once it
+  is older than the TTL, one background refresh is started instead of blocking
+- Incremental: single-user upsert/delete update the snapshot in place (the
+  periodic full refetch remains the fallback resync)
+- Partitioned: one prebuilt block of packed codes + row ids per subject, so
+  the subject filter is a dict lookup; each partition's profile buckets and
+  school groups are patched in place by every change, never rebuilt
+- Counted: subject / grade / day / time distributions (app/population.py)
+  follow every change, for /stats and / without a scan
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .gower_matching import (
+    encode_profile_packed,
+    unpack_features,
+    build_profile_buckets,
+    bucket_members,
+    ProfileBuckets,
+    PACKED_DTYPE,
+    SUBJECT_SHIFT,
+    SUBJECTS,
+)
+from .metrics import BACKEND_FETCH_SECONDS, SNAPSHOT_BUILD_SECONDS
+from .population import PopulationStats
+
+SNAPSHOT_TTL_SECONDS = float(os.getenv("SNAPSHOT_TTL_SECONDS", "30"))
+
+# Last good snapshot on disk (app/snapshot_file.py format): loaded at boot, rewritten periodically
+SNAPSHOT_FILE_PATH = os.getenv("SNAPSHOT_FILE_PATH")
+SNAPSHOT_SAVE_INTERVAL_SECONDS = float(os.getenv("SNAPSHOT_SAVE_INTERVAL_SECONDS", "300"))
+
+
+def _grow(array: np.ndarray, n_rows: int, used: int) -> np.ndarray:
+    """Return `array` with room for n_rows (capacity doubling, first `used` rows kept)"""
+    if n_rows <= len(array):
+        return array
+    
+    grown = np.zeros((max(n_rows, 2 * len(array), 16),) + array.shape[1:], dtype=array.dtype)
+    grown[:used] = array[:used]
+    return grown
+
+
+# Initial capacity of a new / full position group (doubles on every relocation)
+GROUP_MIN_CAPACITY = 4
+
+
+class PositionGroups:
+    """
+    Partition positions grouped by a key (e.g. profile buckets by packed code),
+    maintained in place
+    
+    Gapped CSR: group g owns members[starts[g]:starts[g] + capacity[g]], the
+    first sizes[g] slots are used. Every change is amortized O(1):
+    - add(): append to the group; a full group is moved to the end of
+      `members` with twice the capacity (or grows in place if it is last)
+    - discard() / move(): swap-with-last inside the group (slot_of maps a
+      position to its slot)
+    - An emptied group is swapped with the last group, so none is ever empty
+    - Freed slots are reclaimed by one repack once they outnumber the live
+      members
+    Members stay in ascending order until a discard / move / out-of-order add.
+    """
+    
+    def __init__(self, keys: np.ndarray, starts: np.ndarray, sizes: np.ndarray, members: np.ndarray, n_positions: int):
+        """Groups over a compact CSR (e.g. from build_profile_buckets), members ascending per group"""
+        self._n = len(keys)
+        self._keys = np.array(keys)
+        self._starts = np.asarray(starts, dtype=np.int64).copy()
+        self._sizes = np.asarray(sizes, dtype=np.int64).copy()
+        self._capacity = self._sizes.copy()
+        self._group_of = {key: g for g, key in enumerate(self._keys.tolist())}
+        self.members = np.asarray(members, dtype=np.int64)
+        self._end = len(self.members)
+        self._free = 0
+        self._slot_of = np.zeros(n_positions, dtype=np.int64)
+        self._slot_of[self.members] = np.arange(len(self.members))
+        self.ordered = True
+    
+    @classmethod
+    def from_codes(cls, codes: np.ndarray) -> 'PositionGroups':
+        """Profile buckets of positions 0..n-1"""
+        buckets = build_profile_buckets(codes)
+        return cls(buckets.codes, buckets.starts, buckets.sizes, buckets.members, len(codes))
+    
+    @property
+    def buckets(self) -> ProfileBuckets:
+        """Current groups as ProfileBuckets (views, valid until the next change)"""
+        n = self._n
+        return ProfileBuckets(self._keys[:n], self._starts[:n], self._sizes[:n], self.members, self.ordered)
+    
+    def positions(self, key) -> np.ndarray:
+        """Positions in one group, ascending (empty if the key has no group)"""
+        g = self._group_of.get(key)
+        if g is None:
+            return np.zeros(0, dtype=np.int64)
+        start = self._starts[g]
+        return np.sort(self.members[start:start + self._sizes[g]])
+    
+    def _new_group(self, key) -> int:
+        g = self._n
+        self._keys = _grow(self._keys, g + 1, g)
+        self._starts = _grow(self._starts, g + 1, g)
+        self._sizes = _grow(self._sizes, g + 1, g)
+        self._capacity = _grow(self._capacity, g + 1, g)
+        self._keys[g] = key
+        self._starts[g] = self._end
+        self._sizes[g] = self._capacity[g] = 0
+        self._group_of[key] = g
+        self._n += 1
+        return g
+    
+    def _repack(self):
+        """Drop the free slots: groups back to back, capacity = size"""
+        live = self.buckets
+        self.members = bucket_members(live)
+        n = self._n
+        self._capacity[:n] = self._sizes[:n]
+        self._starts[:n] = np.cumsum(self._sizes[:n]) - self._sizes[:n]
+        self._end, self._free = len(self.members), 0
+        self._slot_of[self.members] = np.arange(len(self.members))
+    
+    def _reserve(self, n_slots: int):
+        """Room for n_slots more slots after _end"""
+        if self._free > max(self._end - self._free, GROUP_MIN_CAPACITY):
+            self._repack()
+        self.members = _grow(self.members, self._end + n_slots, self._end)
+    
+    def _enlarge(self, g: int):
+        """Double the capacity of a full group"""
+        capacity = max(GROUP_MIN_CAPACITY, 2 * int(self._capacity[g]))
+        self._reserve(capacity)
+        start, size = int(self._starts[g]), int(self._sizes[g])
+        
+        if start + self._capacity[g] == self._end:
+            # Last group: grow in place
+            self._end += capacity - int(self._capacity[g])
+        else:
+            new_start = self._end
+            self.members[new_start:new_start + size] = self.members[start:start + size]
+            self._slot_of[self.members[new_start:new_start + size]] = np.arange(new_start, new_start + size)
+            self._free += int(self._capacity[g])
+            self._starts[g] = new_start
+            self._end += capacity
+        self._capacity[g] = capacity
+    
+    def add(self, position: int, key):
+        """Put a position into the key's group (created if new)"""
+        g = self._group_of.get(key)
+        if g is None:
+            g = self._new_group(key)
+        if self._sizes[g] == self._capacity[g]:
+            self._enlarge(g)
+        
+        slot = int(self._starts[g] + self._sizes[g])
+        if self._sizes[g] > 0 and self.members[slot - 1] > position:
+            self.ordered = False
+        self.members[slot] = position
+        self._slot_of = _grow(self._slot_of, position + 1, len(self._slot_of))
+        self._slot_of[position] = slot
+        self._sizes[g] += 1
+    
+    def discard(self, position: int, key):
+        """Take a position out of the key's group"""
+        g = self._group_of[key]
+        slot = int(self._slot_of[position])
+        last = int(self._starts[g] + self._sizes[g] - 1)
+        if slot != last:
+            moved = self.members[last]
+            self.members[slot] = moved
+            self._slot_of[moved] = slot
+            self.ordered = False
+        self._sizes[g] -= 1
+        
+        if self._sizes[g] == 0:
+            # Fill the hole in the group list with the last group
+            self._free += int(self._capacity[g])
+            last_group = self._n - 1
+            if g != last_group:
+                for array in (self._keys, self._starts, self._sizes, self._capacity):
+                    array[g] = array[last_group]
+                self._group_of[self._keys[g:g + 1].tolist()[0]] = g
+            del self._group_of[key]
+            self._n -= 1
+    
+    def move(self, old_position: int, new_position: int):
+        """A position was renumbered (the partition's swap-with-last)"""
+        slot = int(self._slot_of[old_position])
+        self.members[slot] = new_position
+        self._slot_of[new_position] = slot
+        self.ordered = False
+
+
+class SubjectPartition:
+    """
+    All students of one subject: a contiguous packed-code block + their row ids
+    
+    Same swap-with-last layout as UserSnapshot. Profile buckets and school
+    groups (same_school filter) are built lazily on first use, then patched
+    in place by every change (PositionGroups). A read-only partition (mapped
+    snapshot file) can be given its buckets prebuilt.
+    
+    `version` is the snapshot version of the partition's last change, so
+    caches and cursors of one subject survive changes to the others.
+    """
+    
+    def __init__(self, rows: np.ndarray, codes: np.ndarray, version: int = 0, buckets: Optional[ProfileBuckets] = None):
+        self._rows = np.asarray(rows, dtype=np.int64)
+        self._codes = np.asarray(codes, dtype=PACKED_DTYPE)
+        self.size = len(self._rows)
+        self.version = version
+        self._prebuilt = buckets
+        self._groups: Optional[PositionGroups] = None
+        self.schools: Optional[PositionGroups] = None
+    
+    @property
+    def rows(self) -> np.ndarray:
+        """(n,) snapshot row ids"""
+        return self._rows[:self.size]
+    
+    @property
+    def codes(self) -> np.ndarray:
+        """(n,) packed profile codes (contiguous)"""
+        return self._codes[:self.size]
+    
+    @property
+    def buckets(self) -> ProfileBuckets:
+        """Profile buckets over partition positions"""
+        if self._prebuilt is not None:
+            return self._prebuilt
+        if self._groups is None:
+            self._groups = PositionGroups.from_codes(self.codes)
+        return self._groups.buckets
+    
+    def append(self, row: int, code: int, school: str = '') -> int:
+        """Add a student (school: normalize_school() key), returns its position"""
+        position = self.size
+        self._rows = _grow(self._rows, position + 1, self.size)
+        self._codes = _grow(self._codes, position + 1, self.size)
+        self._rows[position] = row
+        self._codes[position] = code
+        self.size += 1
+        if self._groups is not None:
+            self._groups.add(position, int(code))
+        if self.schools is not None:
+            self.schools.add(position, school)
+        return position
+    
+    def remove(self, position: int, school: str = '') -> Optional[int]:
+        """
+        Remove the student at `position` (swap-with-last)
+        
+        Returns:
+            Row id of the student moved into `position`, or None
+        """
+        self.size -= 1
+        for groups, key in ((self._groups, int(self._codes[position])), (self.schools, school)):
+            if groups is not None:
+                groups.discard(position, key)
+        
+        if position == self.size:
+            return None
+        
+        self._rows[position] = self._rows[self.size]
+        self._codes[position] = self._codes[self.size]
+        for groups in (self._groups, self.schools):
+            if groups is not None:
+                groups.move(self.size, position)
+        return int(self._rows[position])
+    
+    def set_code(self, position: int, code: int):
+        if self._groups is not None:
+            self._groups.discard(position, int(self._codes[position]))
+            self._groups.add(position, int(code))
+        self._codes[position] = code
+    
+    def set_school(self, position: int, old_school: str, school: str):
+        if self.schools is not None and school != old_school:
+            self.schools.discard(position, old_school)
+            self.schools.add(position, school)
+    
+    def set_row(self, position: int, row: int):
+        self._rows[position] = row
+
+
+def normalize_school(school) -> str:
+    """Comparison key of a school name (case / surrounding spaces ignored)"""
+    return str(school).strip().casefold() if school else ''
+
+
+def build_school_groups(schools: List) -> PositionGroups:
+    """School groups (normalize_school keys) of positions 0..n-1, from their raw school values"""
+    # Factorize the raw values (hashing only), then normalize each distinct one
+    raw_ids: Dict = {}
+    ids = np.fromiter(map(lambda school: raw_ids.setdefault(school, len(raw_ids)), schools), dtype=np.int64, count=len(schools))
+    names: Dict[str, int] = {}
+    to_name = np.array([names.setdefault(normalize_school(raw), len(names)) for raw in raw_ids], dtype=np.int64)
+    school_ids = to_name[ids]
+    
+    order = np.argsort(school_ids, kind='stable')
+    sizes = np.bincount(school_ids, minlength=len(names))
+    keys = np.empty(len(names), dtype=object)
+    keys[:] = list(names)
+    return PositionGroups(keys, np.cumsum(sizes) - sizes, sizes, order, len(schools))
+
+
+# Mapped user fields stored as columns (map_backend_to_ml_format keys)
+STUDENT_COLUMNS = (
+    'student_id', 'name', 'email', 'school', 'grade', 'bio',
+    'tag_subject', 'tag_study_days', 'tag_study_times',
+)
+
+
+# Bulk backend users → (STUDENT_COLUMNS columns, packed codes)
+EncodeUsers = Callable[[List[Dict]], Tuple[Dict[str, np.ndarray], np.ndarray]]
+
+
+def profile_fingerprint(codes: np.ndarray) -> str:
+    """Digest of the profile code counts (same users in any row order = same fingerprint)"""
+    counts = np.bincount(np.asarray(codes, dtype=np.int64), minlength=1 << 16)
+    return hashlib.blake2b(counts.tobytes(), digest_size=8).hexdigest()
+
+
+def _object_column(values: List) -> np.ndarray:
+    """1-D object array (lists stay list elements, never a 2-D block)"""
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+class UserSnapshot:
+    """
+    Mapped + encoded users for one backend fetch, indexed by user_id
+    
+    Struct-of-arrays: one object column per mapped field (STUDENT_COLUMNS)
+    plus the (N,) packed profile codes, so results are built with one
+    fancy-index gather per column. Rows live in growable arrays so
+    single-user upsert/delete are amortized O(1): appends double the
+    capacity when full, and a delete moves the last row into the freed slot.
+    Every subject in SUBJECTS has a prebuilt SubjectPartition that is kept in
+    sync with the rows.
+    
+    A snapshot given a prebuilt `row_of` index (a mapped snapshot file, see
+    app/snapshot_file.py) is read-only: upsert/delete raise. It may also be
+    given its partitions prebuilt (rows, codes and buckets as views of the
+    file), so loading it builds no per-subject arrays.
+    
+    `stats` (PopulationStats) is counted from the columns unless given, and
+    adjusted by every upsert/delete.
+    
+    Setting `version` (SnapshotStore does after every change) also stamps the
+    partitions changed since the previous version.
+    
+    `content_version` fingerprints the profiles the snapshot was built (or
+    loaded) with and is kept by upsert/delete and writable_copy(): models
+    trained on it (app/clustering.py) follow single-user changes themselves.
+    """
+    
+    def __init__(
+        self,
+        version: int,
+        columns: Dict[str, np.ndarray],
+        codes: np.ndarray,
+        row_of=None,
+        partitions: Optional[Dict[str, SubjectPartition]] = None,
+        stats: Optional[PopulationStats] = None,
+        content_version: Optional[str] = None
+    ):
+        self._version = version
+        self._touched: List[SubjectPartition] = []
+        self._columns = {name: columns[name] for name in STUDENT_COLUMNS}
+        self._codes = np.asarray(codes, dtype=PACKED_DTYPE)
+        self.size = len(self._codes)
+        self.read_only = row_of is not None
+        if row_of is None:
+            row_of = dict(zip(self._columns['student_id'][:self.size].tolist(), range(self.size)))
+        self.row_of = row_of
+        self.built_at = time.monotonic()
+        self.content_version = content_version or profile_fingerprint(self._codes)
+        self._stats = stats
+        
+        # Subject partitions + position of every row inside its partition
+        # (positions are only needed to apply changes)
+        self._partition_pos = None if self.read_only else np.full(self.size, -1, dtype=np.int64)
+        if partitions is None:
+            subject_idx = self.codes >> SUBJECT_SHIFT
+            partitions = {}
+            for idx, subject in enumerate(SUBJECTS):
+                rows = np.flatnonzero(subject_idx == idx)
+                partitions[subject] = SubjectPartition(rows, self.codes[rows], version)
+        
+        self.partitions: Dict[str, SubjectPartition] = dict(partitions)
+        if self._partition_pos is not None:
+            for partition in self.partitions.values():
+                self._partition_pos[partition.rows] = np.arange(partition.size)
+    
+    @property
+    def version(self) -> int:
+        return self._version
+    
+    @version.setter
+    def version(self, version: int):
+        self._version = version
+        for partition in self._touched:
+            partition.version = version
+        self._touched = []
+    
+    @property
+    def codes(self) -> np.ndarray:
+        """(N,) packed profile codes"""
+        return self._codes[:self.size]
+    
+    @property
+    def stats(self) -> PopulationStats:
+        """Distribution counters (counted on first use when not given)"""
+        if self._stats is None:
+            self._stats = PopulationStats.from_columns(self._columns, self.size)
+        return self._stats
+    
+    @property
+    def features(self) -> np.ndarray:
+        """(N, 18) Gower features, unpacked on demand (clustering only)"""
+        return unpack_features(self.codes)
+    
+    def column(self, name: str) -> np.ndarray:
+        """(N,) object column of one mapped field"""
+        return self._columns[name][:self.size]
+    
+    def gather(self, rows: np.ndarray) -> Dict[str, List]:
+        """Selected rows of every column (one gather per column)"""
+        return {name: column[rows].tolist() for name, column in self._columns.items()}
+    
+    def student(self, row: int) -> Dict:
+        """One row as a mapped-user dict"""
+        return {name: column[row] for name, column in self._columns.items()}
+    
+    def school_positions(self, subject: str, school) -> np.ndarray:
+        """Partition positions of the subject's students at `school` (ascending)"""
+        partition = self.partitions[subject]
+        if partition.schools is None:
+            partition.schools = build_school_groups(self.column('school')[partition.rows].tolist())
+        return partition.schools.positions(normalize_school(school))
+    
+    def _school_of(self, row: int) -> str:
+        return normalize_school(self._columns['school'][row])
+    
+    def _partition_of(self, row: int) -> Optional[SubjectPartition]:
+        subject_idx = int(self._codes[row]) >> SUBJECT_SHIFT
+        if subject_idx >= len(SUBJECTS):
+            return None
+        return self.partitions[SUBJECTS[subject_idx]]
+    
+    def _unlink(self, row: int):
+        """Remove a row from its subject partition"""
+        partition = self._partition_of(row)
+        if partition is None:
+            return
+        
+        position = int(self._partition_pos[row])
+        moved = partition.remove(position, self._school_of(row))
+        self._touched.append(partition)
+        if moved is not None:
+            self._partition_pos[moved] = position
+        self._partition_pos[row] = -1
+    
+    def _link(self, row: int):
+        """Add a row to its subject partition"""
+        partition = self._partition_of(row)
+        if partition is not None:
+            self._partition_pos[row] = partition.append(row, int(self._codes[row]), self._school_of(row))
+            self._touched.append(partition)
+    
+    def _write_row(self, row: int, ml_user: Dict):
+        for name, column in self._columns.items():
+            column[row] = ml_user.get(name)
+    
+    def upsert(self, ml_user: Dict, code: int) -> int:
+        """
+        Insert or replace one user
+        
+        Args:
+            ml_user: Mapped user (map_backend_to_ml_format output)
+            code: Packed profile code for that user
+        
+        Returns:
+            Row index of the user
+        """
+        if self.read_only:
+            raise RuntimeError("Snapshot is read-only")
+        
+        user_id = ml_user['student_id']
+        row = self.row_of.get(user_id)
+        code = int(code)
+        stats = self.stats      # counted before the rows change
+        
+        if row is None:
+            row = self.size
+            for name, column in self._columns.items():
+                self._columns[name] = _grow(column, row + 1, self.size)
+            self._codes = _grow(self._codes, row + 1, self.size)
+            self._partition_pos = _grow(self._partition_pos, row + 1, self.size)
+            self.size += 1
+            self.row_of[user_id] = row
+        elif int(self._codes[row]) >> SUBJECT_SHIFT == code >> SUBJECT_SHIFT:
+            # Same subject: update the partition entry in place
+            stats.remove(self.student(row))
+            stats.add(ml_user)
+            old_school = self._school_of(row)
+            self._write_row(row, ml_user)
+            self._codes[row] = code
+            partition = self._partition_of(row)
+            if partition is not None:
+                position = int(self._partition_pos[row])
+                partition.set_code(position, code)
+                partition.set_school(position, old_school, self._school_of(row))
+                self._touched.append(partition)
+            return row
+        else:
+            stats.remove(self.student(row))
+            self._unlink(row)
+        
+        stats.add(ml_user)
+        self._write_row(row, ml_user)
+        self._codes[row] = code
+        self._link(row)
+        
+        return row
+    
+    def delete(self, user_id: str) -> bool:
+        """
+        Remove one user (swap-with-last)
+        
+        Returns:
+            False if the user is not in the snapshot
+        """
+        if self.read_only:
+            raise RuntimeError("Snapshot is read-only")
+        
+        row = self.row_of.pop(user_id, None)
+        if row is None:
+            return False
+        
+        self.stats.remove(self.student(row))
+        self._unlink(row)
+        
+        last = self.size - 1
+        if row != last:
+            for column in self._columns.values():
+                column[row] = column[last]
+            self._codes[row] = self._codes[last]
+            self._partition_pos[row] = self._partition_pos[last]
+            self.row_of[self._columns['student_id'][row]] = row
+            
+            partition = self._partition_of(row)
+            if partition is not None:
+                partition.set_row(int(self._partition_pos[row]), row)
+        
+        for column in self._columns.values():
+            column[last] = None
+        self.size -= 1
+        return True
+
+
+def build_user_snapshot(
+    backend_users: List[Dict],
+    map_user: Callable[[Dict], Dict],
+    version: int,
+    encode_users: Optional[EncodeUsers] = None
+) -> UserSnapshot:
+    """
+    Map and encode every backend user once
+    
+    Args:
+        backend_users: Raw users from the backend
+        map_user: Backend → ML format mapper
+        version: Snapshot version number
+        encode_users: Bulk (columns, codes) encoder for the whole list
+            (e.g. user_encoder.encode_backend_users); map_user +
+            encode_profile_packed per user when omitted
+    
+    Returns:
+        UserSnapshot
+    """
+    if encode_users is not None:
+        columns, codes = encode_users(backend_users)
+    else:
+        students = [map_user(backend_user) for backend_user in backend_users]
+        columns = {name: _object_column([student.get(name) for student in students]) for name in STUDENT_COLUMNS}
+        codes = np.fromiter((encode_profile_packed(student) for student in students), dtype=PACKED_DTYPE, count=len(students))
+    stats = PopulationStats.from_columns(columns, len(codes))
+    
+    return UserSnapshot(version, columns, codes, stats=stats)
+
+
+def writable_copy(snapshot: UserSnapshot) -> UserSnapshot:
+    """In-memory (mutable) copy of a read-only mapped snapshot (partition versions kept)"""
+    columns = {name: snapshot.column(name) for name in STUDENT_COLUMNS}
+    copy = UserSnapshot(
+        snapshot.version, columns, snapshot.codes.copy(),
+        stats=snapshot.stats.copy(), content_version=snapshot.content_version
+    )
+    for subject, partition in snapshot.partitions.items():
+        copy.partitions[subject].version = partition.version
+    return copy
+
+
+class SnapshotStore:
+    """
+    Holds the current UserSnapshot and refreshes it on a TTL
+    
+    - get(): returns immediately with the current snapshot; schedules a
+      background refresh when it is stale (only blocks on cold start or
+      while the snapshot is still empty)
+    - refresh(): single-flight fetch + rebuild; map/encode runs in a worker
+      thread so the event loop keeps serving requests
+    - upsert_user() / delete_user(): apply one change in place and bump the
+      version
+    - With a snapshot_path: the last good snapshot is written there
+      periodically (SNAPSHOT_SAVE_INTERVAL_SECONDS) and memory-mapped at boot,
+      so a restart serves immediately, even while the backend is down
+    - Multi-worker deployments use SharedSnapshotStore (app/shared_snapshot.py)
+    """
+    
+    def __init__(
+        self,
+        fetch_users: Callable[[], Awaitable[List[Dict]]],
+        map_user: Callable[[Dict], Dict],
+        ttl_seconds: float = SNAPSHOT_TTL_SECONDS,
+        snapshot_path: Optional[str] = SNAPSHOT_FILE_PATH,
+        save_interval: float = SNAPSHOT_SAVE_INTERVAL_SECONDS,
+        encode_users: Optional[EncodeUsers] = None,
+    ):
+        self._fetch_users = fetch_users
+        self._map_user = map_user
+        self._encode_users = encode_users
+        self.ttl_seconds = ttl_seconds
+        self.snapshot_path = snapshot_path
+        self.save_interval = save_interval
+        self._snapshot: Optional[UserSnapshot] = None
+        self._last_attempt = 0.0
+        self._version = 0
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        # Changes applied while a full refresh is in flight, replayed onto its result
+        self._journal: Optional[List[Tuple]] = None
+        # Persistence (snapshot_path)
+        self._saved_version: Optional[int] = None
+        self._last_save = float('-inf')
+        self._save_task: Optional[asyncio.Task] = None
+    
+    @property
+    def snapshot(self) -> Optional[UserSnapshot]:
+        return self._snapshot
+    
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._last_attempt >= self.ttl_seconds
+    
+    async def get(self) -> UserSnapshot:
+        """Current snapshot (stale-while-revalidate)"""
+        snapshot = self._snapshot
+        
+        if snapshot is None:
+            # Boot: serve the last saved snapshot while the first fetch runs
+            snapshot = self.load_saved()
+        
+        if snapshot is None or snapshot.size == 0:
+            return await self.refresh()
+        
+        if self.is_stale():
+            self.schedule_refresh()
+        self.schedule_save()
+        
+        return snapshot
+    
+    def schedule_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+    
+    def load_saved(self) -> Optional[UserSnapshot]:
+        """Map the snapshot file at snapshot_path (read-only), if there is one"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+        
+        from .snapshot_file import load_snapshot_file
+        
+        try:
+            snapshot = load_snapshot_file(self.snapshot_path)
+        except Exception as e:
+            print(f"⚠️ [Snapshot] Cannot load {self.snapshot_path}: {e}")
+            return None
+        
+        self._snapshot = snapshot
+        self._version = max(self._version, snapshot.version)
+        self._saved_version = snapshot.version
+        print(f"📂 [Snapshot] Loaded v{snapshot.version} ({snapshot.size} users) from {self.snapshot_path}")
+        return snapshot
+    
+    def schedule_save(self):
+        """Write the snapshot file in the background when it changed and the save interval has passed"""
+        snapshot = self._snapshot
+        if (
+            not self.snapshot_path
+            or snapshot is None or snapshot.size == 0
+            or snapshot.version == self._saved_version
+            or time.monotonic() - self._last_save < self.save_interval
+            or (self._save_task is not None and not self._save_task.done())
+        ):
+            return
+        
+        self._last_save = time.monotonic()
+        self._save_task = asyncio.create_task(self.save(snapshot))
+    
+    async def save(self, snapshot: UserSnapshot):
+        from .snapshot_file import save_snapshot_file
+        
+        try:
+            self._saved_version = await save_snapshot_file(self.snapshot_path, snapshot)
+            print(f"💾 [Snapshot] Saved v{self._saved_version} ({snapshot.size} users) to {self.snapshot_path}")
+        except Exception as e:
+            print(f"⚠️ [Snapshot] Save failed: {e}")
+    
+    async def resync(self) -> UserSnapshot:
+        """Explicit full resync (POST /users/resync)"""
+        return await self.refresh()
+    
+    async def refresh(self) -> UserSnapshot:
+        """Fetch users and rebuild the snapshot (single-flight)"""
+        started = time.monotonic()
+        
+        async with self._lock:
+            # Another caller refreshed while we were waiting
+            if self._snapshot is not None and self._last_attempt >= started:
+                return self._snapshot
+            
+            self._journal = []
+            try:
+                with BACKEND_FETCH_SECONDS.time():
+                    backend_users = await self._fetch_users()
+                
+                if len(backend_users) == 0 and self._snapshot is not None and self._snapshot.size > 0:
+                    # Backend down or empty response: keep serving the last good snapshot
+                    print(f"⚠️ [Snapshot] Empty fetch, keeping v{self._snapshot.version} ({self._snapshot.size} users)")
+                    self._last_attempt = time.monotonic()
+                    return self._snapshot
+                
+                with SNAPSHOT_BUILD_SECONDS.time():
+                    snapshot = await asyncio.to_thread(
+                        build_user_snapshot, backend_users, self._map_user, self._version + 1, self._encode_users
+                    )
+                
+                # Upserts/deletes that arrived during the fetch (idempotent)
+                for op in self._journal:
+                    if op[0] == 'upsert':
+                        snapshot.upsert(op[1], op[2])
+                    else:
+                        snapshot.delete(op[1])
+            finally:
+                self._journal = None
+            
+            self._bump(snapshot)
+            self._snapshot = snapshot
+            self._last_attempt = time.monotonic()
+            print(f"✅ [Snapshot] v{snapshot.version}: {snapshot.size} users encoded")
+            self.schedule_save()
+            
+            return snapshot
+    
+    async def upsert_user(self, backend_user: Dict) -> UserSnapshot:
+        """Insert or update one backend user in the current snapshot"""
+        snapshot = self._writable(await self.get())
+        
+        ml_user = self._map_user(backend_user)
+        code = encode_profile_packed(ml_user)
+        snapshot.upsert(ml_user, code)
+        self._bump(snapshot)
+        
+        if self._journal is not None:
+            self._journal.append(('upsert', ml_user, code))
+        
+        return snapshot
+    
+    async def delete_user(self, user_id: str) -> Optional[UserSnapshot]:
+        """
+        Remove one user from the current snapshot
+        
+        Returns:
+            The snapshot, or None if the user was not present
+        """
+        snapshot = await self.get()
+        
+        if self._journal is not None:
+            self._journal.append(('delete', user_id))
+        
+        if user_id not in snapshot.row_of:
+            return None
+        snapshot = self._writable(snapshot)
+        snapshot.delete(user_id)
+        self._bump(snapshot)
+        
+        return snapshot
+    
+    def _writable(self, snapshot: UserSnapshot) -> UserSnapshot:
+        """The snapshot to apply a change to (a mapped one is copied into memory once)"""
+        if snapshot.read_only:
+            snapshot = writable_copy(snapshot)
+            if self._snapshot is not None and self._snapshot.read_only:
+                self._snapshot = snapshot
+        return snapshot
+    
+    def _bump(self, snapshot: UserSnapshot):
+        self._version += 1
+        snapshot.version = self._version
@@ -0,0 +1,324 @@
+# app/snapshot_file.py - BINARY SNAPSHOT FILE
+
+"""
+One UserSnapshot as a single memory-mappable file
+- Layout: magic, header length, JSON header, then 64-byte aligned arrays
+  (the header maps array name → offset / dtype / shape)
+- codes: (N,) uint16 packed profiles
+- Every STUDENT_COLUMNS field: int64 offsets into a UTF-8 blob + a null
+  flag per row (list fields are joined with LIST_SEPARATOR)
+- id index: student ids as fixed-width bytes, sorted, + their rows, so
+  user_id → row is a binary search instead of a per-process dict
+- Subject partitions: rows grouped by subject (in the writer's partition
+  order, so ranking ties break alike in every worker) + offsets per SUBJECTS
+  entry, their codes in that order, and each partition's profile buckets (CSR over
+  partition positions), so every process mapping the file serves /match
+  from views: no scan of the codes, no per-process bucket arrays
+- Each partition's version and the snapshot's content_version in the JSON
+  header, so every worker mapping the file keys caches and cursors exactly
+  like the writer (app/result_cache.py data_version)
+- Population stats (app/population.py) in the JSON header, so /stats needs
+  no scan of the columns either
+- Written to a temp file and os.replace()d: readers see the old or the new
+  file, never a partial one. Readers np.memmap it read-only, so every
+  process mapping the same file shares the same page-cache pages.
+"""
+
+import asyncio
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .gower_matching import PACKED_DTYPE, SUBJECT_SHIFT, SUBJECTS, ProfileBuckets, build_profile_buckets
+from .population import PopulationStats
+from .snapshot import STUDENT_COLUMNS, SubjectPartition, UserSnapshot, _object_column, profile_fingerprint
+
+MAGIC = b'GWRSNAP1'
+FORMAT_VERSION = 4
+ALIGN = 64
+
+# Mapped fields holding lists of option codes
+LIST_COLUMNS = ('tag_study_days', 'tag_study_times')
+LIST_SEPARATOR = '\x1f'
+
+
+class StringColumn:
+    """
+    Read-only column of strings (or string lists) over an offsets + UTF-8 blob
+    
+    Rows are decoded on access: an int gives one value, a row array or slice
+    gives an object ndarray (same contract as the in-memory object columns).
+    """
+    
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray, nulls: np.ndarray, is_list: bool = False):
+        self._offsets = offsets
+        self._blob = memoryview(blob)
+        self._nulls = nulls
+        self._is_list = is_list
+    
+    def __len__(self) -> int:
+        return len(self._nulls)
+    
+    def raw(self, row: int) -> bytes:
+        return bytes(self._blob[self._offsets[row]:self._offsets[row + 1]])
+    
+    def _decode(self, starts: List[int], ends: List[int], nulls: List[bool]) -> List:
+        blob = self._blob
+        values = [None if null else str(blob[start:end], 'utf-8') for start, end, null in zip(starts, ends, nulls)]
+        if self._is_list:
+            values = [value if value is None else (value.split(LIST_SEPARATOR) if value else []) for value in values]
+        return values
+    
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            row = int(index)
+            return self._decode([self._offsets[row]], [self._offsets[row + 1]], [self._nulls[row]])[0]
+        
+        rows = np.arange(len(self))[index] if isinstance(index, slice) else np.asarray(index, dtype=np.int64)
+        starts = self._offsets[rows].tolist()
+        ends = self._offsets[rows + 1].tolist()
+        return _object_column(self._decode(starts, ends, self._nulls[rows].tolist()))
+
+
+class IdIndex:
+    """user_id → row lookup (dict-like, read-only) by binary search over sorted ids"""
+    
+    def __init__(self, sorted_ids: np.ndarray, rows: np.ndarray):
+        self._sorted_ids = sorted_ids
+        self._rows = rows
+    
+    def __len__(self) -> int:
+        return len(self._rows)
+    
+    def get(self, user_id: str, default=None):
+        key = str(user_id).encode('utf-8')
+        if len(key) > self._sorted_ids.dtype.itemsize or len(self._rows) == 0:
+            return default
+        
+        position = int(np.searchsorted(self._sorted_ids, key))
+        if position < len(self._rows) and self._sorted_ids[position] == key:
+            return int(self._rows[position])
+        return default
+    
+    def __getitem__(self, user_id: str) -> int:
+        row = self.get(user_id)
+        if row is None:
+            raise KeyError(user_id)
+        return row
+    
+    def __contains__(self, user_id: str) -> bool:
+        return self.get(user_id) is not None
+
+
+def _encode_column(values: Sequence, is_list: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(offsets, blob, nulls) of one column"""
+    nulls = np.fromiter((value is None for value in values), dtype=np.bool_, count=len(values))
+    if is_list:
+        encoded = [b'' if value is None else LIST_SEPARATOR.join(value).encode('utf-8') for value in values]
+    else:
+        encoded = [b'' if value is None else str(value).encode('utf-8') for value in values]
+    
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, blob, nulls
+
+
+def snapshot_arrays(columns: Dict[str, Sequence], codes: np.ndarray,
+                    partition_rows: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, np.ndarray]:
+    """Every array stored in the file, by name (partition_rows: SubjectPartition.rows per subject)"""
+    codes = np.asarray(codes, dtype=PACKED_DTYPE)
+    arrays = {'codes': codes}
+    
+    for name in STUDENT_COLUMNS:
+        offsets, blob, nulls = _encode_column(columns[name][:len(codes)], name in LIST_COLUMNS)
+        arrays[f'{name}.offsets'] = offsets
+        arrays[f'{name}.blob'] = blob
+        arrays[f'{name}.nulls'] = nulls
+    
+    # Fixed-width byte ids: searchsorted needs a sortable dtype
+    ids = np.array([str(user_id).encode('utf-8') for user_id in columns['student_id'][:len(codes)]], dtype=np.bytes_)
+    order = np.argsort(ids, kind='stable')
+    arrays['id_index.sorted_ids'] = ids[order]
+    arrays['id_index.rows'] = order.astype(np.int64)
+    
+    # Rows of each subject in the writer's partition order (positions break
+    # ranking ties), else ascending as UserSnapshot builds them
+    if partition_rows is not None:
+        rows = [np.asarray(partition_rows[subject], dtype=np.int64) for subject in SUBJECTS]
+        arrays['partitions.rows'] = np.concatenate(rows)
+        arrays['partitions.offsets'] = np.concatenate([[0], np.cumsum([len(r) for r in rows])]).astype(np.int64)
+    else:
+        subject_idx = codes >> SUBJECT_SHIFT
+        arrays['partitions.rows'] = np.argsort(subject_idx, kind='stable').astype(np.int64)
+        arrays['partitions.offsets'] = np.searchsorted(
+            subject_idx[arrays['partitions.rows']], np.arange(len(SUBJECTS) + 1)
+        ).astype(np.int64)
+    arrays['partitions.codes'] = codes[arrays['partitions.rows']]
+    
+    # Profile buckets of every partition back to back; starts / members are
+    # partition positions, members share partitions.offsets
+    offsets = arrays['partitions.offsets']
+    partition_buckets = [
+        build_profile_buckets(arrays['partitions.codes'][offsets[idx]:offsets[idx + 1]])
+        for idx in range(len(SUBJECTS))
+    ]
+    arrays['buckets.offsets'] = np.concatenate([[0], np.cumsum([len(b.codes) for b in partition_buckets])]).astype(np.int64)
+    for field in ('codes', 'starts', 'sizes', 'members'):
+        dtype = PACKED_DTYPE if field == 'codes' else np.int64
+        arrays[f'buckets.{field}'] = np.concatenate([getattr(b, field) for b in partition_buckets]).astype(dtype)
+    
+    return arrays
+
+
+def write_snapshot_file(
+    path: str,
+    version: int,
+    columns: Dict[str, Sequence],
+    codes: np.ndarray,
+    meta: Optional[Dict] = None,
+    stats: Optional[PopulationStats] = None,
+    partition_versions: Optional[Dict[str, int]] = None,
+    content_version: Optional[str] = None,
+    partition_rows: Optional[Dict[str, np.ndarray]] = None
+):
+    """
+    Atomically (re)write the snapshot file at `path`
+    
+    Args:
+        path: Destination file
+        version: Snapshot version stored in the header
+        columns: STUDENT_COLUMNS name → (N,) values
+        codes: (N,) packed profile codes
+        meta: Extra JSON-serializable header fields
+        stats: Population stats of these rows (counted from the columns if omitted)
+        partition_versions: SUBJECTS entry → SubjectPartition.version (all
+            `version` if omitted)
+        partition_rows: SUBJECTS entry → SubjectPartition.rows (rows
+            ascending per subject if omitted)
+        content_version: UserSnapshot.content_version (fingerprint of the
+            codes if omitted)
+    """
+    arrays = snapshot_arrays(columns, codes, partition_rows)
+    if stats is None:
+        stats = PopulationStats.from_columns(columns, len(arrays['codes']))
+    partition_versions = partition_versions or {}
+    
+    entries, offset = {}, 0
+    for name, array in arrays.items():
+        entries[name] = [offset, array.dtype.str, list(array.shape)]
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    
+    header = json.dumps({
+        'format': FORMAT_VERSION,
+        'version': int(version),
+        'size': int(len(arrays['codes'])),
+        'content_version': content_version or profile_fingerprint(arrays['codes']),
+        'partition_versions': {subject: int(partition_versions.get(subject, version)) for subject in SUBJECTS},
+        'arrays': entries,
+        'stats': stats.to_dict(),
+        'meta': meta or {},
+    }).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + entries[name][0])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+async def save_snapshot_file(path: str, snapshot: UserSnapshot, meta: Optional[Dict] = None) -> int:
+    """
+    Write a live snapshot without blocking the event loop
+    
+    The columns are copied (shallow) before the write starts, so in-place
+    upserts/deletes during the write never reach the file.
+    
+    Returns:
+        The version written
+    """
+    version = snapshot.version
+    columns = {name: snapshot.column(name).copy() for name in STUDENT_COLUMNS}
+    codes = snapshot.codes.copy()
+    stats = snapshot.stats.copy()
+    partition_versions = {subject: partition.version for subject, partition in snapshot.partitions.items()}
+    partition_rows = {subject: partition.rows.copy() for subject, partition in snapshot.partitions.items()}
+    
+    await asyncio.to_thread(
+        write_snapshot_file, path, version, columns, codes, meta, stats,
+        partition_versions, snapshot.content_version, partition_rows
+    )
+    return version
+
+
+def read_snapshot_file(path: str) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    """
+    Map a snapshot file read-only
+    
+    Returns:
+        (header, arrays) - read-only views into one memory map of the file
+    """
+    # Plain ndarray view: slicing an np.memmap subclass is slow on the gather path
+    mapped = np.memmap(path, dtype=np.uint8, mode='r').view(np.ndarray)
+    if mapped[:len(MAGIC)].tobytes() != MAGIC:
+        raise ValueError(f"{path} is not a snapshot file")
+    
+    header_len = int(mapped[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+    header = json.loads(mapped[len(MAGIC) + 8:len(MAGIC) + 8 + header_len].tobytes())
+    if header['format'] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot file format {header['format']}")
+    
+    data_start = -(-(len(MAGIC) + 8 + header_len) // ALIGN) * ALIGN
+    arrays = {}
+    for name, (offset, dtype, shape) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        start = data_start + offset
+        arrays[name] = mapped[start:start + count * dtype.itemsize].view(dtype).reshape(shape)
+    
+    return header, arrays
+
+
+def load_snapshot_file(path: str) -> UserSnapshot:
+    """Read-only UserSnapshot backed by the mapped file (no per-row decoding up front)"""
+    header, arrays = read_snapshot_file(path)
+    
+    columns = {
+        name: StringColumn(
+            arrays[f'{name}.offsets'], arrays[f'{name}.blob'], arrays[f'{name}.nulls'],
+            is_list=name in LIST_COLUMNS
+        )
+        for name in STUDENT_COLUMNS
+    }
+    row_of = IdIndex(arrays['id_index.sorted_ids'], arrays['id_index.rows'])
+    
+    offsets, bucket_offsets = arrays['partitions.offsets'], arrays['buckets.offsets']
+    partitions = {}
+    for idx, subject in enumerate(SUBJECTS):
+        start, end = offsets[idx], offsets[idx + 1]
+        first, last = bucket_offsets[idx], bucket_offsets[idx + 1]
+        buckets = ProfileBuckets(
+            arrays['buckets.codes'][first:last], arrays['buckets.starts'][first:last],
+            arrays['buckets.sizes'][first:last], arrays['buckets.members'][start:end]
+        )
+        partitions[subject] = SubjectPartition(
+            arrays['partitions.rows'][start:end], arrays['partitions.codes'][start:end],
+            header['partition_versions'][subject], buckets
+        )
+    
+    stats = PopulationStats.from_dict(header['stats']) if 'stats' in header else None
+    
+    return UserSnapshot(
+        header['version'], columns, arrays['codes'],
+        row_of=row_of, partitions=partitions, stats=stats, content_version=header['content_version']
+    )
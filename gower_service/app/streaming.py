@@ -0,0 +1,36 @@
+# app/streaming.py - NDJSON STREAMING HELPERS
+
+"""
+Newline-delimited JSON for /match/stream
+- ndjson_line(): one object per line, serialized with orjson when installed
+  (it ships with fastapi[all]), the json module otherwise
+- chunk_sizes(): a small first chunk so the first partners go out at once,
+  then doubling chunks to keep per-chunk overhead low on deep lists
+"""
+
+import json
+from typing import Any, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+FIRST_CHUNK = 16
+MAX_CHUNK = 1024
+
+
+def ndjson_line(obj: Any) -> bytes:
+    """One JSON object + newline, UTF-8"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+    return (json.dumps(obj, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def chunk_sizes(first: int = FIRST_CHUNK, largest: int = MAX_CHUNK) -> Iterator[int]:
+    """first, 2 * first, ... capped at largest (endless)"""
+    size = first
+    while True:
+        yield size
+        size = min(size * 2, largest)
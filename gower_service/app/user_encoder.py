@@ -0,0 +1,305 @@
+# app/user_encoder.py - BACKEND USER ENCODING
+
+"""
+Backend user format → ML format + packed profile codes
+- map_backend_to_ml_format(): one user (ingest, queries); the display → code
+  tables are built once at import instead of on every call
+- encode_backend_users(): a whole fetch at once, column by column. Users are
+  read in cache-sized chunks, all fields of a user with one itemgetter call,
+  straight into preallocated columns. Raw field values are interned into
+  lookup tables (raw value → id → mapped value + its bits of the packed
+  code), so the few hundred distinct subject / grade / day-list / time-list
+  values are converted once per process instead of once per user, rows
+  share the interned mapped values, and codes are assembled with numpy
+  gathers into a preallocated array
+- Both apply the same defaulting rules: unknown subject → math, unparsable
+  grade → 11 (out of range → grade 11 in the code), no days → Mon/Wed/Fri,
+  no times → morning/evening
+"""
+
+from itertools import repeat
+from operator import itemgetter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .gower_matching import (
+    PACKED_DTYPE,
+    SUBJECT_INDEX,
+    SUBJECT_SHIFT,
+    GRADE_SHIFT,
+    DAYS_SHIFT,
+    DAYS,
+    TIMES,
+    GRADES,
+)
+from .snapshot import STUDENT_COLUMNS, _object_column
+
+# Subject mapping
+SUBJECT_MAP = {
+    'Mathematics': 'math',
+    'Physics': 'physics',
+    'Chemistry': 'chemistry',
+    'Biology': 'biology',
+    'English': 'english',
+    'Computer Science': 'computer',
+    'math': 'math',
+    'physics': 'physics',
+    'chemistry': 'chemistry',
+    'biology': 'biology',
+    'english': 'english',
+    'computer': 'computer'
+}
+
+# Days mapping
+DAY_MAP = {
+    'Monday': 'monday',
+    'Tuesday': 'tuesday',
+    'Wednesday': 'wednesday',
+    'Thursday': 'thursday',
+    'Friday': 'friday',
+    'Saturday': 'saturday',
+    'Sunday': 'sunday',
+}
+
+# Times mapping
+TIME_MAP = {
+    'Morning (6am-12pm)': 'morning',
+    'Afternoon (12pm-6pm)': 'afternoon',
+    'Evening (6pm-9pm)': 'evening',
+    'Night (9pm-6am)': 'night',
+    'Morning': 'morning',
+    'Afternoon': 'afternoon',
+    'Evening': 'evening',
+    'Night': 'night',
+}
+
+DEFAULT_DAYS = ['monday', 'wednesday', 'friday']
+DEFAULT_TIMES = ['morning', 'evening']
+
+# Lookup tables are reset when they grow past this (garbage input can't pin memory)
+MAX_INTERNED = 65536
+
+
+def map_backend_to_ml_format(backend_user: Dict) -> Dict:
+    """Map backend user format to ML format"""
+    # Transform
+    subject_input = backend_user.get('tag_subject', 'math')
+    subject_code = SUBJECT_MAP.get(str(subject_input), 'math')
+    
+    days_display = backend_user.get('tag_study_days', [])
+    days_codes = [DAY_MAP.get(d, d.lower()) for d in days_display if d]
+    if not days_codes:
+        days_codes = list(DEFAULT_DAYS)
+    
+    times_display = backend_user.get('tag_study_times', [])
+    times_codes = [TIME_MAP.get(t, t.lower()) for t in times_display if t]
+    if not times_codes:
+        times_codes = list(DEFAULT_TIMES)
+    
+    # Grade normalization
+    grade_raw = backend_user.get('grade', '11')
+    try:
+        grade = int(grade_raw)
+    except:
+        grade = 11
+    
+    return {
+        'student_id': backend_user.get('user_id', ''),
+        'name': backend_user.get('name', 'Student'),
+        'email': backend_user.get('email', ''),
+        'school': backend_user.get('school', ''),
+        'grade': str(grade),
+        'bio': backend_user.get('bio', ''),
+        'tag_subject': subject_code,
+        'tag_study_days': days_codes,
+        'tag_study_times': times_codes,
+    }
+
+
+# ===== PER-FIELD CONVERSIONS (raw value → (mapped value, packed bits)) =====
+
+def _subject_entry(raw) -> Tuple[str, int]:
+    subject = SUBJECT_MAP.get(str(raw), 'math')
+    return subject, SUBJECT_INDEX[subject] << SUBJECT_SHIFT
+
+
+def _grade_entry(raw) -> Tuple[str, int]:
+    try:
+        grade = int(raw)
+    except:
+        grade = 11
+    code_grade = grade if grade in GRADES else 11
+    return str(grade), (code_grade - 10) << GRADE_SHIFT
+
+
+def _option_list_entry(raw, display_map: Dict[str, str], default: List[str], options: List[str], shift: int) -> Tuple[List[str], int]:
+    codes = [display_map.get(value, value.lower()) for value in raw if value]
+    if not codes:
+        codes = list(default)
+    mask = sum(1 << i for i, option in enumerate(options) if option in codes)
+    return codes, mask << shift
+
+
+def _days_entry(raw) -> Tuple[List[str], int]:
+    return _option_list_entry(raw, DAY_MAP, DEFAULT_DAYS, DAYS, DAYS_SHIFT)
+
+
+def _times_entry(raw) -> Tuple[List[str], int]:
+    return _option_list_entry(raw, TIME_MAP, DEFAULT_TIMES, TIMES, 0)
+
+
+class _Interner(dict):
+    """
+    Lookup table built on demand: raw value → small id
+    
+    values[id] / bits[id] are the mapped value and its packed-code bits, so a
+    whole column converts with one C-level map() over the raw values and one
+    numpy gather per table.
+    """
+    
+    def __init__(self, convert: Callable):
+        super().__init__()
+        self.convert = convert
+        self.values: List = []
+        self.bits: List[int] = []
+    
+    def add(self, raw) -> int:
+        """Convert a value without remembering it (unhashable raw values)"""
+        value, bits = self.convert(raw)
+        self.values.append(value)
+        self.bits.append(bits)
+        return len(self.values) - 1
+    
+    def __missing__(self, key) -> int:
+        self[key] = self.add(key)
+        return self[key]
+    
+    def trim(self):
+        """Forget everything once too large (between encodes: ids must stay valid during one)"""
+        if len(self.values) > MAX_INTERNED:
+            self.clear()
+            self.values, self.bits = [], []
+    
+    def ids(self, raw_values: Sequence, as_key: Optional[Callable] = None) -> np.ndarray:
+        """(N,) ids of raw values"""
+        try:
+            keys = raw_values if as_key is None else map(as_key, raw_values)
+            return np.fromiter(map(self.__getitem__, keys), dtype=np.int64, count=len(raw_values))
+        except TypeError:
+            pass
+        
+        ids = np.empty(len(raw_values), dtype=np.int64)
+        for i, raw in enumerate(raw_values):
+            try:
+                ids[i] = self[raw if as_key is None else as_key(raw)]
+            except TypeError:
+                ids[i] = self.add(raw)
+        return ids
+    
+    def lookup(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(mapped values, packed bits) of every id"""
+        return _object_column(self.values)[ids], np.array(self.bits, dtype=np.int64)[ids]
+
+
+_SUBJECTS = _Interner(_subject_entry)
+_GRADES = _Interner(_grade_entry)
+_DAY_LISTS = _Interner(_days_entry)         # keyed by tuple(raw list)
+_TIME_LISTS = _Interner(_times_entry)
+
+# Raw fields read per user, with the backend defaults of map_backend_to_ml_format()
+RAW_FIELDS = (
+    ('user_id', ''), ('name', 'Student'), ('email', ''), ('school', ''), ('bio', ''),
+    ('grade', '11'), ('tag_subject', 'math'), ('tag_study_days', []), ('tag_study_times', []),
+)
+
+# Fields converted through a lookup table: (interner, raw value → key)
+CODED_FIELDS = {
+    'grade': (_GRADES, None),
+    'tag_subject': (_SUBJECTS, None),
+    'tag_study_days': (_DAY_LISTS, tuple),
+    'tag_study_times': (_TIME_LISTS, tuple),
+}
+
+# Users read per chunk: the chunk's dicts and strings are still in cache when
+# the coded fields are interned
+RAW_CHUNK = 512
+
+
+def _read_users(backend_users: List[Dict]) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """
+    Every raw field with C-level passes (no per-user Python code)
+    
+    The fields the first user has are read with one itemgetter call per user
+    and transposed with zip(). The others are the backend defaults when no
+    user of the chunk has more keys than that; otherwise they (and every
+    field of a chunk where some user lacks one) take one dict.get pass per
+    field.
+    
+    Returns:
+        (plain, ids) - object columns of the fields stored as is, and the
+        interned ids of every CODED_FIELDS field
+    """
+    n = len(backend_users)
+    plain = {field: np.empty(n, dtype=object) for field, _ in RAW_FIELDS if field not in CODED_FIELDS}
+    ids = {field: np.empty(n, dtype=np.int64) for field in CODED_FIELDS}
+    
+    common = [field for field, _ in RAW_FIELDS if n and field in backend_users[0]]
+    read_row = itemgetter(*common) if len(common) > 1 else None
+    
+    for start in range(0, n, RAW_CHUNK):
+        users = backend_users[start:start + RAW_CHUNK]
+        stop = start + len(users)
+        try:
+            columns = dict(zip(common, zip(*map(read_row, users)))) if read_row else {}
+        except KeyError:
+            columns = {}
+        
+        # Every user has the common fields and no other key: the rest are absent
+        only_common = bool(columns) and len(common) < len(RAW_FIELDS) and max(map(len, users)) == len(common)
+        
+        for field, default in RAW_FIELDS:
+            values = columns.get(field)
+            if values is None and only_common and field in plain:
+                plain[field][start:stop] = default
+                continue
+            if values is None and only_common:
+                values = [default] * len(users)
+            elif values is None:
+                values = list(map(dict.get, users, repeat(field), repeat(default)))
+            
+            if field in plain:
+                plain[field][start:stop] = _object_column(values)
+            else:
+                interner, as_key = CODED_FIELDS[field]
+                ids[field][start:stop] = interner.ids(values, as_key)
+    
+    return plain, ids
+
+
+def encode_backend_users(backend_users: List[Dict]) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """
+    Map and encode a whole backend fetch without per-user dicts
+    
+    Same result as map_backend_to_ml_format() + encode_profile_packed() on
+    every user.
+    
+    Args:
+        backend_users: Raw users from the backend
+    
+    Returns:
+        (columns, codes) - STUDENT_COLUMNS name → (N,) object column, and
+        the (N,) packed profile codes
+    """
+    for interner, _ in CODED_FIELDS.values():
+        interner.trim()
+    
+    columns, ids = _read_users(backend_users)
+    
+    codes = np.zeros(len(backend_users), dtype=PACKED_DTYPE)
+    for field, (interner, _) in CODED_FIELDS.items():
+        columns[field], bits = interner.lookup(ids[field])
+        codes |= bits.astype(PACKED_DTYPE)
+    
+    columns['student_id'] = columns.pop('user_id')
+    return {name: columns[name] for name in STUDENT_COLUMNS}, codes
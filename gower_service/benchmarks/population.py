@@ -0,0 +1,82 @@
+# benchmarks/population.py - SYNTHETIC POPULATION GENERATOR
+
+"""
+Realistic synthetic students in backend format (/users/for-matching)
+- Subject / grade / schedule popularity follow a Zipf-like skew:
+  weight of the i-th most popular option ∝ 1 / (i + 1) ** skew (0 = uniform)
+- A small share of users leave days / times empty (service defaults apply)
+- Deterministic for a given seed
+"""
+
+from typing import Dict, List
+
+import numpy as np
+
+# Display values as sent by the backend, most popular first
+SUBJECT_OPTIONS = ['Mathematics', 'English', 'Physics', 'Chemistry', 'Computer Science', 'Biology']
+GRADE_OPTIONS = ['12', '11', '10']
+DAY_OPTIONS = ['Saturday', 'Sunday', 'Wednesday', 'Monday', 'Friday', 'Tuesday', 'Thursday']
+TIME_OPTIONS = ['Evening (6pm-9pm)', 'Afternoon (12pm-6pm)', 'Night (9pm-6am)', 'Morning (6am-12pm)']
+SCHOOLS = [f'THPT School {i:03d}' for i in range(200)]
+
+
+def skewed_weights(n_options: int, skew: float) -> np.ndarray:
+    """Zipf-like probabilities over options ordered by popularity"""
+    weights = 1.0 / np.arange(1, n_options + 1) ** skew
+    return weights / weights.sum()
+
+
+def _pick_sets(rng: np.random.Generator, n: int, options: List[str], skew: float, max_items: int, empty_rate: float) -> List[List[str]]:
+    """n skewed multi-select answers (1..max_items options, some left empty)"""
+    sizes = rng.integers(1, max_items + 1, size=n)
+    sizes[rng.random(n) < empty_rate] = 0
+    
+    # Sample without replacement by ranking exponential keys scaled by weight
+    keys = rng.exponential(size=(n, len(options))) / skewed_weights(len(options), skew)
+    order = np.argsort(keys, axis=1)
+    
+    return [[options[j] for j in sorted(row[:size])] for row, size in zip(order.tolist(), sizes.tolist())]
+
+
+def generate_population(
+    n: int,
+    seed: int = 0,
+    subject_skew: float = 1.0,
+    grade_skew: float = 0.3,
+    schedule_skew: float = 1.0,
+    empty_rate: float = 0.02
+) -> List[Dict]:
+    """
+    Generate n backend-format users
+    
+    Args:
+        n: Number of users
+        seed: Random seed
+        subject_skew: Popularity skew of subjects (0 = uniform)
+        grade_skew: Popularity skew of grades
+        schedule_skew: Popularity skew of days and time slots
+        empty_rate: Share of users with empty days / times (defaults apply)
+    
+    Returns:
+        List of user dicts
+    """
+    rng = np.random.default_rng(seed)
+    subjects = rng.choice(len(SUBJECT_OPTIONS), size=n, p=skewed_weights(len(SUBJECT_OPTIONS), subject_skew))
+    grades = rng.choice(len(GRADE_OPTIONS), size=n, p=skewed_weights(len(GRADE_OPTIONS), grade_skew))
+    schools = rng.integers(0, len(SCHOOLS), size=n)
+    days = _pick_sets(rng, n, DAY_OPTIONS, schedule_skew, 4, empty_rate)
+    times = _pick_sets(rng, n, TIME_OPTIONS, schedule_skew, 2, empty_rate)
+    
+    return [
+        {
+            'user_id': f'bench-{i}',
+            'name': f'Student {i}',
+            'email': f'student{i}@bench.edu.vn',
+            'school': SCHOOLS[schools[i]],
+            'grade': GRADE_OPTIONS[grades[i]],
+            'tag_subject': SUBJECT_OPTIONS[subjects[i]],
+            'tag_study_days': days[i],
+            'tag_study_times': times[i],
+        }
+        for i in range(n)
+    ]
@@ -0,0 +1,233 @@
+# benchmarks/run.py - MATCHING BENCHMARK SUITE
+
+"""
+Times the matching pipeline on synthetic populations
+- encode (18-dim + packed + bulk raw → packed), distances (18-dim + packed + every weight
+  profile from one component pass), breakdown (scalar + batch), clustering (K-Means + k-medoids), end-to-end /match and /match/batch
+- Writes machine-readable JSON; --compare prints speedups against a baseline
+
+Run (from gower_service/):
+    python -m benchmarks.run --sizes 1000 10000 100000 --out bench.json
+    python -m benchmarks.run --sizes 1000000 --skip-e2e
+    python -m benchmarks.run --compare baseline.json --out bench.json
+"""
+
+import argparse
+import asyncio
+import builtins
+import json
+import platform
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from app import main
+from app.gower_matching import (
+    encode_features_for_gower,
+    encode_profile_packed,
+    calculate_gower_distances,
+    calculate_gower_distances_packed,
+    component_distances_packed,
+    combine_component_distances,
+    get_similarity_breakdown,
+    get_similarity_breakdown_batch,
+    pack_features,
+    fit_profile_kmeans,
+    kmedoids_clustering_for_gower,
+    WEIGHT_PROFILES
+)
+from app.result_cache import ResultCache
+from app.snapshot import SnapshotStore
+from app.user_encoder import encode_backend_users
+
+from .population import generate_population
+
+
+def measure(fn: Callable[[], object], repeat: int = 5, items: int = 1) -> Dict:
+    """Run fn `repeat` times; seconds per run (median/min) and µs per item"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    
+    median = float(np.median(timings))
+    return {
+        'seconds_median': median,
+        'seconds_min': float(min(timings)),
+        'items': items,
+        'us_per_item': median / items * 1e6,
+    }
+
+
+def latency_summary(latencies: List[float]) -> Dict:
+    """Latency percentiles (seconds) over individual requests"""
+    values = np.array(latencies)
+    return {
+        'seconds_median': float(np.median(values)),
+        'seconds_min': float(values.min()),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'seconds_mean': float(values.mean()),
+        'items': len(values),
+        'us_per_item': float(np.median(values) * 1e6),
+    }
+
+
+def bench_population(n: int, args) -> Dict[str, Dict]:
+    """Every benchmark for one population size"""
+    users = generate_population(n, seed=args.seed, subject_skew=args.subject_skew,
+                                grade_skew=args.grade_skew, schedule_skew=args.schedule_skew)
+    queries = generate_population(args.queries, seed=args.seed + 1, subject_skew=args.subject_skew,
+                                  grade_skew=args.grade_skew, schedule_skew=args.schedule_skew)
+    ml_users = [main.map_backend_to_ml_format(user) for user in users]
+    ml_queries = [main.map_backend_to_ml_format(query) for query in queries[:10]]
+    results = {}
+    
+    # Encoding
+    results['map'] = measure(lambda: [main.map_backend_to_ml_format(user) for user in users], args.repeat, n)
+    results['encode_features'] = measure(lambda: [encode_features_for_gower(user) for user in ml_users], args.repeat, n)
+    results['encode_packed'] = measure(lambda: [encode_profile_packed(user) for user in ml_users], args.repeat, n)
+    # Raw backend users → columns + packed codes (replaces map + encode on snapshot builds)
+    results['encode_bulk'] = measure(lambda: encode_backend_users(users), args.repeat, n)
+    
+    all_features = np.array([encode_features_for_gower(user) for user in ml_users])
+    codes = pack_features(all_features)
+    query_features = [encode_features_for_gower(query) for query in ml_queries]
+    query_codes = [encode_profile_packed(query) for query in ml_queries]
+    
+    # Distances: one query against the whole population
+    results['distances_features'] = measure(
+        lambda: [calculate_gower_distances(q, all_features) for q in query_features], args.repeat, n * len(query_features))
+    results['distances_packed'] = measure(
+        lambda: [calculate_gower_distances_packed(q, codes) for q in query_codes], args.repeat, n * len(query_codes))
+    
+    # Every weight profile for each query: components once, one 4-term combine per profile
+    profiles = list(WEIGHT_PROFILES.values())
+    results['distances_packed_weightings'] = measure(
+        lambda: [[combine_component_distances(component, w) for w in profiles]
+                 for component in (component_distances_packed(q, codes) for q in query_codes)],
+        args.repeat, n * len(query_codes) * len(profiles))
+    
+    # Breakdown of 100 results
+    top = min(100, n)
+    results['breakdown_scalar'] = measure(
+        lambda: [get_similarity_breakdown(query_features[0], features) for features in all_features[:top]], args.repeat, top)
+    results['breakdown_batch'] = measure(
+        lambda: get_similarity_breakdown_batch(query_codes[0], codes[:top]), args.repeat, top)
+    
+    # Clustering (one fit each)
+    if not args.skip_clustering:
+        results['cluster_kmeans'] = measure(lambda: fit_profile_kmeans(codes, 18), 1, n)
+        results['cluster_kmedoids'] = measure(lambda: kmedoids_clustering_for_gower(codes, 18), 1, n)
+    
+    if not args.skip_e2e:
+        results.update(bench_endpoints(users, queries, args))
+    
+    return results
+
+
+def bench_endpoints(users: List[Dict], queries: List[Dict], args) -> Dict[str, Dict]:
+    """End-to-end /match and /match/batch through the ASGI app (backend mocked, TestClient overhead included)"""
+    from fastapi.testclient import TestClient
+    
+    async def fetch():
+        return users
+    
+    main.snapshot_store = SnapshotStore(fetch, main.map_backend_to_ml_format, ttl_seconds=3600,
+                                        encode_users=encode_backend_users)
+    main.result_cache = ResultCache(max_entries=0)           # measure ranking, not cache hits
+    client = TestClient(main.app)
+    bodies = [{key: value for key, value in query.items() if key != 'user_id'} for query in queries]
+    
+    # Fetch (mocked) + map + encode + partitions, once
+    results = {'snapshot_build': measure(lambda: asyncio.run(main.snapshot_store.refresh()), 1, len(users))}
+    
+    latencies = []
+    for body in bodies:
+        start = time.perf_counter()
+        response = client.post('/match', json=body, params={'top_n': args.top_n})
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code in (200, 404), response.text
+    results['match_e2e'] = latency_summary(latencies)
+    
+    batch = {'profiles': bodies[:args.batch_size], 'top_n': args.top_n}
+    results['match_batch_e2e'] = measure(lambda: client.post('/match/batch', json=batch), args.repeat, len(batch['profiles']))
+    
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def compare(current: Dict, baseline: Dict):
+    """Print baseline → current median times per (size, benchmark)"""
+    print(f"\n{'size':>9}  {'benchmark':<22} {'baseline':>12} {'current':>12} {'speedup':>8}")
+    for size, benchmarks in current['results'].items():
+        for name, result in benchmarks.items():
+            before = baseline.get('results', {}).get(size, {}).get(name)
+            if before is None:
+                continue
+            speedup = before['seconds_median'] / max(result['seconds_median'], 1e-12)
+            print(f"{size:>9}  {name:<22} {before['seconds_median']:>11.4f}s {result['seconds_median']:>11.4f}s {speedup:>7.2f}x")
+
+
+def main_cli(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Gower matching benchmarks on synthetic populations")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Population sizes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--subject-skew', type=float, default=1.0, help="Zipf skew of subjects (0 = uniform)")
+    parser.add_argument('--grade-skew', type=float, default=0.3, help="Zipf skew of grades")
+    parser.add_argument('--schedule-skew', type=float, default=1.0, help="Zipf skew of days / time slots")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per micro-benchmark")
+    parser.add_argument('--queries', type=int, default=200, help="/match requests per size")
+    parser.add_argument('--batch-size', type=int, default=100, help="Profiles per /match/batch request")
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--skip-e2e', action='store_true', help="Skip /match benchmarks")
+    parser.add_argument('--skip-clustering', action='store_true', help="Skip clustering benchmarks")
+    parser.add_argument('--out', help="Write JSON results here")
+    parser.add_argument('--compare', help="Baseline JSON to compare against")
+    args = parser.parse_args(argv)
+    
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'results': {},
+    }
+    
+    builtins_print = builtins.print
+    main.metrics.MATCH_LOG = False
+    for n in args.sizes:
+        builtins_print(f"⏱️  [Bench] {n} users ...")
+        builtins.print = lambda *a, **k: None             # silence refresh / cluster logs
+        try:
+            report['results'][str(n)] = bench_population(n, args)
+        finally:
+            builtins.print = builtins_print
+        for name, result in report['results'][str(n)].items():
+            print(f"    {name:<22} {result['seconds_median'] * 1000:>10.3f} ms  ({result['us_per_item']:.3f} µs/item)")
+    
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 [Bench] Results written to {args.out}")
+    
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -6,14 +6,51 @@ Run: python test_gower.py
 """
 
 import numpy as np
+from app.knn_graph import build_knn_graph
 from app.gower_matching import (
     encode_features_for_gower,
     gower_distance_manual,
+    calculate_gower_distances,
     get_similarity_breakdown,
+    get_similarity_breakdown_batch,
+    encode_profile_packed,
+    pack_features,
+    unpack_features,
+    calculate_gower_distances_packed,
+    build_profile_buckets,
+    rank_profile_buckets,
+    rank_profile_buckets_batch,
+    rank_profile_buckets_weightings,
+    rank_bucket_order,
+    ranking_page,
+    select_top_k,
+    kmedoids_clustering_for_gower,
+    assign_to_medoids,
+    component_distances_packed,
+    combine_component_distances,
+    validate_weights,
     FEATURE_WEIGHTS,
+    WEIGHT_PROFILES,
+    SUBJECTS,
+    DAYS,
+    TIMES,
     explain_weights
 )
 
+
+def random_profiles(n, seed=0):
+    """Random profiles covering every subject/grade and empty day/time sets"""
+    rng = np.random.default_rng(seed)
+    profiles = []
+    for _ in range(n):
+        profiles.append({
+            'tag_subject': SUBJECTS[rng.integers(len(SUBJECTS))],
+            'grade': str(rng.integers(10, 13)),
+            'tag_study_days': [d for d in DAYS if rng.random() < 0.3],
+            'tag_study_times': [t for t in TIMES if rng.random() < 0.3],
+        })
+    return profiles
+
 def test_encoding():
     """Test feature encoding"""
     print("=" * 60)
@@ -213,6 +250,294 @@ def test_grade_ordinal_distance():
     
     print("✅ Ordinal property OK\n")
 
+def test_batch_distances_match_manual():
+    """Test that the vectorized kernel is bit-identical to the per-row loop"""
+    print("=" * 60)
+    print("TEST 6: Vectorized Gower Distances")
+    print("=" * 60)
+    
+    profiles = random_profiles(500)
+    all_features = np.array([encode_features_for_gower(p) for p in profiles])
+    
+    # Include a query with no days/times selected ("both empty" rule)
+    queries = profiles[:20] + [{'tag_subject': 'math', 'grade': '11', 'tag_study_days': [], 'tag_study_times': []}]
+    
+    for query in queries:
+        query_features = encode_features_for_gower(query)
+        batch = calculate_gower_distances(query_features, all_features)
+        loop = np.array([gower_distance_manual(query_features, f) for f in all_features])
+        assert np.array_equal(batch, loop), "Vectorized distances must equal gower_distance_manual"
+    
+    print(f"Checked {len(queries)} queries × {len(all_features)} candidates")
+    print("✅ Vectorized kernel OK\n")
+
+def test_packed_encoding():
+    """Test that packed codes round-trip and give identical distances"""
+    print("=" * 60)
+    print("TEST 7: Packed Profile Encoding")
+    print("=" * 60)
+    
+    profiles = random_profiles(300, seed=1)
+    profiles.append({'tag_subject': 'art', 'grade': '9', 'tag_study_days': [], 'tag_study_times': ['night']})
+    all_features = np.array([encode_features_for_gower(p) for p in profiles])
+    codes = np.array([encode_profile_packed(p) for p in profiles], dtype=np.uint16)
+    
+    assert np.array_equal(pack_features(all_features), codes), "pack_features must match encode_profile_packed"
+    assert np.array_equal(unpack_features(codes), all_features), "Unpacked codes must equal 18-dim features"
+    
+    for query, query_features, query_code in zip(profiles[:20], all_features, codes):
+        packed = calculate_gower_distances_packed(query_code, codes)
+        assert np.array_equal(packed, calculate_gower_distances(query_features, all_features))
+        
+        for features, code in zip(all_features[:30], codes[:30]):
+            assert gower_distance_manual(query_code, code) == gower_distance_manual(query_features, features)
+            assert get_similarity_breakdown(query_code, code) == get_similarity_breakdown(query_features, features)
+    
+    print(f"Feature matrix: {all_features.nbytes} bytes → packed: {codes.nbytes} bytes")
+    print("✅ Packed encoding OK\n")
+
+def test_profile_buckets():
+    """Test that bucketed ranking equals a stable sort over all students"""
+    print("=" * 60)
+    print("TEST 8: Profile Buckets")
+    print("=" * 60)
+    
+    profiles = random_profiles(2000, seed=2)
+    codes = np.array([encode_profile_packed(p) for p in profiles], dtype=np.uint16)
+    buckets = build_profile_buckets(codes)
+    
+    for query_code in codes[:20]:
+        distances = calculate_gower_distances_packed(query_code, codes)
+        expected = np.argsort(distances, kind='stable')
+        
+        for k in (1, 10, 100, None):
+            rows, ranked_distances = rank_profile_buckets(query_code, buckets, k)
+            assert np.array_equal(rows, expected[:k]), "Bucket expansion must follow (distance, row) order"
+            assert np.array_equal(ranked_distances, distances[rows])
+    
+    print(f"{len(codes)} students → {len(buckets.codes)} buckets")
+    print("✅ Profile buckets OK\n")
+
+def test_batch_ranking():
+    """Test that blocked batch ranking equals one ranking per query"""
+    print("=" * 60)
+    print("TEST 9: Batch Ranking")
+    print("=" * 60)
+    
+    codes = np.array([encode_profile_packed(p) for p in random_profiles(1000, seed=3)], dtype=np.uint16)
+    buckets = build_profile_buckets(codes)
+    query_codes = np.concatenate([codes[:50], codes[:10]])   # repeated profiles are ranked once
+    
+    # Tiny block budget forces many blocks
+    ranked = rank_profile_buckets_batch(query_codes, buckets, k=25, max_block_bytes=4096)
+    
+    assert len(ranked) == len(query_codes)
+    for query_code, (rows, distances) in zip(query_codes, ranked):
+        expected_rows, expected_distances = rank_profile_buckets(query_code, buckets, k=25)
+        assert np.array_equal(rows, expected_rows) and np.array_equal(distances, expected_distances)
+    
+    print(f"Ranked {len(query_codes)} queries against {len(buckets.codes)} buckets")
+    print("✅ Batch ranking OK\n")
+
+def test_top_k_selection():
+    """Test that argpartition top-k equals a stable full sort"""
+    print("=" * 60)
+    print("TEST 10: Top-K Selection")
+    print("=" * 60)
+    
+    rng = np.random.default_rng(4)
+    # Few discrete levels → heavy ties, like real Gower distances
+    distances = rng.choice([0.0, 0.05, 0.1, 0.2833, 0.35, 0.7], size=5000)
+    expected = np.argsort(distances, kind='stable')
+    
+    for k in (0, 1, 7, 100, 4999, 5000, 6000):
+        assert np.array_equal(select_top_k(distances, k), expected[:k]), f"top-{k} mismatch"
+    
+    # Bucket expansion with huge tie groups at the cutoff
+    codes = np.array([encode_profile_packed(p) for p in random_profiles(3000, seed=5)], dtype=np.uint16)
+    codes = np.tile(codes[:40], 75)
+    buckets = build_profile_buckets(codes)
+    for query_code in codes[:10]:
+        expected = np.argsort(calculate_gower_distances_packed(query_code, codes), kind='stable')
+        for k in (1, 74, 75, 76, 1000):
+            rows, _ = rank_profile_buckets(query_code, buckets, k)
+            assert np.array_equal(rows, expected[:k]), "Bucket top-k must break ties by row"
+    
+    print("✅ Top-k selection OK\n")
+
+def test_batch_breakdown():
+    """Test that the batched breakdown equals the per-candidate breakdown"""
+    print("=" * 60)
+    print("TEST 11: Batched Similarity Breakdown")
+    print("=" * 60)
+    
+    profiles = random_profiles(200, seed=6)
+    all_features = np.array([encode_features_for_gower(p) for p in profiles])
+    codes = pack_features(all_features)
+    
+    for query_features, query_code in zip(all_features[:10], codes[:10]):
+        from_features = get_similarity_breakdown_batch(query_features, all_features)
+        distances = calculate_gower_distances_packed(query_code, codes)
+        from_codes = get_similarity_breakdown_batch(query_code, codes, distances)
+        
+        for i, features in enumerate(all_features):
+            expected = get_similarity_breakdown(query_features, features)
+            for batch in (from_features, from_codes):
+                row = {key: (value if np.ndim(value) == 0 else value[i]) for key, value in batch.items()}
+                assert row == expected, f"Breakdown mismatch at candidate {i}"
+    
+    print("✅ Batched breakdown OK\n")
+
+def test_kmedoids_clustering():
+    """Test Gower k-medoids: nearest-medoid labels, PAM local optimum, CLARA sampling"""
+    print("=" * 60)
+    print("TEST 12: Gower K-Medoids (CLARA)")
+    print("=" * 60)
+    
+    codes = pack_features(np.array([encode_features_for_gower(p) for p in random_profiles(300, seed=7)]))
+    medoids = kmedoids_clustering_for_gower(codes, 4)
+    assert len(medoids) == 4 and set(medoids) <= set(codes), "Medoids are real profiles"
+    
+    # Labels are nearest medoids under the exact Gower distance
+    labels, distances = assign_to_medoids(codes, medoids)
+    for code, label, distance in zip(codes[:50], labels, distances):
+        manual = [gower_distance_manual(code, medoid) for medoid in medoids]
+        assert distance == min(manual) and manual[label] == distance
+    
+    # Few distinct profiles → plain PAM: no single swap lowers the cost
+    small = codes[:40]
+    medoids = kmedoids_clustering_for_gower(small, 3)
+    best = assign_to_medoids(small, medoids)[1].sum()
+    for i in range(3):
+        for h in np.unique(small):
+            if h not in medoids:
+                swapped = medoids.copy()
+                swapped[i] = h
+                assert assign_to_medoids(small, swapped)[1].sum() >= best - 1e-9
+    
+    # CLARA sampling is deterministic and beats random medoids
+    many = pack_features(np.array([encode_features_for_gower(p) for p in random_profiles(3000, seed=8)]))
+    first = kmedoids_clustering_for_gower(many, 6, sample_size=30)
+    assert np.array_equal(first, kmedoids_clustering_for_gower(many, 6, sample_size=30))
+    random_medoids = np.random.default_rng(0).choice(np.unique(many), 6, replace=False)
+    assert assign_to_medoids(many, first)[1].sum() < assign_to_medoids(many, random_medoids)[1].sum()
+    
+    print("✅ K-Medoids clustering OK\n")
+
+def test_knn_graph():
+    """Test that the all-pairs graph equals per-user ranking (in-process and process pool)"""
+    print("=" * 60)
+    print("TEST 13: All-Pairs kNN Graph")
+    print("=" * 60)
+    
+    codes = pack_features(np.array([encode_features_for_gower(p) for p in random_profiles(1500, seed=9)]))
+    codes[:4] = codes[0]                 # duplicate profiles tie at distance 0
+    codes[-1] = codes[-1] | 0b111 << 13  # no known subject: no partners (/match answers 404)
+    k = 6
+    
+    neighbors, distances = build_knn_graph(codes, k, workers=1, tile_buckets=40)
+    pooled = build_knn_graph(codes, k, workers=2, tile_buckets=40)
+    assert np.array_equal(neighbors, pooled[0]) and np.array_equal(distances, pooled[1])
+    
+    subjects = codes.astype(np.int64) >> 13
+    for i in list(range(0, len(codes), 23)) + [0, 1, 3]:
+        rows = np.flatnonzero(subjects == subjects[i])
+        ranked, ranked_dist = rank_profile_buckets(codes[i], build_profile_buckets(codes[rows]), k)
+        expected, expected_dist = rows[ranked], ranked_dist
+        
+        assert np.array_equal(neighbors[i, :len(expected)], expected), f"Neighbours of {i} differ"
+        assert np.allclose(distances[i, :len(expected)], expected_dist)
+        assert (neighbors[i, len(expected):] == -1).all()
+    
+    assert neighbors[0, :4].tolist() == neighbors[3, :4].tolist() == [0, 1, 2, 3], "Identical profiles first, by row"
+    assert (neighbors[-1] == -1).all() and np.isinf(distances[-1]).all(), "Unknown subject: no partners"
+    
+    # Ties break by position in subject_rows (SubjectPartition.rows order), as on /match
+    subject_rows = [np.flatnonzero(subjects == s)[::-1] for s in range(6)]
+    reordered, _ = build_knn_graph(codes, k, workers=1, subject_rows=subject_rows)
+    rows = subject_rows[subjects[0]]
+    ranked, _ = rank_profile_buckets(codes[0], build_profile_buckets(codes[rows]), k)
+    assert np.array_equal(reordered[0], rows[ranked]) and reordered[0, :4].tolist() != [0, 1, 2, 3]
+    print("✅ kNN graph OK\n")
+
+def test_ranking_pages():
+    """Test that consecutive ranking pages equal the full (distance, row) ranking"""
+    print("=" * 60)
+    print("TEST 14: Ranking Pages")
+    print("=" * 60)
+    
+    codes = pack_features(np.array([encode_features_for_gower(p) for p in random_profiles(800, seed=4)]))
+    codes[10:20] = codes[0]                 # one large bucket
+    buckets = build_profile_buckets(codes)
+    
+    for query in codes[:25]:
+        full_rows, full_dist = rank_profile_buckets(query, buckets)
+        ranking = rank_bucket_order(query, buckets)
+        
+        for k in (1, 5, 64):
+            rows, dist = ranking_page(ranking, 0, k)
+            expected = rank_profile_buckets(query, buckets, k)
+            assert np.array_equal(rows, expected[0]) and np.array_equal(dist, expected[1])
+        
+        pages = [ranking_page(ranking, offset, 13) for offset in range(0, len(codes), 13)]
+        assert np.array_equal(np.concatenate([p[0] for p in pages]), full_rows), "Pages must tile the ranking"
+        assert np.array_equal(np.concatenate([p[1] for p in pages]), full_dist)
+        assert len(ranking_page(ranking, len(codes), 13)[0]) == 0
+    
+    print("✅ Ranking pages OK\n")
+
+def test_weightings():
+    """Test per-request weightings over shared component distances"""
+    print("=" * 60)
+    print("TEST 15: Per-request Weightings")
+    print("=" * 60)
+    
+    codes = pack_features(np.array([encode_features_for_gower(p) for p in random_profiles(600, seed=5)]))
+    buckets = build_profile_buckets(codes)
+    custom = {'subject': 0.1, 'grade': 0.2, 'days': 0.3, 'times': 0.4}
+    weightings = [None, custom] + list(WEIGHT_PROFILES.values())
+    
+    for query in codes[:20]:
+        components = component_distances_packed(query, codes)
+        assert len(components) == 4 and all(c.shape == codes.shape for c in components)
+        
+        # Default weighting is bit-identical to the unweighted functions
+        assert np.array_equal(combine_component_distances(components), calculate_gower_distances_packed(query, codes))
+        assert np.array_equal(calculate_gower_distances_packed(query, codes, FEATURE_WEIGHTS), calculate_gower_distances_packed(query, codes))
+        
+        # Custom weights re-weight the breakdown's components
+        breakdown = get_similarity_breakdown_batch(query, codes)
+        expected = (
+            custom['subject'] * (~breakdown['subject_match']) +
+            custom['grade'] * (1.0 - breakdown['grade_similarity']) +
+            custom['days'] * (1.0 - breakdown['days_similarity']) +
+            custom['times'] * (1.0 - breakdown['times_similarity'])
+        )
+        assert np.allclose(calculate_gower_distances_packed(query, codes, custom), expected)
+        
+        # Several weightings over one candidate set = one ranking each
+        for weights, (rows, dist) in zip(weightings, rank_profile_buckets_weightings(query, buckets, weightings, 25)):
+            expected_rows, expected_dist = rank_profile_buckets(query, buckets, 25, weights)
+            assert np.array_equal(rows, expected_rows) and np.array_equal(dist, expected_dist)
+    
+    batch = rank_profile_buckets_batch(codes[:20], buckets, 10, weights=custom)
+    for query, (rows, dist) in zip(codes[:20], batch):
+        expected_rows, expected_dist = rank_profile_buckets(query, buckets, 10, custom)
+        assert np.array_equal(rows, expected_rows) and np.array_equal(dist, expected_dist)
+    
+    # Invalid weightings
+    for bad in ({'subject': 1.0}, {**custom, 'extra': 0.1}, {**custom, 'grade': -0.1},
+                {**custom, 'times': float('nan')}, {**custom, 'times': 0.5}, dict.fromkeys(custom, 0.0)):
+        try:
+            validate_weights(bad)
+            assert False, f"Weights {bad} should be rejected"
+        except ValueError:
+            pass
+    for weights in WEIGHT_PROFILES.values():
+        assert validate_weights(weights) == weights
+    
+    print("✅ Weightings OK\n")
+
 if __name__ == "__main__":
     print("\n🧪 Testing Gower Distance Implementation")
     print("=" * 60)
@@ -223,6 +548,16 @@ if __name__ == "__main__":
         test_similarity_breakdown()
         test_weights_explanation()
         test_grade_ordinal_distance()
+        test_batch_distances_match_manual()
+        test_packed_encoding()
+        test_profile_buckets()
+        test_batch_ranking()
+        test_top_k_selection()
+        test_batch_breakdown()
+        test_kmedoids_clustering()
+        test_knn_graph()
+        test_ranking_pages()
+        test_weightings()
         
         print("=" * 60)
         print("🎉 ALL TESTS PASSED!")
@@ -231,7 +566,7 @@ if __name__ == "__main__":
         print(f"✅ Weights: Subject 34.7%, Grade 35.2%, Days 20%, Times 10.1%")
         print("✅ Distance metric respects data types (categorical, ordinal, binary)")
         print("✅ Ready for production use!")
-        
+    
     except AssertionError as e:
         print(f"\n❌ TEST FAILED: {e}")
     except Exception as e:
@@ -0,0 +1,1112 @@
+# test_service.py - Test matching service internals (snapshot, API)
+
+"""
+Test script for the matching service
+Run: python test_service.py
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+from app import main, metrics
+from app import clustering as clustering_module
+from app import snapshot as snapshot_module
+from app.main import map_backend_to_ml_format
+from app.clustering import ClusterIndex
+from app.gower_matching import SUBJECTS, assign_to_medoids, build_profile_buckets, rank_profile_buckets
+from app import knn_graph as knn_graph_module
+from app.knn_graph import build_knn_graph, save_knn_graph
+from app.result_cache import ResultCache, data_version
+from app.shared_snapshot import SharedSnapshotStore
+from app.population import PopulationStats
+from app.snapshot import STUDENT_COLUMNS, SnapshotStore, build_user_snapshot
+from app.snapshot_file import load_snapshot_file, save_snapshot_file
+from app.user_encoder import encode_backend_users
+
+
+def make_backend_users(n, subject='Mathematics'):
+    """Backend-format users (as returned by /users/for-matching)"""
+    return [
+        {
+            'user_id': f'user-{i}',
+            'name': f'Student {i}',
+            'email': f'student{i}@edu.vn',
+            'school': 'THPT Lê Hồng Phong',
+            'grade': str(10 + i % 3),
+            'tag_subject': subject,
+            'tag_study_days': ['Monday', 'Wednesday'] if i % 2 else ['Saturday'],
+            'tag_study_times': ['Morning (6am-12pm)'],
+        }
+        for i in range(n)
+    ]
+
+
+class FakeBackend:
+    """Counts fetches and serves a configurable user list"""
+    
+    def __init__(self, users):
+        self.users = users
+        self.fetches = 0
+    
+    async def fetch(self):
+        self.fetches += 1
+        await asyncio.sleep(0)
+        return list(self.users)
+
+
+def test_snapshot_store():
+    """Test caching and stale-while-revalidate refresh"""
+    print("=" * 60)
+    print("TEST 1: Snapshot Store")
+    print("=" * 60)
+    
+    async def scenario():
+        backend = FakeBackend(make_backend_users(20))
+        store = SnapshotStore(backend.fetch, map_backend_to_ml_format, ttl_seconds=60)
+        
+        # Cold start: concurrent requests share one fetch
+        first, second = await asyncio.gather(store.get(), store.get())
+        assert first is second and backend.fetches == 1
+        assert first.size == 20 and first.codes.shape == (20,)
+        
+        # Fresh snapshot: no backend traffic
+        await store.get()
+        assert backend.fetches == 1, "Fresh snapshot must not refetch"
+        
+        # Stale snapshot: old one is served, refresh runs in background
+        store.ttl_seconds = 0
+        backend.users = make_backend_users(30)
+        stale = await store.get()
+        assert stale is first, "Stale snapshot is still served immediately"
+        await store._refresh_task
+        assert store.snapshot.size == 30 and store.snapshot.version == first.version + 1
+        
+        # Backend outage: keep the last good snapshot
+        backend.users = []
+        await store.refresh()
+        assert store.snapshot.size == 30, "Empty fetch must not replace a good snapshot"
+    
+    asyncio.run(scenario())
+    print("✅ Snapshot store OK\n")
+
+
+def test_incremental_upsert_delete():
+    """Test that in-place upserts/deletes equal a full rebuild"""
+    print("=" * 60)
+    print("TEST 2: Incremental Upsert / Delete")
+    print("=" * 60)
+    
+    async def scenario():
+        users = {u['user_id']: u for u in make_backend_users(50)}
+        backend = FakeBackend(users.values())
+        store = SnapshotStore(backend.fetch, map_backend_to_ml_format, ttl_seconds=60)
+        first = await store.get()
+        version = first.version
+        for partition in first.partitions.values():
+            partition.buckets       # built now, then patched by every change
+        
+        edits = make_backend_users(80, subject='Physics')
+        for user in edits[30:]:           # 30 updates + 20 inserts
+            users[user['user_id']] = user
+            await store.upsert_user(user)
+        for user_id in ['user-0', 'user-7', 'user-79', 'user-40']:
+            users.pop(user_id)
+            assert await store.delete_user(user_id) is not None
+        assert await store.delete_user('missing') is None
+        
+        snapshot = store.snapshot
+        assert snapshot is first and snapshot.version == version + 54
+        
+        expected = build_user_snapshot(list(users.values()), map_backend_to_ml_format, 0)
+        assert snapshot.size == expected.size == len(users)
+        for user_id, row in expected.row_of.items():
+            assert snapshot.student(snapshot.row_of[user_id]) == expected.student(row)
+            assert snapshot.codes[snapshot.row_of[user_id]] == expected.codes[row]
+        
+        # Subject partitions stay in sync with the rows
+        for subject, partition in snapshot.partitions.items():
+            rows = {row for row, s in enumerate(snapshot.column('tag_subject')) if s == subject}
+            assert set(partition.rows.tolist()) == rows and partition.size == len(rows)
+            assert (partition.codes == snapshot.codes[partition.rows]).all()
+            
+            # Patched buckets rank exactly like freshly built ones
+            rebuilt = build_profile_buckets(partition.codes)
+            assert partition.buckets.size == partition.size
+            assert sorted(partition.buckets.codes.tolist()) == rebuilt.codes.tolist()
+            for code in rebuilt.codes[:5]:
+                patched_rows, _ = rank_profile_buckets(int(code), partition.buckets, 7)
+                assert np.array_equal(patched_rows, rank_profile_buckets(int(code), rebuilt, 7)[0])
+        
+        # Upsert while a full refresh is in flight is replayed onto the new snapshot
+        release = asyncio.Event()
+        
+        async def slow_fetch():
+            await release.wait()
+            return make_backend_users(10)
+        
+        store._fetch_users = slow_fetch
+        refresh = asyncio.create_task(store.refresh())
+        await asyncio.sleep(0)
+        await store.upsert_user({**edits[0], 'user_id': 'late-user'})
+        release.set()
+        refreshed = await refresh
+        assert refreshed.size == 11 and 'late-user' in refreshed.row_of
+    
+    asyncio.run(scenario())
+    print("✅ Incremental ingestion OK\n")
+
+
+def make_client(users):
+    """TestClient whose snapshot store serves `users` instead of the backend"""
+    backend = FakeBackend(users)
+    main.snapshot_store = SnapshotStore(backend.fetch, map_backend_to_ml_format, ttl_seconds=60)
+    return TestClient(main.app), backend
+
+
+def query_profile(**overrides):
+    return {
+        'name': 'Query Student',
+        'email': 'query@edu.vn',
+        'grade': '11',
+        'tag_subject': 'Mathematics',
+        'tag_study_days': ['Monday', 'Wednesday'],
+        'tag_study_times': ['Morning (6am-12pm)'],
+        **overrides,
+    }
+
+
+def test_batch_endpoint():
+    """Test that /match/batch returns the same partners as /match"""
+    print("=" * 60)
+    print("TEST 3: Batch Endpoint")
+    print("=" * 60)
+    
+    users = make_backend_users(40) + make_backend_users(40, subject='Physics')[20:]
+    client, backend = make_client(users)
+    
+    queries = [
+        query_profile(),
+        query_profile(tag_subject='Physics', grade='12'),
+        query_profile(tag_subject='Biology'),        # nobody studies biology
+        query_profile(tag_study_days=['Saturday']),
+    ]
+    response = client.post('/match/batch', json={'profiles': queries, 'top_n': 10})
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert len(results) == len(queries)
+    assert results[2]['matched_partners'] == []
+    
+    for query, result in zip(queries, results):
+        if not result['matched_partners']:
+            continue
+        single = client.post('/match', json=query, params={'top_n': 10}).json()
+        assert result['matched_partners'] == single['matched_partners']
+    
+    assert backend.fetches == 1, "One snapshot serves every query"
+    
+    # top_n is honoured (not the fixed 100 cap)
+    single = client.post('/match', json=query_profile(), params={'top_n': 3}).json()
+    assert [p['rank'] for p in single['matched_partners']] == [1, 2, 3]
+    print("✅ Batch endpoint OK\n")
+
+
+def test_cluster_index():
+    """Test persistent clustering: background training, label cache, persistence, partial_fit"""
+    print("=" * 60)
+    print("TEST 4: Cluster Index")
+    print("=" * 60)
+    
+    time_options = [['Morning'], ['Evening'], ['Afternoon', 'Night'], ['Morning', 'Night']]
+    users = make_backend_users(200)
+    for i, user in enumerate(users):
+        user['tag_study_times'] = time_options[i % 4]
+    snapshot = build_user_snapshot(users, map_backend_to_ml_format, version=1)
+    
+    async def scenario(path):
+        index = ClusterIndex(path=path, partial_fit_batch=4)
+        
+        # First request only schedules training, it never blocks on it
+        assert index.get(snapshot, 8) is None
+        await index._task
+        model = index.get(snapshot, 8)
+        assert model is not None and model.trained_for == snapshot.content_version
+        assert index._task.done(), "Same snapshot build must not retrain"
+        
+        # A rebuild with the same users (any order) keeps the model
+        task = index._task
+        rebuilt = build_user_snapshot(users[::-1], map_backend_to_ml_format, version=2)
+        assert index.get(rebuilt, 8) is model and index._task is task, "Same content must not retrain"
+        
+        # Cached labels agree with predict, clusters are bucket subsets
+        labels = model.labels_of(snapshot.codes)
+        assert np.array_equal(labels, model.model.predict(snapshot.features))
+        assert model.labels_of(snapshot.codes[:5]).tolist() == labels[:5].tolist()
+        
+        # Persisted model is reused after a restart
+        restarted = ClusterIndex(path=path)
+        restarted.load()
+        assert np.array_equal(restarted.model.labels_of(snapshot.codes), labels)
+        
+        # Upserts are folded in with partial_fit once a batch is full: fitted
+        # off the event loop on a copy, the current model serves meanwhile
+        centers = model.model.cluster_centers_.copy()
+        for code in snapshot.codes[:4]:
+            await index.observe(code)
+        assert index.model is model
+        await index._update_task
+        assert not index._pending
+        assert index.model is not model and index.model.revision == model.revision + 1
+        assert not np.array_equal(centers, index.model.model.cluster_centers_)
+        assert np.array_equal(centers, model.model.cluster_centers_)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'clusters.joblib')
+        asyncio.run(scenario(path))
+        assert os.path.exists(path)
+    
+    # Gower k-medoids: labels are nearest-medoid lookups
+    medoid_index = ClusterIndex(path=None, method='kmedoids')
+    medoid_model = asyncio.run(medoid_index.train(snapshot, 8))
+    assert medoid_model.method == 'kmedoids' and medoid_model.n_clusters == len(set(medoid_model.model))
+    assert np.array_equal(medoid_model.labels_of(snapshot.codes), assign_to_medoids(snapshot.codes, medoid_model.model)[0])
+    
+    # Failed training: error kept, no retry before the backoff is over
+    def broken_fit(codes, n_clusters):
+        raise MemoryError("no room")
+    
+    async def failing():
+        failing_index = ClusterIndex(path=None)
+        original, clustering_module.fit_profile_kmeans = clustering_module.fit_profile_kmeans, broken_fit
+        try:
+            assert failing_index.get(snapshot, 8) is None
+            await failing_index._task
+        finally:
+            clustering_module.fit_profile_kmeans = original
+        task = failing_index._task
+        assert failing_index.get(snapshot, 8) is None and failing_index._task is task, "Retried without backoff"
+        return failing_index
+    
+    failed = asyncio.run(failing())
+    assert failed.last_error == "MemoryError: no room"
+    assert failed.stats()['retry_in_seconds'] > 0
+    
+    # /match with clustering on: partners all come from the query's cluster
+    client, _ = make_client(users)
+    client.post('/match', json=query_profile())
+    store_snapshot = main.snapshot_store.snapshot
+    main.cluster_index = ClusterIndex(path=None)
+    model = asyncio.run(main.cluster_index.train(store_snapshot, 8))
+    
+    main.USE_CLUSTERING = True
+    try:
+        response = client.post('/match', json=query_profile(), params={'top_n': 20}).json()
+    finally:
+        main.USE_CLUSTERING = False
+    
+    rows = [store_snapshot.row_of[p['student_id']] for p in response['matched_partners']]
+    assert response['cluster_id'] == model.label_of(int(store_snapshot.codes[rows[0]]))
+    assert set(model.labels_of(store_snapshot.codes[rows]).tolist()) == {response['cluster_id']}
+    
+    # Cursors belong to one cluster model: unclustered or pre-update pages expire
+    unclustered = client.post('/match', json=query_profile(), params={'top_n': 5}).json()
+    main.USE_CLUSTERING = True
+    try:
+        page1 = client.post('/match', json=query_profile(), params={'top_n': 5}).json()
+        assert client.post('/match', json=query_profile(), params={'cursor': unclustered['next_cursor']}).status_code == 410
+        page2 = client.post('/match', json=query_profile(), params={'cursor': page1['next_cursor'], 'top_n': 5})
+        assert page2.status_code == 200 and page2.json()['cluster_id'] == page1['cluster_id']
+        model.partial_fit(store_snapshot.codes[:4])
+        assert client.post('/match', json=query_profile(), params={'cursor': page1['next_cursor']}).status_code == 410
+    finally:
+        main.USE_CLUSTERING = False
+    print("✅ Cluster index OK\n")
+
+
+def test_knn_graph_serving():
+    """Test that /match serves known users from the precomputed graph"""
+    print("=" * 60)
+    print("TEST 5: kNN Graph Serving")
+    print("=" * 60)
+    
+    users = make_backend_users(40)
+    client, _ = make_client(users)
+    snapshot = asyncio.run(main.snapshot_store.get())
+    
+    # Profile of user-7, as the backend would send it
+    user = users[7]
+    query = query_profile(user_id=user['user_id'], grade=user['grade'], tag_study_days=user['tag_study_days'])
+    live = client.post('/match', json=query, params={'top_n': 6}).json()['matched_partners']
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        # Job run on the service's snapshot file: the graph records its version
+        snapshot_path, graph_dir = os.path.join(tmp, 'snapshot.bin'), os.path.join(tmp, 'graph')
+        asyncio.run(save_snapshot_file(snapshot_path, snapshot))
+        knn_graph_module.main(['--out', graph_dir, '--k', '10', '--workers', '1', '--snapshot', snapshot_path])
+        with open(os.path.join(graph_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        assert meta['snapshot_version'] == snapshot.version and meta['content_version'] == snapshot.content_version
+        
+        main.KNN_GRAPH_DIR = graph_dir
+        try:
+            from_graph = metrics.MATCH_REQUESTS.value(source='graph')
+            served = client.post('/match', json=query, params={'top_n': 5}).json()['matched_partners']
+            assert metrics.MATCH_REQUESTS.value(source='graph') == from_graph + 1
+            
+            # Changed profile → graph row is stale, live ranking again
+            changed = client.post('/match', json={**query, 'grade': '12'}, params={'top_n': 5}).json()['matched_partners']
+            
+            # Changes to another subject keep the math graph current
+            client.put('/users/physics-1', json={**make_backend_users(1, subject='Physics')[0], 'user_id': 'physics-1'})
+            assert client.post('/match', json=query, params={'top_n': 5}).json()['matched_partners'] == served
+            assert metrics.MATCH_REQUESTS.value(source='graph') == from_graph + 2
+            
+            # Math changes since the job ran: a distance-0 twin joins (and moves to
+            # position 0 when user-0 leaves) → live ranking, not the old neighbours
+            client.put('/users/twin-7', json={**user, 'user_id': 'twin-7'})
+            client.delete('/users/user-0')
+            after_change = client.post('/match', json=query, params={'top_n': 5}).json()
+            assert metrics.MATCH_REQUESTS.value(source='graph') == from_graph + 2, "Stale graph must not be served"
+            assert after_change['matched_partners'][0]['student_id'] == 'twin-7'
+            
+            # Missing graph: checked once per interval, reported once
+            main.KNN_GRAPH_DIR = os.path.join(tmp, 'missing')
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                for _ in range(3):
+                    assert client.post('/match', json=query, params={'top_n': 5}).status_code == 200
+            assert output.getvalue().count("Graph unavailable") == 1
+        finally:
+            main.KNN_GRAPH_DIR = None
+    
+    # Same partners as live ranking (self included on both paths)
+    assert served == live[:5]
+    assert any(p['student_id'] == user['user_id'] for p in served)
+    assert changed != served
+    print("✅ kNN graph serving OK\n")
+
+
+def test_result_cache():
+    """Test LRU/TTL result cache and its invalidation on snapshot changes"""
+    print("=" * 60)
+    print("TEST 6: Result Cache")
+    print("=" * 60)
+    
+    # LRU eviction + TTL expiry
+    snapshot = SimpleNamespace(built_at=1.0, version=1)
+    cache = ResultCache(max_entries=2, ttl_seconds=60)
+    cache.put(snapshot, 'a', 1)
+    cache.put(snapshot, 'b', 2)
+    assert cache.get(snapshot, 'a') == 1           # 'a' is now most recent
+    cache.put(snapshot, 'c', 3)
+    assert cache.get(snapshot, 'b') is None and cache.evictions == 1
+    assert cache.get(snapshot, 'c') == 3
+    
+    cache.ttl_seconds = 0.01
+    time.sleep(0.02)
+    assert cache.get(snapshot, 'c') is None, "Expired entry"
+    
+    # New snapshot version drops everything
+    cache.ttl_seconds = 60
+    cache.put(snapshot, 'a', 1)
+    assert cache.get(SimpleNamespace(built_at=1.0, version=2), 'a') is None
+    
+    # /match: repeats hit, top_n and ingestion change the key / scope
+    client, _ = make_client(make_backend_users(30))
+    main.result_cache = ResultCache()
+    
+    first = client.post('/match', json=query_profile(), params={'top_n': 5}).json()
+    second = client.post('/match', json=query_profile(name='Other Student'), params={'top_n': 5}).json()
+    assert first['matched_partners'] == second['matched_partners']
+    assert (main.result_cache.hits, main.result_cache.misses) == (1, 1)
+    
+    client.post('/match', json=query_profile(), params={'top_n': 3})
+    assert main.result_cache.misses == 2
+    
+    twin = {**query_profile(), 'user_id': 'twin', 'name': 'Twin'}
+    client.put('/users/twin', json=twin)
+    after = client.post('/match', json=query_profile(), params={'top_n': 6}).json()
+    assert main.result_cache.misses == 3
+    assert after['matched_partners'][-1]['student_id'] == 'twin'
+    client.post('/match', json=query_profile(), params={'top_n': 5})
+    assert main.result_cache.misses == 4, "Upsert drops the subject's cached results"
+    
+    assert client.get('/').json()['result_cache']['hits'] == 1
+    print("✅ Result cache OK\n")
+
+
+def test_metrics():
+    """Test stage histograms, counters, /metrics exposition and the log switch"""
+    print("=" * 60)
+    print("TEST 7: Metrics")
+    print("=" * 60)
+    
+    client, _ = make_client(make_backend_users(30))
+    main.result_cache = ResultCache()
+    fetches = metrics.BACKEND_FETCH_SECONDS.count()
+    ranked = metrics.MATCH_STAGE_SECONDS.count(stage='rank')
+    scanned = metrics.CANDIDATES_SCANNED.value()
+    returned = metrics.RESULTS_RETURNED.value()
+    
+    metrics.MATCH_LOG = False
+    try:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            client.post('/match', json=query_profile(), params={'top_n': 4})
+            client.post('/match', json=query_profile(), params={'top_n': 4})
+        assert '[ML]' not in output.getvalue(), "Hot-path logging is switched off"
+    finally:
+        metrics.MATCH_LOG = True
+    
+    assert metrics.BACKEND_FETCH_SECONDS.count() == fetches + 1
+    assert metrics.MATCH_STAGE_SECONDS.count(stage='rank') == ranked + 1, "Second query is a cache hit"
+    assert metrics.CANDIDATES_SCANNED.value() == scanned + 30
+    assert metrics.RESULTS_RETURNED.value() == returned + 8
+    
+    response = client.get('/metrics')
+    assert response.headers['content-type'].startswith('text/plain')
+    text = response.text
+    assert '# TYPE gower_match_stage_seconds histogram' in text
+    assert 'gower_match_stage_seconds_bucket{stage="rank",le="+Inf"}' in text
+    assert 'gower_match_requests_total{source="cache"}' in text
+    assert 'gower_snapshot_users 30' in text
+    print("✅ Metrics OK\n")
+
+
+def test_startup_and_readiness():
+    """Test lazy heavy imports, startup preload and the /ready probe"""
+    print("=" * 60)
+    print("TEST 8: Startup + Readiness")
+    print("=" * 60)
+    
+    # sklearn stays unloaded until clustering needs it; pandas is never loaded
+    loaded = subprocess.check_output(
+        [sys.executable, '-c', "import sys, app.main; print('sklearn' in sys.modules, 'pandas' in sys.modules)"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), text=True
+    )
+    assert loaded.split() == ['False', 'False'], loaded
+    
+    # Backend down: not ready (and a retry is scheduled)
+    client, backend = make_client([])
+    assert client.get('/ready').status_code == 503
+    
+    # Startup hook fetches, encodes and builds buckets before serving
+    backend.users = make_backend_users(25)
+    with TestClient(main.app) as client:
+        snapshot = main.snapshot_store.snapshot
+        assert snapshot.size == 25
+        assert all(p._groups is not None for p in snapshot.partitions.values())
+        
+        response = client.get('/ready')
+        assert response.status_code == 200 and response.json()['total_students'] == 25
+        
+        fetches = backend.fetches
+        client.post('/match', json=query_profile())
+        assert backend.fetches == fetches, "First request is served from the preloaded snapshot"
+    print("✅ Startup + readiness OK\n")
+
+
+def test_shared_snapshot():
+    """Test one leader publishing the snapshot file and a follower mapping it"""
+    print("=" * 60)
+    print("TEST 9: Shared Snapshot (multi-worker)")
+    print("=" * 60)
+    
+    async def scenario(directory):
+        users = make_backend_users(40)
+        users[3] = {**users[3], 'bio': None}
+        backend = FakeBackend(users)
+        leader = SharedSnapshotStore(directory, backend.fetch, map_backend_to_ml_format, ttl_seconds=60, publish_interval=0)
+        follower = SharedSnapshotStore(directory, backend.fetch, map_backend_to_ml_format, ttl_seconds=60, publish_interval=0)
+        
+        # Leader fetches + publishes; the follower only maps the file
+        built = await leader.refresh()
+        mapped = await follower.get()
+        assert leader.is_leader and not follower.is_leader
+        assert backend.fetches == 1, "Only the leader talks to the backend"
+        assert mapped.read_only and mapped.version == built.version and mapped.size == built.size
+        assert (mapped.codes == built.codes).all()
+        
+        rows = np.array([5, 0, 39, 3])
+        assert mapped.gather(rows) == built.gather(rows)
+        for user_id, row in built.row_of.items():
+            assert mapped.row_of[user_id] == row
+        assert mapped.row_of.get('missing') is None and 'missing' not in mapped.row_of
+        for subject, partition in built.partitions.items():
+            assert (mapped.partitions[subject].rows == partition.rows).all()
+        
+        # Follower partitions (rows, codes, profile buckets) are views of the file, built once by the leader
+        def mapping_of(array):
+            while isinstance(array.base, np.ndarray):
+                array = array.base
+            return array
+        
+        for subject, partition in mapped.partitions.items():
+            buckets = partition.buckets
+            for array in (partition.rows, partition.codes, buckets.codes, buckets.starts, buckets.sizes, buckets.members):
+                assert mapping_of(array) is mapping_of(mapped.codes), subject
+            assert partition._groups is None
+            query = int(built.codes[0])
+            expected = rank_profile_buckets(query, built.partitions[subject].buckets, 10)
+            for got, want in zip(rank_profile_buckets(query, buckets, 10), expected):
+                assert (got == want).all(), subject
+        assert mapped.content_version == built.content_version
+        
+        # Follower upsert via the API: the cluster model observes the new profile, not the attached row
+        observed = []
+        async def observe(code):
+            observed.append(int(code))
+        
+        changed = {**users[2], 'grade': '10'}
+        originals = main.snapshot_store, main.cluster_index
+        main.snapshot_store, main.cluster_index = follower, SimpleNamespace(observe=observe)
+        try:
+            await main.upsert_user('user-2', main.schemas.StudentProfile(**changed))
+        finally:
+            main.snapshot_store, main.cluster_index = originals
+        assert observed == [main.encode_profile_packed(map_backend_to_ml_format(changed))]
+        assert observed[0] != mapped.codes[mapped.row_of['user-2']]
+        
+        # Follower ingest is queued; visible everywhere after the leader publishes
+        new_user = {**make_backend_users(1, subject='Physics')[0], 'user_id': 'new-user'}
+        await follower.upsert_user(new_user)
+        assert await follower.delete_user('user-1') is not None
+        assert await follower.delete_user('missing') is None
+        assert 'new-user' not in (await follower.get()).row_of
+        
+        await leader.sync()
+        current = await follower.get()
+        assert current is not mapped and current.version == leader.snapshot.version
+        assert 'new-user' in current.row_of and 'user-1' not in current.row_of
+        
+        # Per-subject data versions survive the file: cursors and cache entries agree across workers
+        for subject in SUBJECTS:
+            assert data_version(current, subject) == data_version(leader.snapshot, subject), subject
+        versions = [data_version(current, subject) for subject in ('chemistry', 'physics', 'math')]
+        assert versions == sorted(set(versions)) and versions[-1] == current.version, versions
+        assert current.student(current.row_of['new-user']) == leader.snapshot.student(leader.snapshot.row_of['new-user'])
+        
+        # Leader goes away: the follower takes over, refetches and republishes
+        leader.close()
+        await follower.sync()
+        assert follower.is_leader and not follower.snapshot.read_only
+        assert backend.fetches == 2 and follower.snapshot.version > current.version
+        follower.close()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(scenario(directory))
+    print("✅ Shared snapshot OK\n")
+
+
+def test_snapshot_file_restart():
+    """Test saving the snapshot file and serving from it after a restart with the backend down"""
+    print("=" * 60)
+    print("TEST 10: Snapshot File Restart")
+    print("=" * 60)
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'snapshot.bin')
+        users = make_backend_users(60)
+        
+        async def first_run():
+            store = SnapshotStore(FakeBackend(users).fetch, map_backend_to_ml_format, ttl_seconds=60, snapshot_path=path)
+            snapshot = await store.get()
+            await store._save_task
+            return snapshot
+        
+        built = asyncio.run(first_run())
+        assert os.path.exists(path)
+        
+        # Restart while the backend is down: served from the file, no fetch awaited
+        client, backend = make_client([])
+        main.snapshot_store = SnapshotStore(backend.fetch, map_backend_to_ml_format, ttl_seconds=60, snapshot_path=path, save_interval=0)
+        main.result_cache = ResultCache()
+        
+        response = client.post('/match', json=query_profile(), params={'top_n': 10})
+        assert response.status_code == 200, response.text
+        snapshot = main.snapshot_store.snapshot
+        assert snapshot.read_only and snapshot.version == built.version and snapshot.size == built.size
+        for subject, partition in built.partitions.items():
+            assert (snapshot.partitions[subject].rows == partition.rows).all()
+            assert (snapshot.partitions[subject].codes == partition.codes).all()
+        
+        # Same ranking as before the restart
+        client, _ = make_client(users)
+        main.result_cache = ResultCache()
+        expected = client.post('/match', json=query_profile(), params={'top_n': 10}).json()
+        assert response.json()['matched_partners'] == expected['matched_partners']
+        
+        # Ingest on a mapped snapshot: copied into memory once, then saved again
+        async def restarted():
+            store = SnapshotStore(FakeBackend([]).fetch, map_backend_to_ml_format, ttl_seconds=60, snapshot_path=path, save_interval=0)
+            await store.get()
+            await store._refresh_task                     # backend down: keep the file's snapshot
+            assert store.snapshot.read_only and store.snapshot.size == 60
+            chemistry_version = data_version(store.snapshot, 'chemistry')
+            
+            await store.upsert_user({**users[0], 'user_id': 'after-restart'})
+            assert await store.delete_user('user-5') is not None
+            assert not store.snapshot.read_only and store.snapshot.version == built.version + 2
+            assert data_version(store.snapshot, 'chemistry') == chemistry_version, "In-memory copy keeps partition versions"
+            
+            await store.get()
+            await store._save_task
+            reloaded = SnapshotStore(FakeBackend([]).fetch, map_backend_to_ml_format, snapshot_path=path).load_saved()
+            assert reloaded.version == built.version + 2 and reloaded.size == 60
+            assert 'after-restart' in reloaded.row_of and 'user-5' not in reloaded.row_of
+        
+        asyncio.run(restarted())
+    print("✅ Snapshot file restart OK\n")
+
+
+def test_match_pagination():
+    """Test cursor pages concatenating to the full ranking"""
+    print("=" * 60)
+    print("TEST 11: /match Cursor Pagination")
+    print("=" * 60)
+    
+    client, _ = make_client(make_backend_users(60))
+    main.result_cache = ResultCache()
+    full = client.post('/match', json=query_profile(), params={'top_n': 60}).json()
+    assert full['next_cursor'] is None
+    
+    pages, cursor = [], None
+    while True:
+        params = {'top_n': 7, **({'cursor': cursor} if cursor else {})}
+        response = client.post('/match', json=query_profile(), params=params)
+        assert response.status_code == 200, response.text
+        pages.append(response.json()['matched_partners'])
+        cursor = response.json()['next_cursor']
+        if cursor is None:
+            break
+    
+    assert len(pages) == 9 and len(pages[-1]) == 60 - 8 * 7
+    partners = [partner for page in pages for partner in page]
+    assert [p['student_id'] for p in partners] == [p['student_id'] for p in full['matched_partners']]
+    assert [p['rank'] for p in partners] == list(range(1, 61))
+    
+    # Later pages come from the cached ranking
+    first = client.post('/match', json=query_profile(), params={'top_n': 7}).json()
+    served = metrics.MATCH_REQUESTS.value(source='page')
+    second = client.post('/match', json=query_profile(), params={'top_n': 7, 'cursor': first['next_cursor']})
+    assert metrics.MATCH_REQUESTS.value(source='page') == served + 1
+    assert second.json()['matched_partners'] == pages[1]
+    
+    # Malformed, foreign-profile and outdated cursors
+    assert client.post('/match', json=query_profile(), params={'cursor': 'not-a-cursor'}).status_code == 400
+    other = query_profile(grade='12')
+    assert client.post('/match', json=other, params={'cursor': first['next_cursor']}).status_code == 400
+    client.put('/users/new-user', json=query_profile())
+    assert client.post('/match', json=query_profile(), params={'cursor': first['next_cursor']}).status_code == 410
+    print("✅ Pagination OK\n")
+
+
+def test_match_stream():
+    """Test that /match/stream yields the same ranked partners as /match, as NDJSON"""
+    print("=" * 60)
+    print("TEST 12: /match/stream NDJSON")
+    print("=" * 60)
+    
+    client, _ = make_client(make_backend_users(80))
+    main.result_cache = ResultCache()
+    expected = client.post('/match', json=query_profile(), params={'top_n': 80}).json()
+    
+    response = client.post('/match/stream', json=query_profile())
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    
+    header, partners, end = lines[0], lines[1:-1], lines[-1]
+    assert header['type'] == 'query' and header['total_candidates'] == 80
+    assert header['query_student'] == expected['query_student']
+    assert end == {'type': 'end', 'returned': 80, 'complete': True}
+    assert [{k: v for k, v in p.items() if k != 'type'} for p in partners] == expected['matched_partners']
+    
+    # top_n limits the stream; unknown subject is a plain 404 before streaming
+    limited = client.post('/match/stream', json=query_profile(), params={'top_n': 20}).text.splitlines()
+    assert len(limited) == 22 and json.loads(limited[-1])['returned'] == 20
+    assert client.post('/match/stream', json=query_profile(tag_subject='Physics')).status_code == 404
+    print("✅ NDJSON stream OK\n")
+
+
+def test_population_stats():
+    """Test that /stats follows ingest without refetching and survives the snapshot file"""
+    print("=" * 60)
+    print("TEST 13: Population Stats")
+    print("=" * 60)
+    
+    client, backend = make_client(make_backend_users(30))
+    stats = client.get('/stats').json()
+    assert stats['total_users'] == 30 and stats['subject_distribution'] == {'math': 30}
+    assert stats['grade_distribution'] == {'10': 10, '11': 10, '12': 10}
+    assert stats['day_distribution'] == {'monday': 15, 'wednesday': 15, 'saturday': 15}
+    assert stats['time_distribution'] == {'morning': 30}
+    
+    # Ingest moves the counters; info endpoints never refetch, even when stale
+    client.put('/users/user-1', json=query_profile(
+        tag_subject='Physics', grade='12', tag_study_days=['Sunday'], tag_study_times=['Night']
+    ))
+    client.delete('/users/user-2')
+    main.snapshot_store.ttl_seconds = 0
+    stats = client.get('/stats').json()
+    assert client.get('/').json()['total_students'] == stats['total_users'] == 29
+    assert stats['subject_distribution'] == {'math': 28, 'physics': 1}
+    assert stats['grade_distribution'] == {'10': 10, '11': 9, '12': 10}
+    assert stats['day_distribution'] == {'monday': 14, 'wednesday': 14, 'saturday': 14, 'sunday': 1}
+    assert stats['time_distribution'] == {'morning': 28, 'night': 1}
+    assert backend.fetches == 1, "/stats and / must not touch the backend"
+    
+    snapshot = main.snapshot_store.snapshot
+    recount = PopulationStats.from_columns({name: snapshot.column(name) for name in STUDENT_COLUMNS}, snapshot.size)
+    assert recount.to_dict() == snapshot.stats.to_dict()
+    
+    # Mapped snapshot: counters come from the file header, no column scan
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'snapshot.bin')
+        asyncio.run(save_snapshot_file(path, snapshot))
+        mapped = load_snapshot_file(path)
+        assert mapped._stats is not None and mapped.stats.to_dict() == snapshot.stats.to_dict()
+    print("✅ Population stats OK\n")
+
+
+def test_bulk_encoder():
+    """Test that the bulk encoder matches map_backend_to_ml_format + encode_profile_packed"""
+    print("=" * 60)
+    print("TEST 14: Bulk User Encoder")
+    print("=" * 60)
+    
+    users = make_backend_users(40)
+    odd = [
+        {'user_id': 'no-fields'},                                                   # every default
+        {'user_id': 'caps', 'tag_subject': 'MATH', 'grade': 13, 'tag_study_days': ['SUNDAY', ''], 'tag_study_times': ['NIGHT']},
+        {'user_id': 'unknown', 'tag_subject': 'Art', 'grade': 'x', 'tag_study_days': ['funday'], 'tag_study_times': []},
+        {'user_id': 'float', 'tag_subject': None, 'grade': 12.7, 'tag_study_days': ('Monday',), 'tag_study_times': ['Evening']},
+        {'user_id': 'unhashable', 'grade': {'value': 11}, 'tag_study_days': 'Friday', 'tag_study_times': ['Night', 'Night']},
+    ]
+    
+    with_bio = [{**user, 'bio': f"Bio {i}"} for i, user in enumerate(users)]
+    
+    # Field sets differ within a chunk, from the first user on, and across chunks
+    for batch in ([], users, users + odd, odd + users, with_bio + users, users + with_bio, make_backend_users(600) + odd + users):
+        expected = build_user_snapshot(batch, map_backend_to_ml_format, 0)
+        bulk = build_user_snapshot(batch, map_backend_to_ml_format, 0, encode_users=encode_backend_users)
+        assert (bulk.codes == expected.codes).all()
+        for name in STUDENT_COLUMNS:
+            assert bulk.column(name).tolist() == expected.column(name).tolist(), name
+        assert bulk.stats.to_dict() == expected.stats.to_dict()
+    
+    # Defaults: math, grade 11, Mon/Wed/Fri, morning/evening; unknown days encode to no bit
+    student = bulk.student(bulk.row_of['no-fields'])
+    assert (student['tag_subject'], student['grade']) == ('math', '11')
+    assert student['tag_study_days'] == ['monday', 'wednesday', 'friday']
+    assert student['tag_study_times'] == ['morning', 'evening']
+    assert bulk.student(bulk.row_of['unknown'])['tag_study_days'] == ['funday']
+    assert (int(bulk.codes[bulk.row_of['unknown']]) >> 4) & 0x7F == 0
+    
+    # Same failure as the per-user mapper on malformed input
+    for mapper in (map_backend_to_ml_format, lambda user: encode_backend_users([user])):
+        try:
+            mapper({'user_id': 'bad', 'tag_study_days': None})
+            assert False, "days=None must raise"
+        except TypeError:
+            pass
+    print("✅ Bulk encoder OK\n")
+
+
+def test_match_weightings():
+    """Test weight_profile / weights on /match, /match/stream and /match/batch"""
+    print("=" * 60)
+    print("TEST 15: Per-request Weightings")
+    print("=" * 60)
+    
+    client, _ = make_client(make_backend_users(60))
+    main.result_cache = ResultCache()
+    days_only = {'weights': 'subject=0,grade=0,days=1,times=0'}
+    
+    default = client.post('/match', json=query_profile(), params={'top_n': 60}).json()
+    survey = client.post('/match', json=query_profile(), params={'top_n': 60, 'weight_profile': 'survey'}).json()
+    assert survey == default, "The survey profile is the default weighting"
+    
+    weighted = client.post('/match', json=query_profile(), params={'top_n': 60, **days_only}).json()
+    scores = [p['days_match_score'] for p in weighted['matched_partners']]
+    assert scores == sorted(scores, reverse=True) and scores[0] == 1.0, "Ranked by days overlap only"
+    assert [p['student_id'] for p in weighted['matched_partners']] != [p['student_id'] for p in default['matched_partners']]
+    assert '100% Days' in weighted['message']
+    
+    # Cursors belong to one weighting; weighted pages tile the weighted ranking
+    first = client.post('/match', json=query_profile(), params={'top_n': 25, **days_only}).json()
+    assert client.post('/match', json=query_profile(), params={'top_n': 25, 'cursor': first['next_cursor']}).status_code == 400
+    second = client.post('/match', json=query_profile(), params={'top_n': 25, 'cursor': first['next_cursor'], **days_only})
+    assert first['matched_partners'] + second.json()['matched_partners'] == weighted['matched_partners'][:50]
+    
+    # Stream and batch apply the same weighting
+    lines = client.post('/match/stream', json=query_profile(), params=days_only).text.splitlines()
+    assert [json.loads(line)['student_id'] for line in lines[1:-1]] == [p['student_id'] for p in weighted['matched_partners']]
+    
+    profile = client.post('/match', json=query_profile(), params={'top_n': 10, 'weight_profile': 'schedule_first'}).json()
+    batch = client.post('/match/batch', json={'profiles': [query_profile()], 'top_n': 10, 'weight_profile': 'schedule_first'}).json()
+    assert batch['results'][0]['matched_partners'] == profile['matched_partners']
+    custom = {'subject': 0.0, 'grade': 0.0, 'days': 1.0, 'times': 0.0}
+    batch = client.post('/match/batch', json={'profiles': [query_profile()], 'top_n': 60, 'weights': custom}).json()
+    assert batch['results'][0]['matched_partners'] == weighted['matched_partners']
+    
+    # Per-profile weightings: one profile under several weightings costs one component pass
+    names = [None, 'schedule_first', 'equal', 'schedule_first']
+    expected = [
+        client.post('/match', json=query_profile(), params={'top_n': 10, 'weight_profile': name or 'survey'}).json()
+        for name in names
+    ]
+    main.result_cache = ResultCache()
+    passes = []
+    original_components = main.component_distances_packed
+    main.component_distances_packed = lambda *args: passes.append(args[0]) or original_components(*args)
+    try:
+        request = {'profiles': [query_profile()] * 4, 'top_n': 10, 'weight_profiles': names}
+        batch = client.post('/match/batch', json=request).json()
+        again = client.post('/match/batch', json={**request, 'weight_profiles': ['equal', None, None, None]}).json()
+    finally:
+        main.component_distances_packed = original_components
+    assert [r['matched_partners'] for r in batch['results']] == [r['matched_partners'] for r in expected]
+    assert again['results'][0]['matched_partners'] == expected[2]['matched_partners']
+    assert len(passes) == 1, f"Components computed once per (snapshot, query profile), got {len(passes)}"
+    assert client.post('/match/batch', json={**request, 'weight_profiles': ['equal']}).status_code == 400
+    
+    # Invalid weightings are rejected before ranking
+    for params in ({'weight_profile': 'nope'}, {'weights': 'subject=1,grade=1,days=0,times=0'},
+                   {'weights': 'subject=0.5'}, {'weights': 'garbage'}, {'weight_profile': 'equal', **days_only}):
+        assert client.post('/match', json=query_profile(), params=params).status_code == 400, params
+    assert client.post('/match/batch', json={'profiles': [query_profile()], 'weights': {'subject': -1}}).status_code == 400
+    
+    assert set(client.get('/weights').json()['weight_profiles']) >= {'survey', 'schedule_first', 'equal'}
+    print("✅ Weightings OK\n")
+
+
+def test_match_filters():
+    """Test filter expressions on /match: pushed-down masks, per-clause counts, cursors"""
+    print("=" * 60)
+    print("TEST 16: /match Filters")
+    print("=" * 60)
+    
+    users = make_backend_users(90)
+    for i, user in enumerate(users):
+        user['school'] = ['THPT A', 'THPT B', 'thpt a '][i % 3]
+        user['tag_study_times'] = [['Morning (6am-12pm)'], ['Evening (6pm-9pm)'], ['Morning (6am-12pm)', 'Evening (6pm-9pm)']][i % 4 % 3]
+    client, _ = make_client(users)
+    main.result_cache = ResultCache()
+    query = query_profile(school='THPT A', grade='10')
+    expression = 'grade_within=1,min_common_days=2,times=Evening (6pm-9pm),same_school'
+    
+    response = client.post('/match', json=query, params={'top_n': 90, 'filter': expression})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    
+    # Counts after the subject and each clause, matching a per-user check
+    passing = [u for u in users if int(u['grade']) <= 11]
+    counts = [90, len(passing)]
+    passing = [u for u in passing if u['tag_study_days'] == ['Monday', 'Wednesday']]
+    counts.append(len(passing))
+    passing = [u for u in passing if 'Evening (6pm-9pm)' in u['tag_study_times']]
+    counts.append(len(passing))
+    passing = [u for u in passing if u['school'].strip().casefold() == 'thpt a']
+    counts.append(len(passing))
+    assert [c['candidates'] for c in body['filter_counts']] == counts
+    assert [c['filter'] for c in body['filter_counts']] == [
+        'subject=math', 'grade_within=1', 'min_common_days=2', 'times=evening', 'same_school'
+    ]
+    assert {p['student_id'] for p in body['matched_partners']} == {u['user_id'] for u in passing}
+    
+    # Filtered ranking = unfiltered ranking restricted to the passing users
+    full = client.post('/match', json=query, params={'top_n': 90}).json()
+    assert full['filter_counts'] is None
+    allowed = {u['user_id'] for u in passing}
+    assert [p['student_id'] for p in body['matched_partners']] == [
+        p['student_id'] for p in full['matched_partners'] if p['student_id'] in allowed
+    ]
+    
+    # Pages of a filtered ranking; cursors do not carry over to another filter
+    first = client.post('/match', json=query, params={'top_n': 4, 'filter': expression}).json()
+    second = client.post('/match', json=query, params={'top_n': 4, 'filter': expression, 'cursor': first['next_cursor']}).json()
+    assert first['matched_partners'] + second['matched_partners'] == body['matched_partners'][:8]
+    assert second['filter_counts'] == body['filter_counts']
+    assert client.post('/match', json=query, params={'top_n': 4, 'cursor': first['next_cursor']}).status_code == 400
+    other_school = query_profile(school='THPT B', grade='10')
+    assert client.post('/match', json=other_school, params={'top_n': 4, 'filter': expression, 'cursor': first['next_cursor']}).status_code == 400
+    
+    # Stream applies the same filter
+    lines = client.post('/match/stream', json=query, params={'filter': expression}).text.splitlines()
+    assert json.loads(lines[0])['filter_counts'] == body['filter_counts']
+    assert [json.loads(line)['student_id'] for line in lines[1:-1]] == [p['student_id'] for p in body['matched_partners']]
+    
+    # Nobody left: empty page with the counts instead of a 404
+    empty = client.post('/match', json=query, params={'filter': 'days=sunday'}).json()
+    assert empty['matched_partners'] == [] and empty['filter_counts'][-1] == {'filter': 'days=sunday', 'candidates': 0}
+    
+    # Invalid expressions, same_school without a school
+    for expression in ('grade_within=x', 'color=red', 'same_school=1', 'times=noon', ','):
+        assert client.post('/match', json=query, params={'filter': expression}).status_code == 400, expression
+    assert client.post('/match', json=query_profile(), params={'filter': 'same_school'}).status_code == 400
+    print("✅ Filters OK\n")
+
+
+def test_incremental_indexes():
+    """Test that upserts/deletes patch buckets, school groups and caches instead of rebuilding them"""
+    print("=" * 60)
+    print("TEST 17: Indexes Patched In Place")
+    print("=" * 60)
+    
+    builds = {'buckets': 0, 'schools': 0}
+    originals = (snapshot_module.build_profile_buckets, snapshot_module.build_school_groups)
+    
+    def counted(name, build):
+        def wrapper(*args):
+            builds[name] += 1
+            return build(*args)
+        return wrapper
+    
+    users = make_backend_users(30) + make_backend_users(50, subject='Physics')[30:]
+    client, _ = make_client(users)
+    main.result_cache = ResultCache()
+    snapshot_module.build_profile_buckets = counted('buckets', originals[0])
+    snapshot_module.build_school_groups = counted('schools', originals[1])
+    try:
+        other_school = query_profile(school='THPT Chu Văn An')
+        physics = query_profile(tag_subject='Physics')
+        client.post('/match', json=query_profile(school='THPT Lê Hồng Phong'), params={'filter': 'same_school'})
+        client.post('/match', json=physics, params={'top_n': 8})
+        built = dict(builds)
+        
+        # Math edits: one student changes school, one joins it, one leaves
+        moved = {**users[3], 'school': 'THPT Chu Văn An'}
+        joined = {**users[5], 'user_id': 'new-1', 'school': ' thpt chu văn an', 'tag_study_days': ['Friday']}
+        for user in (moved, joined):
+            client.put(f"/users/{user['user_id']}", json=user)
+        client.delete('/users/user-4')
+        
+        hits = main.result_cache.hits
+        response = client.post('/match', json=other_school, params={'filter': 'same_school', 'top_n': 10}).json()
+        client.post('/match', json=physics, params={'top_n': 8})
+    finally:
+        snapshot_module.build_profile_buckets, snapshot_module.build_school_groups = originals
+    
+    assert built == {'buckets': 2, 'schools': 1}
+    assert builds == built, "Changes must patch the indexes, not rebuild them"
+    assert main.result_cache.hits == hits + 1, "Physics results survive math changes"
+    
+    # Same partners as a snapshot built from scratch with the edited users
+    edited = [user for user in users if user['user_id'] != 'user-4']
+    edited[3] = moved
+    fresh, _ = make_client(edited + [joined])
+    expected = fresh.post('/match', json=other_school, params={'filter': 'same_school', 'top_n': 10}).json()
+    assert {p['student_id'] for p in response['matched_partners']} == {'user-3', 'new-1'}
+    assert response['matched_partners'] == expected['matched_partners']
+    assert response['filter_counts'] == expected['filter_counts']
+    print("✅ Indexes patched in place OK\n")
+
+
+def save_graph_of(snapshot, path, k=10):
+    """Run the graph job on a live snapshot (as on the snapshot file it saves)"""
+    neighbors, distances = build_knn_graph(
+        snapshot.codes, k, workers=1, subject_rows=[partition.rows for partition in snapshot.partitions.values()]
+    )
+    save_knn_graph(
+        path, snapshot.column('student_id'), snapshot.codes, neighbors, distances, snapshot.version,
+        snapshot.content_version, {subject: partition.version for subject, partition in snapshot.partitions.items()}
+    )
+
+
+def test_knn_graph_paging():
+    """Test that paging on from a graph-served first page never repeats or skips a partner, also after changes"""
+    print("=" * 60)
+    print("TEST 18: kNN Graph Paging")
+    print("=" * 60)
+    
+    users = make_backend_users(40)
+    client, _ = make_client(users)
+    snapshot = asyncio.run(main.snapshot_store.get())
+    user = users[7]
+    query = query_profile(user_id=user['user_id'], grade=user['grade'], tag_study_days=user['tag_study_days'])
+    live = client.post('/match', json=query, params={'top_n': 15}).json()['matched_partners']
+    
+    def page_through():
+        pages = [client.post('/match', json=query, params={'top_n': 5}).json()]
+        for _ in range(2):
+            pages.append(client.post('/match', json=query, params={'top_n': 5, 'cursor': pages[-1]['next_cursor']}).json())
+        return [p for page in pages for p in page['matched_partners']]
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        save_graph_of(snapshot, tmp)
+        main.KNN_GRAPH_DIR = tmp
+        try:
+            from_graph = metrics.MATCH_REQUESTS.value(source='graph')
+            paged = page_through()
+            assert metrics.MATCH_REQUESTS.value(source='graph') == from_graph + 1, "First page comes from the graph"
+            
+            # Math changes after the job ran: a distance-0 twin joins and moves to position 0
+            # when user-0 leaves (every graph partner of user-7 is still indexed)
+            first = client.post('/match', json=query, params={'top_n': 5}).json()
+            client.put('/users/twin-7', json={**user, 'user_id': 'twin-7'})
+            client.delete('/users/user-0')
+            stale = client.post('/match', json=query, params={'top_n': 5, 'cursor': first['next_cursor']})
+            assert stale.status_code == 410, "A graph page's cursor expires with the subject's data"
+            
+            changed = page_through()
+            assert metrics.MATCH_REQUESTS.value(source='graph') == from_graph + 2, "Stale graph must not serve page 1"
+        finally:
+            main.KNN_GRAPH_DIR = None
+        
+        main.result_cache = ResultCache()
+        changed_live = client.post('/match', json=query, params={'top_n': 15}).json()['matched_partners']
+    
+    for pages, expected in ((paged, live), (changed, changed_live)):
+        ids = [p['student_id'] for p in pages]
+        assert len(ids) == len(set(ids)) == 15, "A partner was repeated across pages"
+        assert ids == [p['student_id'] for p in expected], "Pages skipped or reordered a partner"
+        assert [p['rank'] for p in pages] == list(range(1, 16))
+    assert changed[0]['student_id'] == 'twin-7'
+    print("✅ kNN graph paging OK\n")
+
+
+if __name__ == "__main__":
+    print("\n🧪 Testing Matching Service")
+    print("=" * 60)
+    
+    try:
+        test_snapshot_store()
+        test_incremental_upsert_delete()
+        test_batch_endpoint()
+        test_cluster_index()
+        test_knn_graph_serving()
+        test_result_cache()
+        test_metrics()
+        test_startup_and_readiness()
+        test_shared_snapshot()
+        test_snapshot_file_restart()
+        test_match_pagination()
+        test_match_stream()
+        test_population_stats()
+        test_bulk_encoder()
+        test_match_weightings()
+        test_match_filters()
+        test_incremental_indexes()
+        test_knn_graph_paging()
+        
+        print("=" * 60)
+        print("🎉 ALL TESTS PASSED!")
+        print("=" * 60)
+    
+    except AssertionError as e:
+        print(f"\n❌ TEST FAILED: {e}")
+    except Exception as e:
+        print(f"\n❌ ERROR: {e}")
+        import traceback
+        traceback.print_exc()